@@ -1,11 +1,13 @@
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, FileResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, FileResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.contrib import messages
 from django.core.files.storage import FileSystemStorage
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.core import serializers
-from django.utils.timezone import now
+from django.utils.timezone import now, localdate
 import json
 import random
 import string
@@ -29,10 +31,111 @@ except (ImportError, AttributeError):
 
 from student_management_app.models import (
     CustomUser, Staffs, Courses, Subjects, Students,
-    SessionYearModel, Attendance, AttendanceReport, StudentResult, AttendanceQRCode
+    SessionYearModel, Attendance, AttendanceReport, StudentResult, AttendanceQRCode, Geofence
 )
 from .utils import get_client_ip, verify_network_connectivity
 from .utils import export_attendance_to_excel
+from .qr_session import (
+    cache_qr_session, cache_qr_roster, qr_network_cache_key, get_staff_qr_session, get_qr_roster_names,
+    seconds_until_expiry, close_qr_session
+)
+from .qr_render import (
+    render_qr, cache_rendered_qr, get_rendered_qr, read_stored_qr, scan_url_prefix, qr_render_cache_key
+)
+from .checkin import preload_marked_students
+from .closeout import close_out_qr_code
+from .location_anomalies import summarize_anomalies
+from .distance_stats import summarize_distances
+from .qr_events import set_event_baseline, stream_checkin_events, astream_checkin_events
+from .qr_tokens import (
+    make_qr_token, make_frame_window, make_frame_code, frame_step, is_compact_token, FRAME_SEPARATOR
+)
+from .write_behind import flush_pending_reports
+
+
+def qr_url_prefix(request, compact):
+    return scan_url_prefix(request.build_absolute_uri('/'), compact)
+
+
+def build_rotation(token, rotation_seconds, expiry_time, url_prefix):
+    """
+    Frame window for a rotating QR code; the page renders the frames itself.
+
+    Returns:
+    - tuple: (rotation dict, or None for a static code, token to encode in the image)
+    """
+    if not rotation_seconds:
+        return None, token
+
+    # Precompute every frame until expiry
+    first_step, frames = make_frame_window(token, rotation_seconds, expiry_time.timestamp())
+    rotation = {
+        "seconds": rotation_seconds,
+        "first_step": first_step,
+        "frames": frames,
+        "server_time": now().timestamp(),
+        "url_prefix": url_prefix,
+        "token": token,
+        "separator": FRAME_SEPARATOR,
+    }
+    return rotation, f"{token}{FRAME_SEPARATOR}{frames[0]}"
+
+
+def build_network_info(request):
+    """Network policy for a new QR session from the teacher's request (None if disabled)."""
+    teacher_ip = get_client_ip(request)
+    enable_network_verification = request.POST.get('enableNetwork') == 'on'
+
+    print(f"Network verification settings:")
+    print(f"- Teacher IP: {teacher_ip}")
+    print(f"- Enable network verification: {enable_network_verification}")
+
+    if not enable_network_verification:
+        return None
+    return {
+        'teacher_ip': teacher_ip,
+        'teacher_ssid': None,  # IP-based verification only
+        'require_network_verification': True
+    }
+
+
+def start_qr_session(qr_code, network_info, qr_image, qr_content_type, rotation):
+    """
+    Cache the rendered image and everything the scan path needs for an active
+    QR code, and build the response for the teacher's page.
+    """
+    timeout = seconds_until_expiry(qr_code.expiry_time)
+
+    # Store network information in cache using the token as key
+    # This will expire when the QR code expires
+    if network_info:
+        cache.set(qr_network_cache_key(qr_code.token), network_info, timeout=timeout)
+        print(f"Stored network info in cache: {network_info}")  # Debug
+
+    # A rotating code's first frame is only good for one step
+    cache_rendered_qr(qr_code.id, qr_image, qr_content_type, qr_code.rotation_seconds or timeout)
+
+    # Cache everything the scan path needs so scans skip the QR lookup,
+    # plus the eligible roster and students already marked today
+    qr_session = cache_qr_session(qr_code, network_info)
+    cache_qr_roster(qr_session)
+    set_event_baseline(qr_session, preload_marked_students(qr_session))
+
+    # URL of the cached image (also usable for sharing the code)
+    qr_code_url = reverse('staff_qr_image', args=[qr_code.id])
+    print(f"QR code URL: {qr_code_url}")  # Debug
+
+    return {
+        "status": "success",
+        "qr_code_url": qr_code_url,
+        "expiry_time": qr_code.expiry_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "expires_in": timeout,
+        "qr_id": str(qr_code.id),
+        "stream_url": reverse('staff_qr_attendance_stream', args=[qr_code.id]),
+        "close_url": reverse('staff_close_qr', args=[qr_code.id]),
+        "rotation": rotation,
+    }
+
 
 def staff_generate_qr(request):
     print(f"QR Generation request: {request.method}")  # Debug
@@ -57,13 +160,16 @@ def staff_generate_qr(request):
         except (ValueError, TypeError):
             allowed_radius = 100  # Default fallback
 
-        # Get teacher's network information
-        teacher_ip = get_client_ip(request)
-        enable_network_verification = request.POST.get('enableNetwork') == 'on'
+        # Rotating QR mode: a new frame every N seconds (0 = static QR code)
+        try:
+            rotation_seconds = int(request.POST.get('rotation_seconds') or 0)
+            if rotation_seconds:
+                rotation_seconds = min(max(rotation_seconds, 5), 60)
+        except (ValueError, TypeError):
+            rotation_seconds = 0
 
-        print(f"Network verification settings:")
-        print(f"- Teacher IP: {teacher_ip}")
-        print(f"- Enable network verification: {enable_network_verification}")
+        # Classroom geofence: scans are checked against the room's outline instead of the radius
+        geofence_id = request.POST.get('geofence') or None
 
         print(f"Parsed data - Subject: {subject_id}, Session: {session_year_id}, Expiry: {expiry_minutes}")  # Debug
 
@@ -81,68 +187,62 @@ def staff_generate_qr(request):
             session_year = SessionYearModel.objects.get(id=session_year_id)
             print(f"Found session year: {session_year}")  # Debug
 
-            unique_token = str(uuid.uuid4())
+            geofence = Geofence.objects.get(id=geofence_id, is_active=True) if geofence_id else None
+            if geofence and not (teacher_latitude and teacher_longitude):
+                # The fence center stands in for the teacher's location (reports, re-verification)
+                teacher_latitude = geofence.center_latitude
+                teacher_longitude = geofence.center_longitude
+
+            # Signed token carrying the QR id, subject, session year and expiry,
+            # so scans can reject forged or expired codes without a database lookup
+            qr_id = uuid.uuid4()
+            expiry_time = now() + datetime.timedelta(minutes=int(expiry_minutes))
+            compact = settings.QR_COMPACT_TOKENS
+            unique_token = make_qr_token(qr_id, subject.id, session_year.id, expiry_time, compact=compact)
             print(f"Generated token: {unique_token}")  # Debug
 
             # Create a URL that includes the token for direct scanning
             # This URL will redirect to the login page if user is not logged in
-            qr_data = f"{request.build_absolute_uri('/scan-attendance/')}?token={unique_token}"
+            url_prefix = qr_url_prefix(request, compact)
+            rotation, qr_token = build_rotation(unique_token, rotation_seconds, expiry_time, url_prefix)
+
+            qr_data = f"{url_prefix}{qr_token}"
             print(f"QR data URL: {qr_data}")  # Debug
 
             print("Creating QR code...")  # Debug
-            qr = qrcode.make(qr_data)
-            qr_io = BytesIO()
-            qr.save(qr_io, format="PNG")
+            image_format = settings.QR_RENDER_FORMAT
+            qr_image, qr_content_type = render_qr(qr_data, image_format)
             print("QR code created successfully")  # Debug
 
             # Create QR code instance with basic fields first
             print("Creating QR code instance...")  # Debug
             qr_code_instance = AttendanceQRCode(
+                id=qr_id,
                 subject=subject,
                 session_year=session_year,
-                expiry_time=now() + datetime.timedelta(minutes=int(expiry_minutes)),
+                expiry_time=expiry_time,
                 is_active=True,
                 token=unique_token,
                 teacher_latitude=float(teacher_latitude) if teacher_latitude else None,
                 teacher_longitude=float(teacher_longitude) if teacher_longitude else None,
-                allowed_radius=float(allowed_radius)
+                allowed_radius=float(allowed_radius),
+                geofence=geofence,
+                rotation_seconds=rotation_seconds,
+                activated_at=now()
             )
-
-            # Store network information in cache using the token as key
-            # This will expire when the QR code expires
-            if enable_network_verification:
-                network_info = {
-                    'teacher_ip': teacher_ip,
-                    'teacher_ssid': None,  # IP-based verification only
-                    'require_network_verification': True
-                }
-                cache_key = f"qr_network_{unique_token}"
-                cache.set(cache_key, network_info, timeout=int(expiry_minutes) * 60)  # Cache for same duration as QR code
-                print(f"Stored network info in cache: {network_info}")  # Debug
             print("QR code instance created")  # Debug
 
-            # Network verification removed
-            print("Saving QR code image...")  # Debug
-            qr_code_instance.qr_code_image.save(f"qr_{subject.id}_{session_year.id}.png", ContentFile(qr_io.getvalue()), save=True)
-            print("QR code image saved successfully")  # Debug
-
-            # Get the full URL to the QR code image
-            qr_code_url = qr_code_instance.qr_code_image.url
-            print(f"QR code URL: {qr_code_url}")  # Debug
-
-            # Also include the base64 encoded image data for direct sharing
-            import base64
-            qr_io.seek(0)  # Reset the pointer to the beginning of the BytesIO object
-            qr_base64 = base64.b64encode(qr_io.getvalue()).decode('utf-8')
-            qr_data_url = f"data:image/png;base64,{qr_base64}"
-            print("Base64 encoding completed")  # Debug
-
-            response_data = {
-                "status": "success",
-                "qr_code_url": qr_code_instance.qr_code_image.url,
-                "qr_data_url": qr_data_url,  # Include the base64 data URL
-                "expiry_time": qr_code_instance.expiry_time.strftime("%Y-%m-%d %H:%M:%S"),
-            }
+            # The rendered image is served from the cache; keeping a copy in MEDIA_ROOT is optional
+            if settings.QR_STORE_IMAGE:
+                print("Saving QR code image...")  # Debug
+                qr_code_instance.qr_code_image.save(f"qr_{qr_id}.{image_format}", ContentFile(qr_image), save=True)
+                print("QR code image saved successfully")  # Debug
+            else:
+                qr_code_instance.save()
+
+            response_data = start_qr_session(
+                qr_code_instance, build_network_info(request), qr_image, qr_content_type, rotation
+            )
             print(f"Returning success response: {response_data}")  # Debug
             return JsonResponse(response_data)
 
@@ -152,6 +252,9 @@ def staff_generate_qr(request):
         except SessionYearModel.DoesNotExist:
             print(f"Session year not found with ID: {session_year_id}")  # Debug
             return JsonResponse({"status": "error", "message": "Invalid session year ID."}, status=400)
+        except Geofence.DoesNotExist:
+            print(f"Geofence not found with ID: {geofence_id}")  # Debug
+            return JsonResponse({"status": "error", "message": "Invalid geofence ID."}, status=400)
         except Exception as e:
             print(f"Unexpected error in QR generation: {str(e)}")  # Debug
             import traceback
@@ -161,6 +264,170 @@ def staff_generate_qr(request):
     return JsonResponse({"status": "error", "message": "Invalid request method."}, status=400)
 
 
+def staff_activate_qr(request, qr_id):
+    """
+    Switch on one of the teacher's QR codes pre-generated from the timetable
+    (pregenerate_qr_codes). The token and image already exist, so this only
+    updates the row and warms the cache. The teacher's current location, when
+    sent, replaces the classroom location from the timetable.
+    """
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Invalid request method."}, status=400)
+
+    qr_code = AttendanceQRCode.objects.select_related('subject').filter(
+        id=qr_id,
+        subject__staff_id__admin=request.user,
+        timetable_entry__isnull=False,
+        activated_at__isnull=True,
+        expiry_time__gte=now()
+    ).first()
+    if not qr_code:
+        return JsonResponse({"status": "error", "message": "This QR code is not available for activation."}, status=404)
+
+    try:
+        if request.POST.get('latitude') and request.POST.get('longitude'):
+            qr_code.teacher_latitude = float(request.POST['latitude'])
+            qr_code.teacher_longitude = float(request.POST['longitude'])
+    except ValueError:
+        return JsonResponse({"status": "error", "message": "Invalid location."}, status=400)
+
+    # Conditional update so two open tabs cannot both activate the code
+    qr_code.is_active = True
+    qr_code.activated_at = now()
+    updated = AttendanceQRCode.objects.filter(id=qr_code.id, activated_at__isnull=True).update(
+        is_active=True,
+        activated_at=qr_code.activated_at,
+        teacher_latitude=qr_code.teacher_latitude,
+        teacher_longitude=qr_code.teacher_longitude
+    )
+    if not updated:
+        return JsonResponse({"status": "error", "message": "This QR code has already been activated."}, status=409)
+
+    url_prefix = qr_url_prefix(request, is_compact_token(qr_code.token))
+    rotation, qr_token = build_rotation(qr_code.token, qr_code.rotation_seconds, qr_code.expiry_time, url_prefix)
+
+    # Static codes were rendered by pregenerate_qr_codes; render again if the file is not reachable here
+    rendered = None
+    if qr_code.qr_code_image and not rotation:
+        rendered = read_stored_qr(qr_code.qr_code_image.name)
+    if rendered is None:
+        rendered = render_qr(f"{url_prefix}{qr_token}", settings.QR_RENDER_FORMAT)
+
+    response_data = start_qr_session(qr_code, build_network_info(request), *rendered, rotation)
+    return JsonResponse(response_data)
+
+
+def staff_close_qr(request, qr_id):
+    """
+    End one of the teacher's QR sessions early: deactivate the code, mark its
+    cached session closed so new scans are refused (on every worker sharing the
+    cache), mark the students who did not check in as absent (see closeout.py)
+    and summarize suspicious locations and check-in distances. A scan already past the session lookup
+    can still be saved as present, but never over an absent row (see checkin.py).
+    """
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Invalid request method."}, status=400)
+
+    qr_code = AttendanceQRCode.objects.select_related('subject').filter(
+        id=qr_id,
+        subject__staff_id__admin=request.user
+    ).first()
+    if not qr_code:
+        return JsonResponse({"status": "error", "message": "QR code not found."}, status=404)
+
+    AttendanceQRCode.objects.filter(id=qr_code.id).update(is_active=False)
+    qr_code.is_active = False
+    close_qr_session(qr_code)
+    cache.delete(qr_render_cache_key(qr_code.id))
+
+    absent = close_out_qr_code(qr_code)
+    # Identical or clustered coordinates among the class's check-ins (see location_anomalies.py)
+    anomalies = summarize_anomalies(qr_code)
+    # Final distance statistics from the saved reports (see distance_stats.py)
+    distance_stats = summarize_distances(qr_code)
+    if absent is None:
+        return JsonResponse({
+            "status": "success",
+            "message": "Session ended. Absentees will be marked once the other open QR code for this class ends "
+                       "and every buffered check-in is saved.",
+            "absent": None,
+            "anomalies": anomalies,
+            "distance_stats": distance_stats
+        })
+    return JsonResponse({
+        "status": "success",
+        "message": f"Session ended. {absent} students marked absent.",
+        "absent": absent,
+        "anomalies": anomalies,
+        "distance_stats": distance_stats
+    })
+
+
+def staff_qr_image(request, qr_id):
+    """
+    Serve the rendered image of one of the teacher's active QR codes from the
+    render cache, re-rendering it once on a miss (e.g. another worker process).
+    """
+    rendered = get_rendered_qr(qr_id)
+    if rendered is None:
+        qr_code = AttendanceQRCode.objects.filter(
+            id=qr_id,
+            subject__staff_id__admin=request.user,
+            is_active=True,
+            expiry_time__gte=now()
+        ).first()
+        if not qr_code:
+            return HttpResponse(status=404)
+
+        token = qr_code.token
+        if qr_code.rotation_seconds:
+            # Rotating codes are drawn by the page; the fallback image shows the current frame
+            token = f"{token}{FRAME_SEPARATOR}{make_frame_code(token, frame_step(qr_code.rotation_seconds))}"
+        qr_data = f"{qr_url_prefix(request, is_compact_token(qr_code.token))}{token}"
+        rendered = render_qr(qr_data, settings.QR_RENDER_FORMAT)
+        if not qr_code.rotation_seconds:
+            cache_rendered_qr(qr_id, *rendered, seconds_until_expiry(qr_code.expiry_time))
+
+    image, content_type = rendered
+    response = HttpResponse(image, content_type=content_type)
+    response['Cache-Control'] = 'private, max-age=60'
+    return response
+
+
+def staff_qr_attendance_stream(request, qr_id):
+    """
+    Server-sent events feed of check-ins for one of the teacher's QR codes.
+    Sends a present/total summary, then one 'checkin' event per student and an
+    'expired' event when the QR code closes. Reconnects resume from
+    Last-Event-ID; once the QR code is gone the view answers 204 so the
+    browser stops reconnecting.
+    """
+    token = AttendanceQRCode.objects.filter(
+        id=qr_id,
+        subject__staff_id__admin=request.user
+    ).values_list('token', flat=True).first()
+
+    qr_session = get_staff_qr_session(token) if token else None
+    if not qr_session:
+        return HttpResponse(status=204)
+
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID') or 0)
+    except ValueError:
+        last_seq = 0
+
+    names = get_qr_roster_names(qr_session)
+    # ASGI servers need an async iterator to stream without buffering the response
+    if isinstance(request, ASGIRequest):
+        events = astream_checkin_events(qr_session, names, last_seq)
+    else:
+        events = stream_checkin_events(qr_session, names, last_seq)
+
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx)
+    return response
+
 
 def staff_home(request):
     # Get the Staff instance linked to the logged-in user
@@ -255,10 +522,21 @@ def staff_take_attendance(request):
     # Fetch all session years
     session_years = SessionYearModel.objects.all()
 
+    # Today's QR codes pre-generated from the timetable, waiting to be activated
+    pending_qr_codes = AttendanceQRCode.objects.select_related('subject', 'timetable_entry').filter(
+        subject__in=subjects,
+        timetable_entry__isnull=False,
+        activated_at__isnull=True,
+        expiry_time__gte=now(),
+        expiry_time__date=localdate()
+    ).order_by('expiry_time')
+
     context = {
         "subjects": subjects,
         "session_years": session_years,
-        "selected_subject": selected_subject
+        "selected_subject": selected_subject,
+        "pending_qr_codes": pending_qr_codes,
+        "geofences": Geofence.objects.filter(is_active=True)
     }
     return render(request, "staff_template/take_attendance_template.html", context)
 
@@ -469,6 +747,9 @@ def get_attendance_student(request):
         return JsonResponse([], safe=False)
 
     try:
+        # Make buffered QR check-ins visible before reading the reports
+        flush_pending_reports()
+
         attendance_data = AttendanceReport.objects.filter(attendance_id=attendance)
         print(f"Found {attendance_data.count()} attendance records")
 
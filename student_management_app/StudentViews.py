@@ -1,24 +1,18 @@
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, FileResponse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.core.files.storage import FileSystemStorage, default_storage
 from django.urls import reverse
 from django.utils.timezone import now
 from django.core.cache import cache
 import datetime
 import os
-# OpenCV is optional for deployment
-try:
-    import cv2
-    OPENCV_AVAILABLE = True
-except ImportError:
-    OPENCV_AVAILABLE = False
-    print("OpenCV not available - QR scanning will use alternative methods")
-
+from asgiref.sync import sync_to_async
 import numpy as np
 import json
-import tempfile
 from PIL import Image
 
 from django.views.decorators.csrf import csrf_exempt
@@ -26,9 +20,12 @@ from student_management_app.models import (
     CustomUser, Staffs, Courses, Subjects, Students,
     Attendance, AttendanceReport, StudentResult, SessionYearModel
 )
-from .utils import get_client_ip, verify_network_connectivity
-from .models import AttendanceQRCode
-from .utils import is_within_radius, export_attendance_to_excel
+from .utils import export_attendance_to_excel
+from .qr_tokens import extract_token
+from .qr_decode import DecoderBusy, DECODE_RETRY_AFTER, decode_qr_upload
+from .qr_upload_cache import fingerprint_upload, get_cached_decode, cache_decode, record_uploader
+from .checkin_pipeline import run_checkin, arun_checkin, report_checkin_timings
+from .idempotency import get_client_request_id, get_replay, replay_response
 
 def student_home(request):
     student_obj = Students.objects.get(admin=request.user.id)
@@ -62,21 +59,8 @@ def student_home(request):
     }
     return render(request, "student_template/student_home_template.html", context)
 
-def decode_qr_code(image_path):
-    """ Decodes QR Code using OpenCV (if available) """
-    if not OPENCV_AVAILABLE:
-        return None
-
-    try:
-        img = cv2.imread(image_path)
-        detector = cv2.QRCodeDetector()
-        data, _, _ = detector.detectAndDecode(img)
-        return data if data else None
-    except Exception as e:
-        print(f"OpenCV QR decode error: {e}")
-        return None
-
 @csrf_exempt
+@report_checkin_timings
 def student_upload_qr(request):
     if request.method == 'POST':
         try:
@@ -84,177 +68,49 @@ def student_upload_qr(request):
             if 'qr_image' not in request.FILES:
                 return JsonResponse({'status': 'error', 'message': 'No QR code image provided'})
 
+            # A retried upload with the same request id is answered before decoding the image
+            request_id = get_client_request_id(request, request.POST)
+            replayed = get_replay(request.user.id, request_id=request_id)
+            if replayed:
+                return replay_response(replayed)
+
             # Get the uploaded QR code image
             qr_image = request.FILES['qr_image']
 
-            # Get student's location data
-            latitude = request.POST.get('latitude')
-            longitude = request.POST.get('longitude')
-
             # Open and process the QR code image
             try:
-                import datetime
-                from django.utils.timezone import now
-                import tempfile
-                import os
-
-                token = None
-
-                # Try pyzbar first
-                try:
-                    from pyzbar.pyzbar import decode
-                    from PIL import Image
-
-                    # Open the image using PIL
-                    img = Image.open(qr_image)
-
-                    # Decode the QR code
-                    decoded_objects = decode(img)
-
-                    if decoded_objects:
-                        # Get the QR code data (token)
-                        token = decoded_objects[0].data.decode('utf-8')
-                except Exception as pyzbar_error:
-                    print(f"Pyzbar failed: {pyzbar_error}")
-
-                # If pyzbar failed, try OpenCV as fallback (if available)
-                if not token and OPENCV_AVAILABLE:
+                # Images seen before (e.g. a screenshot shared in a group chat) skip decoding
+                image_data = qr_image.read()
+                fingerprint = fingerprint_upload(image_data)
+                token = get_cached_decode(fingerprint)
+                if token:
+                    request.qr_decode_timings = [('cache', 0)]
+                else:
+                    # Decoded in memory in the decode pool: downscaled first, then larger sizes and crops (see qr_decode)
                     try:
-                        # Save uploaded file temporarily
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-                            for chunk in qr_image.chunks():
-                                temp_file.write(chunk)
-                            temp_file_path = temp_file.name
+                        token, request.qr_decode_timings = decode_qr_upload(image_data)
+                    except DecoderBusy as e:
+                        response = JsonResponse({'status': 'error', 'message': str(e), 'retry': True}, status=503)
+                        response['Retry-After'] = str(DECODE_RETRY_AFTER)
+                        return response
+                    if token:
+                        cache_decode(fingerprint, token)
 
-                        # Use OpenCV to decode
-                        token = decode_qr_code(temp_file_path)
+                if not token:
+                    return JsonResponse({'status': 'error', 'message': 'No QR code found in the image or unable to decode'})
 
-                        # Clean up temp file
-                        os.unlink(temp_file_path)
-                    except Exception as opencv_error:
-                        print(f"OpenCV failed: {opencv_error}")
+                shared_image_uploads = record_uploader(fingerprint, request.user.id)
 
+                # The image holds the scan URL (?token= or the short /Q/<token> form)
+                token = extract_token(token)
                 if not token:
-                    return JsonResponse({'status': 'error', 'message': 'No QR code found in the image or unable to decode'})
+                    return JsonResponse({'status': 'error', 'message': 'This QR code is not an attendance QR code'})
+
+                # Different students uploading the same image is flagged to the teacher
+                verification_extra = {'shared_image_uploads': shared_image_uploads} if shared_image_uploads > 1 else None
 
-                # Find the corresponding QR code record in the database
-                try:
-                    qr_code = AttendanceQRCode.objects.filter(
-                        token=token,
-                        is_active=True,
-                        expiry_time__gte=now()
-                    ).first()
-
-                    if not qr_code:
-                        return JsonResponse({'status': 'error', 'message': 'QR code has expired or is invalid'})
-
-                    # Get the student object
-                    student = Students.objects.get(admin=request.user.id)
-
-                    # Check if attendance already marked
-                    attendance_exists = Attendance.objects.filter(
-                        subject_id=qr_code.subject,
-                        session_year_id=qr_code.session_year,
-                        attendance_date=datetime.date.today()
-                    ).exists()
-
-                    if attendance_exists:
-                        attendance = Attendance.objects.get(
-                            subject_id=qr_code.subject,
-                            session_year_id=qr_code.session_year,
-                            attendance_date=datetime.date.today()
-                        )
-
-                        # Check if student already marked attendance
-                        if AttendanceReport.objects.filter(student_id=student, attendance_id=attendance).exists():
-                            return JsonResponse({'status': 'error', 'message': 'You have already marked attendance for this subject today'})
-                    else:
-                        # Create new attendance record
-                        attendance = Attendance(
-                            subject_id=qr_code.subject,
-                            attendance_date=datetime.date.today(),
-                            session_year_id=qr_code.session_year
-                        )
-                        attendance.save()
-
-                    # Verify location if teacher's location is available
-                    location_verified = False
-                    if qr_code.teacher_latitude and qr_code.teacher_longitude and latitude and longitude:
-                        # Convert to float
-                        student_lat = float(latitude)
-                        student_lon = float(longitude)
-                        teacher_lat = float(qr_code.teacher_latitude)
-                        teacher_lon = float(qr_code.teacher_longitude)
-                        allowed_radius = float(qr_code.allowed_radius)
-
-                        # Debug logging for upload QR
-                        print(f"Upload QR Location verification debug:")
-                        print(f"Student location: {student_lat}, {student_lon}")
-                        print(f"Teacher location: {teacher_lat}, {teacher_lon}")
-                        print(f"Allowed radius: {allowed_radius}")
-
-                        # Check if student is within allowed radius
-                        from .utils import is_within_radius
-
-                        verification_result = is_within_radius(
-                            student_lat, student_lon,
-                            teacher_lat, teacher_lon,
-                            allowed_radius
-                        )
-
-                        print(f"Upload QR Verification result: {verification_result}")
-
-                        # Extract the boolean value for location verification
-                        location_verified = bool(verification_result['is_within'])
-
-                        if not location_verified:
-                            return JsonResponse({
-                                'status': 'error',
-                                'message': f'You are not within the allowed radius for attendance. You are {verification_result["distance"]:.2f} meters away from the teacher, but the allowed radius is {verification_result["original_radius"]:.2f} meters.',
-                                'debug_info': {
-                                    'student_location': f'{student_lat:.6f}, {student_lon:.6f}',
-                                    'teacher_location': f'{teacher_lat:.6f}, {teacher_lon:.6f}',
-                                    'distance_calculated': round(verification_result["distance"], 2)
-                                }
-                            })
-
-                    # Network verification removed - only location-based verification is used
-
-                    # Create attendance report with proper data types
-                    # Create a verification details dictionary if we have location data
-                    verification_details = None
-                    if location_verified is not None and 'verification_result' in locals():
-                        verification_details = {
-                            'distance': float(verification_result['distance']),
-                            'allowed_radius': float(verification_result['original_radius']),
-                            'effective_radius': float(verification_result['effective_radius']),
-                            'error_margin': float(verification_result['error_margin']),
-                            'is_reliable': bool(verification_result['is_reliable'])
-                        }
-
-                    # Network verification removed - no longer needed
-
-                    # Create attendance report with basic fields
-                    attendance_report = AttendanceReport(
-                        student_id=student,
-                        attendance_id=attendance,
-                        status=True,
-                        student_latitude=float(latitude) if latitude else None,
-                        student_longitude=float(longitude) if longitude else None,
-                        location_verified=bool(location_verified),
-                        verification_details=verification_details
-                    )
-
-                    # Network verification removed - no longer needed
-                    attendance_report.save()
-
-                    return JsonResponse({
-                        'status': 'success',
-                        'message': 'Attendance marked successfully'
-                    })
-
-                except Exception as qr_error:
-                    return JsonResponse({'status': 'error', 'message': f'Error validating QR code: {str(qr_error)}'})
+                # Same check-in stages as a camera scan (see checkin_pipeline)
+                return run_checkin(request, request.user.id, token, request.POST, request_id, verification_extra)
 
             except Exception as e:
                 return JsonResponse({'status': 'error', 'message': f'Error processing QR code: {str(e)}'})
@@ -369,7 +225,12 @@ def student_scan_qr(request):
     # Check if there's a token in the session from external QR code scan
     attendance_token = request.session.get('attendance_token')
 
-    context = {}
+    # Under ASGI the page posts scans to the async view
+    context = {
+        'process_scan_url': reverse(
+            'student_process_qr_scan_async' if settings.QR_CHECKIN_ASYNC else 'student_process_qr_scan'
+        )
+    }
     if attendance_token:
         context['attendance_token'] = attendance_token
         # Clear the token from session to prevent reuse
@@ -380,6 +241,7 @@ def student_scan_qr(request):
 
 @csrf_exempt
 @login_required
+@report_checkin_timings
 def student_process_qr_scan(request):
     """Process QR code data from camera scan"""
     if request.method == 'POST':
@@ -391,231 +253,56 @@ def student_process_qr_scan(request):
             # Get the QR code data from the request
             data = json.loads(request.body)
             token = data.get('token')
-            latitude = data.get('latitude')
-            longitude = data.get('longitude')
-            student_ssid = data.get('network_ssid')  # Network SSID from student
 
             if not token:
                 return JsonResponse({'status': 'error', 'message': 'No QR code data provided'})
 
-            # Find the corresponding QR code record in the database
-            try:
-                qr_code = AttendanceQRCode.objects.filter(
-                    token=token,
-                    is_active=True,
-                    expiry_time__gte=now()
-                ).first()
-
-                if not qr_code:
-                    return JsonResponse({'status': 'error', 'message': 'QR code has expired or is invalid'})
-
-                # Get the student object
-                student = Students.objects.get(admin=request.user.id)
-
-                # Check if attendance already marked
-                attendance_exists = Attendance.objects.filter(
-                    subject_id=qr_code.subject,
-                    session_year_id=qr_code.session_year,
-                    attendance_date=datetime.date.today()
-                ).exists()
-
-                if attendance_exists:
-                    attendance = Attendance.objects.get(
-                        subject_id=qr_code.subject,
-                        session_year_id=qr_code.session_year,
-                        attendance_date=datetime.date.today()
-                    )
-
-                    # Check if student already marked attendance
-                    if AttendanceReport.objects.filter(student_id=student, attendance_id=attendance).exists():
-                        return JsonResponse({'status': 'error', 'message': 'You have already marked attendance for this subject today'})
-                else:
-                    # Create new attendance record
-                    attendance = Attendance(
-                        subject_id=qr_code.subject,
-                        attendance_date=datetime.date.today(),
-                        session_year_id=qr_code.session_year
-                    )
-                    attendance.save()
-
-                # Verify location if teacher's location is available
-                location_verified = False
-                location_details = {}
-
-                if qr_code.teacher_latitude and qr_code.teacher_longitude and latitude and longitude:
-                    # Convert to float
-                    student_lat = float(latitude)
-                    student_lon = float(longitude)
-                    teacher_lat = float(qr_code.teacher_latitude)
-                    teacher_lon = float(qr_code.teacher_longitude)
-                    allowed_radius = float(qr_code.allowed_radius)
-
-                    # Debug logging
-                    print(f"Location verification debug:")
-                    print(f"Student location: {student_lat}, {student_lon}")
-                    print(f"Teacher location: {teacher_lat}, {teacher_lon}")
-                    print(f"Allowed radius: {allowed_radius}")
-
-                    # Get student location accuracy if available
-                    student_accuracy = data.get('accuracy', None)
-                    print(f"Student accuracy: {student_accuracy}")
-
-                    # Check if student is within allowed radius with enhanced verification
-                    verification_result = is_within_radius(
-                        student_lat, student_lon,
-                        teacher_lat, teacher_lon,
-                        allowed_radius,
-                        student_accuracy
-                    )
-
-                    print(f"Verification result: {verification_result}")
-
-                    # Store verification details for the response
-                    location_details = {
-                        'distance': round(verification_result['distance'], 2),
-                        'allowed_radius': round(verification_result['original_radius'], 2),
-                        'effective_radius': round(verification_result['effective_radius'], 2),
-                        'error_margin': round(verification_result['error_margin'], 2),
-                        'is_reliable': bool(verification_result['is_reliable'])  # Ensure it's a proper boolean
-                    }
-
-                    print(f"Location details: {location_details}")
-
-                    # Check if coordinates are suspiciously identical
-                    if student_lat == teacher_lat and student_lon == teacher_lon:
-                        print("WARNING: Student and teacher coordinates are identical!")
-
-                    # Check if student is within radius
-                    location_verified = verification_result['is_within']
-                    print(f"Location verified: {location_verified}")
-
-                    if not location_verified:
-                        # Provide more detailed error message with distance information
-                        return JsonResponse({
-                            'status': 'error',
-                            'message': f'You are not within the allowed radius for attendance. You are {location_details["distance"]} meters away from the teacher, but the allowed radius is {location_details["allowed_radius"]} meters.',
-                            'location_details': location_details,
-                            'debug_info': {
-                                'student_location': f'{student_lat:.6f}, {student_lon:.6f}',
-                                'teacher_location': f'{teacher_lat:.6f}, {teacher_lon:.6f}',
-                                'distance_calculated': location_details["distance"]
-                            }
-                        })
-                else:
-                    # If teacher's location is not set, location verification is not required
-                    if qr_code.teacher_latitude and qr_code.teacher_longitude:
-                        # Teacher has location but student doesn't - require location
-                        return JsonResponse({
-                            'status': 'error',
-                            'message': 'Location data is required to mark attendance. Please enable location services and try again.'
-                        })
-                    else:
-                        # No location verification required
-                        location_verified = True  # Allow attendance without location verification
-
-                # Network verification using cached data
-                network_verified = False
-                network_verification_details = None
-                student_ip = get_client_ip(request)
-
-                # Get network information from cache
-                cache_key = f"qr_network_{token}"
-                network_info = cache.get(cache_key)
-
-                print(f"Network verification debug:")
-                print(f"- Cache key: {cache_key}")
-                print(f"- Network info from cache: {network_info}")
-                print(f"- Student IP: {student_ip}")
-
-                if network_info and network_info.get('require_network_verification'):
-                    teacher_ip = network_info.get('teacher_ip')
-                    teacher_ssid = network_info.get('teacher_ssid')
-
-                    # Perform network verification
-                    network_verification_result = verify_network_connectivity(
-                        student_ip=student_ip,
-                        teacher_ip=teacher_ip,
-                        student_ssid=student_ssid,
-                        teacher_ssid=teacher_ssid
-                    )
-
-                    network_verified = network_verification_result['is_same_network']
-                    network_verification_details = {
-                        'student_ip': student_ip,
-                        'teacher_ip': teacher_ip,
-                        'student_ssid': student_ssid,
-                        'teacher_ssid': teacher_ssid,
-                        'ip_match': network_verification_result['ip_match'],
-                        'ssid_match': network_verification_result['ssid_match'],
-                        'verification_method': network_verification_result['verification_method']
-                    }
-
-                    if not network_verified:
-                        return JsonResponse({
-                            'status': 'error',
-                            'message': 'Network verification failed. You must be connected to the same network as your teacher.',
-                            'network_details': network_verification_details
-                        })
-                else:
-                    # Network verification not required or no network info available
-                    print("Network verification skipped - not required or no network info available")
-                    network_verified = True
-
-                # Create attendance report with enhanced location details
-                # Convert location_details to a proper JSON-serializable format
-                json_location_details = None
-                if location_details:
-                    # Ensure all values are proper JSON types (bool, float, int, str, list, dict)
-                    json_location_details = {
-                        'distance': float(location_details['distance']),
-                        'allowed_radius': float(location_details['allowed_radius']),
-                        'effective_radius': float(location_details['effective_radius']),
-                        'error_margin': float(location_details['error_margin']),
-                        'is_reliable': bool(location_details['is_reliable'])
-                    }
-
-                # Create attendance report with available fields
-                # Store network verification details in the existing verification_details field
-                combined_verification_details = json_location_details or {}
-                if network_verification_details:
-                    combined_verification_details['network'] = network_verification_details
-                    combined_verification_details['network_verified'] = network_verified
-
-                attendance_report = AttendanceReport(
-                    student_id=student,
-                    attendance_id=attendance,
-                    status=True,
-                    student_latitude=student_lat if latitude else None,
-                    student_longitude=student_lon if longitude else None,
-                    student_accuracy=float(student_accuracy) if student_accuracy else None,
-                    location_verified=bool(location_verified),
-                    verification_details=combined_verification_details
-                )
-
-                attendance_report.save()
-
-                # Deactivate QR Code after successful attendance marking
-                # qr_code.is_active = False
-                # qr_code.save()
-
-                return JsonResponse({
-                    'status': 'success',
-                    'message': 'Attendance marked successfully',
-                    'subject': qr_code.subject.subject_name,
-                    'location_verified': location_verified,
-                    'location_details': location_details if location_details else None,
-                    'network_verified': network_verified,
-                    'network_details': network_verification_details if network_verification_details else None
-                })
-
-            except AttendanceQRCode.DoesNotExist:
-                return JsonResponse({'status': 'error', 'message': 'Invalid QR code'})
+            # Replay, session, roster, location, network and save stages (see checkin_pipeline)
+            request_id = get_client_request_id(request, data)
+            return run_checkin(request, request.user.id, token, data, request_id)
 
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': f'Error: {str(e)}'})
 
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
+
+@report_checkin_timings
+async def student_process_qr_scan_async(request):
+    """
+    Async variant of student_process_qr_scan for ASGI deployments. Cache and
+    database calls use Django's async APIs, so a worker keeps serving other
+    scans while one waits on I/O. Responses are identical to the sync view.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
+
+    try:
+        # login_required is sync-only in Django 4.2; resolve the lazy user off the event loop
+        user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+        if user is None:
+            return redirect_to_login(request.get_full_path())
+
+        if user.user_type != '3':
+            return JsonResponse({'status': 'error', 'message': 'Access denied. Students only.'})
+
+        data = json.loads(request.body)
+        token = data.get('token')
+
+        if not token:
+            return JsonResponse({'status': 'error', 'message': 'No QR code data provided'})
+
+        request_id = get_client_request_id(request, data)
+        return await arun_checkin(request, user.id, token, data, request_id)
+
+    except Exception as e:
+        return JsonResponse({'status': 'error', 'message': f'Error: {str(e)}'})
+
+
+# csrf_exempt() wraps views in a sync function in Django 4.2, so mark the async view directly
+student_process_qr_scan_async.csrf_exempt = True
+
+
 def student_export_attendance(request):
     """View for exporting student's attendance data"""
     student = Students.objects.get(admin=request.user.id)
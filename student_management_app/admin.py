@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, AdminHOD, Staffs, Courses, Subjects, Students, Attendance, AttendanceReport
+from .models import CustomUser, AdminHOD, Staffs, Courses, Subjects, Students, Attendance, AttendanceReport, TimetableEntry, Geofence
 class UserModel(UserAdmin):
     pass
 
@@ -14,4 +14,6 @@ admin.site.register(Subjects)
 admin.site.register(Students)
 admin.site.register(Attendance)
 admin.site.register(AttendanceReport)
+admin.site.register(TimetableEntry)
+admin.site.register(Geofence)
 
@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.core.exceptions import ImproperlyConfigured
 
 
 class StudentManagementAppConfig(AppConfig):
     name = 'student_management_app'
+
+    def ready(self):
+        # A typo in QR_DISTANCE_KERNEL must stop startup, not fail every scan
+        from .utils import get_distance_kernel
+        try:
+            get_distance_kernel()
+        except ValueError as e:
+            raise ImproperlyConfigured(f"QR_DISTANCE_KERNEL: {e}")
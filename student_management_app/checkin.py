@@ -0,0 +1,313 @@
+"""
+Race-free QR attendance check-in.
+
+Attendance rows are unique per (subject, session year, date) and attendance
+reports are unique per (student, attendance), so check-ins rely on the database
+constraints instead of check-then-insert. The Attendance id for a QR session is
+cached, which leaves a single INSERT per scan on the hot path (at most a SELECT
+plus an INSERT when the cache is cold).
+
+Students already marked are remembered in per-student cache markers (preloaded
+when the QR code is generated), so repeated scans are answered without a query.
+
+With settings.ATTENDANCE_WRITE_BEHIND enabled the report INSERT is deferred to
+the write-behind buffer (see write_behind.py) and duplicates are rejected by a
+cache marker instead of the database constraint.
+
+Every successful check-in is published to the teacher's live feed (see
+qr_events.py) and added to the session's running distance statistics (see
+distance_stats.py).
+
+A student marked absent when an earlier QR code for the class was closed (see
+closeout.py) is switched to present by a later check-in the same day. Before
+switching, the scanned QR code is read back from the database: a scan that got
+past the session lookup just before its own code was closed must not undo the
+close-out (QRSessionClosed).
+
+The a-prefixed functions are async variants for the ASGI scan views.
+"""
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+
+from . import write_behind
+from .distance_stats import record_distance, arecord_distance
+from .models import Attendance, AttendanceQRCode, AttendanceReport
+from .qr_events import publish_checkin, apublish_checkin
+from .qr_session import qr_closed_cache_key, session_attendance_date, session_timeout
+
+# Markers only need to outlive the attendance date they guard
+MARKED_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class QRSessionClosed(Exception):
+    """The QR code was closed while the check-in was in flight."""
+
+
+def qr_attendance_cache_key(token, attendance_date):
+    return f"qr_attendance_{token}_{attendance_date.isoformat()}"
+
+
+def get_session_attendance_id(qr_session, attendance_date):
+    """
+    Return the id of the Attendance row for this QR session and date, creating
+    it if needed. get_or_create is safe under concurrency thanks to the unique
+    constraint: a losing INSERT falls back to reading the winner's row.
+    """
+    cache_key = qr_attendance_cache_key(qr_session['token'], attendance_date)
+    attendance_id = cache.get(cache_key)
+
+    if attendance_id is None:
+        attendance, _ = Attendance.objects.get_or_create(
+            subject_id_id=qr_session['subject_id'],
+            session_year_id_id=qr_session['session_year_id'],
+            attendance_date=attendance_date
+        )
+        attendance_id = attendance.id
+        timeout = session_timeout(qr_session)
+        if timeout > 0:
+            cache.set(cache_key, attendance_id, timeout=timeout)
+
+    return attendance_id
+
+
+def attendance_marked_cache_key(attendance_id, student_id):
+    return f"attendance_marked_{attendance_id}_{student_id}"
+
+
+def preload_marked_students(qr_session, attendance_date=None):
+    """
+    Cache markers for students who already have a report for the session's attendance
+    (e.g. from an earlier QR code), without creating the Attendance row.
+    Returns the number of students already marked.
+    """
+    attendance_date = attendance_date or session_attendance_date(qr_session)
+    attendance = Attendance.objects.filter(
+        subject_id=qr_session['subject_id'],
+        session_year_id=qr_session['session_year_id'],
+        attendance_date=attendance_date
+    ).first()
+
+    if not attendance:
+        return 0
+
+    timeout = session_timeout(qr_session)
+    if timeout <= 0:
+        return 0
+
+    cache.set(qr_attendance_cache_key(qr_session['token'], attendance_date), attendance.id, timeout=timeout)
+    student_ids = list(
+        AttendanceReport.objects.filter(attendance_id=attendance, status=True).values_list('student_id', flat=True)
+    )
+    cache.set_many(
+        {attendance_marked_cache_key(attendance.id, student_id): True for student_id in student_ids},
+        timeout=MARKED_CACHE_TIMEOUT
+    )
+    return len(student_ids)
+
+
+def is_already_marked(qr_session, student_id, attendance_date=None):
+    """O(1) cache check for a student already checked in to this session."""
+    attendance_date = attendance_date or session_attendance_date(qr_session)
+    attendance_id = cache.get(qr_attendance_cache_key(qr_session['token'], attendance_date))
+    if attendance_id is None:
+        return False
+    return bool(cache.get(attendance_marked_cache_key(attendance_id, student_id)))
+
+
+def _absent_report(student_id, attendance_id):
+    return AttendanceReport.objects.filter(student_id_id=student_id, attendance_id_id=attendance_id, status=False)
+
+
+def _open_qr_code(qr_session):
+    return AttendanceQRCode.objects.filter(token=qr_session['token'], is_active=True)
+
+
+def _announce(qr_session, student_id, report_fields):
+    """Publish a written check-in to the live feed and the distance statistics."""
+    publish_checkin(qr_session, student_id, report_fields)
+    record_distance(qr_session, report_fields)
+
+
+async def _aannounce(qr_session, student_id, report_fields):
+    await apublish_checkin(qr_session, student_id, report_fields)
+    await arecord_distance(qr_session, report_fields)
+
+
+def check_in(qr_session, student_id, attendance_date=None, **report_fields):
+    """
+    Atomically mark a student present for a QR session.
+
+    Parameters:
+    - qr_session: Session dictionary from get_qr_session
+    - student_id: Primary key of the Students row
+    - attendance_date: Date to record (default: the QR code's day, see qr_attendance_date)
+    - report_fields: Extra AttendanceReport fields (location, verification details)
+
+    Returns:
+    - tuple: (AttendanceReport, True) on success, (None, False) if the student
+      had already been marked for this session
+
+    Raises:
+    - QRSessionClosed: The student was marked absent and the QR code has been closed since
+      (with write-behind: the QR code has been closed since the session was looked up)
+    """
+    attendance_date = attendance_date or session_attendance_date(qr_session)
+
+    if write_behind.is_enabled():
+        return _buffered_check_in(qr_session, student_id, attendance_date, report_fields)
+
+    for attempt in range(2):
+        attendance_id = get_session_attendance_id(qr_session, attendance_date)
+        try:
+            with transaction.atomic():
+                report = AttendanceReport.objects.create(
+                    student_id_id=student_id,
+                    attendance_id_id=attendance_id,
+                    status=True,
+                    **report_fields
+                )
+            cache.set(attendance_marked_cache_key(attendance_id, student_id), True, timeout=MARKED_CACHE_TIMEOUT)
+            _announce(qr_session, student_id, report_fields)
+            return report, True
+        except IntegrityError:
+            absent = _absent_report(student_id, attendance_id)
+            if absent.exists() and not _open_qr_code(qr_session).exists():
+                raise QRSessionClosed()
+            if absent.update(status=True, updated_at=now(), **report_fields):
+                cache.set(attendance_marked_cache_key(attendance_id, student_id), True, timeout=MARKED_CACHE_TIMEOUT)
+                _announce(qr_session, student_id, report_fields)
+                return AttendanceReport.objects.get(student_id_id=student_id, attendance_id_id=attendance_id), True
+
+            if AttendanceReport.objects.filter(student_id_id=student_id, attendance_id_id=attendance_id).exists():
+                cache.set(attendance_marked_cache_key(attendance_id, student_id), True, timeout=MARKED_CACHE_TIMEOUT)
+                return None, False
+
+            # The cached Attendance row was deleted (e.g. by the teacher); rebuild it once
+            cache.delete(qr_attendance_cache_key(qr_session['token'], attendance_date))
+            if attempt:
+                raise
+
+
+def _buffered_check_in(qr_session, student_id, attendance_date, report_fields):
+    """
+    Write-behind variant of check_in: claim the (attendance, student) pair with an
+    atomic cache.add and queue the report for a batched insert. bulk_create ignores
+    conflicts, so a pair that slips past the marker (e.g. with a per-process cache)
+    is still stored only once. The claim is released if the QR code was closed
+    meanwhile (QRSessionClosed) or the record could not be spooled.
+    """
+    attendance_id = get_session_attendance_id(qr_session, attendance_date)
+    marked_key = attendance_marked_cache_key(attendance_id, student_id)
+
+    if not cache.add(marked_key, True, timeout=MARKED_CACHE_TIMEOUT):
+        return None, False
+
+    record = dict(report_fields, student_id_id=student_id, attendance_id_id=attendance_id)
+    try:
+        # The flush turns absent rows into present without knowing the QR code, so check it here
+        if cache.get(qr_closed_cache_key(qr_session['token'])):
+            raise QRSessionClosed()
+        write_behind.get_write_buffer().enqueue(
+            record,
+            token=qr_session['token'],
+            expiry_timestamp=qr_session['expiry_timestamp']
+        )
+    except BaseException:
+        # Nothing was buffered, so the student must be able to scan again
+        cache.delete(marked_key)
+        raise
+    _announce(qr_session, student_id, report_fields)
+
+    return AttendanceReport(status=True, **record), True
+
+
+async def aget_session_attendance_id(qr_session, attendance_date):
+    """Async variant of get_session_attendance_id."""
+    cache_key = qr_attendance_cache_key(qr_session['token'], attendance_date)
+    attendance_id = await cache.aget(cache_key)
+
+    if attendance_id is None:
+        attendance, _ = await Attendance.objects.aget_or_create(
+            subject_id_id=qr_session['subject_id'],
+            session_year_id_id=qr_session['session_year_id'],
+            attendance_date=attendance_date
+        )
+        attendance_id = attendance.id
+        timeout = session_timeout(qr_session)
+        if timeout > 0:
+            await cache.aset(cache_key, attendance_id, timeout=timeout)
+
+    return attendance_id
+
+
+async def ais_already_marked(qr_session, student_id, attendance_date=None):
+    """Async variant of is_already_marked."""
+    attendance_date = attendance_date or session_attendance_date(qr_session)
+    attendance_id = await cache.aget(qr_attendance_cache_key(qr_session['token'], attendance_date))
+    if attendance_id is None:
+        return False
+    return bool(await cache.aget(attendance_marked_cache_key(attendance_id, student_id)))
+
+
+async def acheck_in(qr_session, student_id, attendance_date=None, **report_fields):
+    """
+    Async variant of check_in, with the same return value.
+
+    The report is a single INSERT in autocommit mode, so it needs no atomic
+    block (which the async ORM cannot open anyway); the unique constraint still
+    turns a concurrent duplicate into an IntegrityError.
+    """
+    attendance_date = attendance_date or session_attendance_date(qr_session)
+
+    if write_behind.is_enabled():
+        attendance_id = await aget_session_attendance_id(qr_session, attendance_date)
+        marked_key = attendance_marked_cache_key(attendance_id, student_id)
+        if not await cache.aadd(marked_key, True, timeout=MARKED_CACHE_TIMEOUT):
+            return None, False
+
+        record = dict(report_fields, student_id_id=student_id, attendance_id_id=attendance_id)
+        try:
+            if await cache.aget(qr_closed_cache_key(qr_session['token'])):
+                raise QRSessionClosed()
+            # The spool write fsyncs; keep it off the event loop and off the ORM thread
+            await sync_to_async(write_behind.get_write_buffer().enqueue, thread_sensitive=False)(
+                record,
+                token=qr_session['token'],
+                expiry_timestamp=qr_session['expiry_timestamp']
+            )
+        except BaseException:
+            await cache.adelete(marked_key)
+            raise
+        await _aannounce(qr_session, student_id, report_fields)
+        return AttendanceReport(status=True, **record), True
+
+    for attempt in range(2):
+        attendance_id = await aget_session_attendance_id(qr_session, attendance_date)
+        try:
+            report = await AttendanceReport.objects.acreate(
+                student_id_id=student_id,
+                attendance_id_id=attendance_id,
+                status=True,
+                **report_fields
+            )
+            await cache.aset(attendance_marked_cache_key(attendance_id, student_id), True, timeout=MARKED_CACHE_TIMEOUT)
+            await _aannounce(qr_session, student_id, report_fields)
+            return report, True
+        except IntegrityError:
+            absent = _absent_report(student_id, attendance_id)
+            if await absent.aexists() and not await _open_qr_code(qr_session).aexists():
+                raise QRSessionClosed()
+            if await absent.aupdate(status=True, updated_at=now(), **report_fields):
+                await cache.aset(attendance_marked_cache_key(attendance_id, student_id), True, timeout=MARKED_CACHE_TIMEOUT)
+                await _aannounce(qr_session, student_id, report_fields)
+                return await AttendanceReport.objects.aget(student_id_id=student_id, attendance_id_id=attendance_id), True
+
+            if await AttendanceReport.objects.filter(student_id_id=student_id, attendance_id_id=attendance_id).aexists():
+                await cache.aset(attendance_marked_cache_key(attendance_id, student_id), True, timeout=MARKED_CACHE_TIMEOUT)
+                return None, False
+
+            await cache.adelete(qr_attendance_cache_key(qr_session['token'], attendance_date))
+            if attempt:
+                raise
@@ -0,0 +1,485 @@
+"""
+QR check-in pipeline shared by the camera scan and image upload views.
+
+Once a view has a token (from the scan payload, or decoded from an uploaded
+image), the check-in always runs through the same stages:
+
+- replay: answer a retry of a scan that already succeeded
+- session: cached QR session for the token (falls back to the database)
+- roster: resolve the student from the cached roster, which also checks enrollment
+- marked: cache check for a student already marked for this session
+- geofence: point-in-fence check, if the QR code references a classroom Geofence
+- location: distance to the teacher against the allowed radius (sessions without a geofence)
+- network: same-network check, if the teacher's QR code requires it
+- anomaly: spatial-hash flags for identical or clustered coordinates (see location_anomalies.py)
+- save: check_in (Attendance get-or-create and report insert, see checkin.py), then
+  the written check-in's coordinates go into the anomaly spatial hash
+- remember: store the success response for replay
+
+A stage either returns None to continue or a JsonResponse that ends the
+check-in. Every stage is timed; the timings are stored on
+request.checkin_timings and report_checkin_timings sends them, after any
+decode timings, in a Server-Timing header.
+
+arun_checkin is the async variant for student_process_qr_scan_async. The
+location and network stages only read the cached session, so both variants
+share them; the geofence and anomaly stages differ only in how they reach
+the index and the cache.
+"""
+import asyncio
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from .checkin import check_in, is_already_marked, acheck_in, ais_already_marked, QRSessionClosed
+from .geofences import get_geofence_index, aget_geofence_index
+from .idempotency import get_replay, aget_replay, remember_response, aremember_response, replay_response
+from .location_anomalies import peek_location, apeek_location, record_location, arecord_location
+from .qr_decode import server_timing
+from .qr_session import get_qr_session, get_qr_roster, aget_qr_session, aget_qr_roster
+from .utils import get_client_ip, is_within_radius, verify_network_connectivity
+
+ALREADY_MARKED_MESSAGE = 'You have already marked attendance for this subject today'
+
+
+def _replay(checkin):
+    replayed = get_replay(checkin['user_id'], checkin['token'], checkin['request_id'])
+    if replayed:
+        return replay_response(replayed)
+    return None
+
+
+def _load_session(checkin):
+    checkin['qr_session'] = get_qr_session(checkin['token'])
+    if not checkin['qr_session']:
+        return JsonResponse({'status': 'error', 'message': 'QR code has expired or is invalid'})
+    return None
+
+
+def _resolve_student(checkin):
+    checkin['student_id'] = get_qr_roster(checkin['qr_session']).get(checkin['user_id'])
+    if checkin['student_id'] is None:
+        return JsonResponse({'status': 'error', 'message': 'You are not enrolled in this subject'})
+    return None
+
+
+def _check_marked(checkin):
+    if is_already_marked(checkin['qr_session'], checkin['student_id']):
+        return JsonResponse({'status': 'error', 'message': ALREADY_MARKED_MESSAGE})
+    return None
+
+
+def _location_required_response():
+    return JsonResponse({
+        'status': 'error',
+        'message': 'Location data is required to mark attendance. Please enable location services and try again.'
+    })
+
+
+def _check_geofence(checkin, index):
+    """
+    Point-in-fence check against the session's geofence. Leaves the check to
+    _verify_location when the fence is no longer in the index (deleted or
+    deactivated since the QR code was generated).
+    """
+    data = checkin['data']
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+    student_accuracy = data.get('accuracy') or None
+    geofence_id = checkin['qr_session']['geofence_id']
+
+    if not (latitude and longitude):
+        return _location_required_response()
+
+    student_lat = float(latitude)
+    student_lon = float(longitude)
+    outside = index.check(geofence_id, student_lat, student_lon)
+    if outside is None:
+        # Not in the index (deactivated since the QR code was made): fall back to the radius check
+        return None
+
+    fence = index.fences[geofence_id]
+    tolerance = float(settings.GEOFENCE_TOLERANCE_METERS)
+    location_details = {
+        'geofence': fence.name,
+        'geofence_id': geofence_id,
+        'rooms': [located.name for located, _ in index.locate(student_lat, student_lon)],
+        'distance_outside': round(outside, 2),
+        'tolerance': round(tolerance, 2),
+        'error_margin': round(float(student_accuracy), 2) if student_accuracy else 0.0,
+        'is_reliable': not student_accuracy or float(student_accuracy) <= tolerance
+    }
+
+    checkin['geofence_checked'] = True
+    if outside > tolerance:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'You are not inside {fence.name}. You are {location_details["distance_outside"]} meters outside it.',
+            'location_details': location_details
+        })
+
+    checkin['location_details'] = location_details
+    return None
+
+
+def _verify_geofence(checkin):
+    if not checkin['qr_session'].get('geofence_id'):
+        return None
+    return _check_geofence(checkin, get_geofence_index())
+
+
+async def _averify_geofence(checkin):
+    if not checkin['qr_session'].get('geofence_id'):
+        return None
+    return _check_geofence(checkin, await aget_geofence_index())
+
+
+def _verify_location(checkin):
+    """Radius check against the teacher's location, if the QR code has one."""
+    if checkin.get('geofence_checked'):
+        return None
+
+    qr_session = checkin['qr_session']
+    data = checkin['data']
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+    student_accuracy = data.get('accuracy') or None  # Location accuracy if available
+
+    if not (qr_session['teacher_latitude'] and qr_session['teacher_longitude']):
+        # If teacher's location is not set, location verification is not required
+        return None
+
+    if not (latitude and longitude):
+        # Teacher has location but student doesn't - require location
+        return _location_required_response()
+
+    student_lat = float(latitude)
+    student_lon = float(longitude)
+    teacher_lat = float(qr_session['teacher_latitude'])
+    teacher_lon = float(qr_session['teacher_longitude'])
+    allowed_radius = float(qr_session['allowed_radius'])
+
+    # Debug logging
+    print(f"Location verification debug:")
+    print(f"Student location: {student_lat}, {student_lon}")
+    print(f"Teacher location: {teacher_lat}, {teacher_lon}")
+    print(f"Allowed radius: {allowed_radius}")
+    print(f"Student accuracy: {student_accuracy}")
+
+    verification_result = is_within_radius(
+        student_lat, student_lon,
+        teacher_lat, teacher_lon,
+        allowed_radius,
+        float(student_accuracy) if student_accuracy else None
+    )
+
+    print(f"Verification result: {verification_result}")
+
+    location_details = {
+        'distance': round(float(verification_result['distance']), 2),
+        'allowed_radius': round(float(verification_result['original_radius']), 2),
+        'effective_radius': round(float(verification_result['effective_radius']), 2),
+        'error_margin': round(float(verification_result['error_margin']), 2),
+        'is_reliable': bool(verification_result['is_reliable'])
+    }
+
+    if not verification_result['is_within']:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'You are not within the allowed radius for attendance. You are {location_details["distance"]} meters away from the teacher, but the allowed radius is {location_details["allowed_radius"]} meters.',
+            'location_details': location_details,
+            'debug_info': {
+                'student_location': f'{student_lat:.6f}, {student_lon:.6f}',
+                'teacher_location': f'{teacher_lat:.6f}, {teacher_lon:.6f}',
+                'distance_calculated': location_details["distance"]
+            }
+        })
+
+    checkin['location_details'] = location_details
+    return None
+
+
+def _verify_network(checkin):
+    """Same-network check, using the network policy cached with the QR session."""
+    network_info = checkin['qr_session']['network']
+    checkin['network_verified'] = True
+    checkin['network_details'] = None
+
+    if not (network_info and network_info.get('require_network_verification')):
+        print("Network verification skipped - not required or no network info available")
+        return None
+
+    student_ip = get_client_ip(checkin['request'])
+    student_ssid = checkin['data'].get('network_ssid')  # Network SSID from student
+    teacher_ip = network_info.get('teacher_ip')
+    teacher_ssid = network_info.get('teacher_ssid')
+
+    print(f"Network verification debug:")
+    print(f"- Network info from session: {network_info}")
+    print(f"- Student IP: {student_ip}")
+
+    network_verification_result = verify_network_connectivity(
+        student_ip=student_ip,
+        teacher_ip=teacher_ip,
+        student_ssid=student_ssid,
+        teacher_ssid=teacher_ssid
+    )
+
+    network_details = {
+        'student_ip': student_ip,
+        'teacher_ip': teacher_ip,
+        'student_ssid': student_ssid,
+        'teacher_ssid': teacher_ssid,
+        'ip_match': network_verification_result['ip_match'],
+        'ssid_match': network_verification_result['ssid_match'],
+        'verification_method': network_verification_result['verification_method']
+    }
+
+    if not network_verification_result['is_same_network']:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Network verification failed. You must be connected to the same network as your teacher.',
+            'network_details': network_details
+        })
+
+    checkin['network_details'] = network_details
+    return None
+
+
+def _student_coordinates(checkin):
+    data = checkin['data']
+    if not (data.get('latitude') and data.get('longitude')):
+        return None
+    return float(data['latitude']), float(data['longitude'])
+
+
+def _flag_anomalies(checkin):
+    """Compare the check-in with the session's spatial hash; flags are recorded, never rejected."""
+    coordinates = _student_coordinates(checkin)
+    if coordinates:
+        checkin['anomalies'] = peek_location(checkin['qr_session'], *coordinates)
+    return None
+
+
+async def _aflag_anomalies(checkin):
+    coordinates = _student_coordinates(checkin)
+    if coordinates:
+        checkin['anomalies'] = await apeek_location(checkin['qr_session'], *coordinates)
+    return None
+
+
+def _report_fields(checkin):
+    """AttendanceReport fields for the verified check-in."""
+    data = checkin['data']
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+    accuracy = data.get('accuracy')
+
+    verification_details = dict(checkin['location_details'] or {})
+    if checkin['network_details']:
+        verification_details['network'] = checkin['network_details']
+        verification_details['network_verified'] = checkin['network_verified']
+    if checkin['anomalies']:
+        verification_details['anomalies'] = checkin['anomalies']
+    verification_details.update(checkin['verification_extra'])
+
+    return {
+        'student_latitude': float(latitude) if latitude else None,
+        'student_longitude': float(longitude) if longitude else None,
+        'student_accuracy': float(accuracy) if accuracy else None,
+        'location_verified': bool(checkin['location_verified']),
+        'verification_details': verification_details,
+    }
+
+
+def _success_payload(checkin):
+    return {
+        'status': 'success',
+        'message': 'Attendance marked successfully',
+        'subject': checkin['qr_session']['subject_name'],
+        'location_verified': checkin['location_verified'],
+        'location_details': checkin['location_details'],
+        'network_verified': checkin['network_verified'],
+        'network_details': checkin['network_details'],
+    }
+
+
+def _save(checkin):
+    # The unique constraints make concurrent duplicate scans fail cleanly
+    try:
+        _, created = check_in(checkin['qr_session'], checkin['student_id'], **_report_fields(checkin))
+    except QRSessionClosed:
+        return JsonResponse({'status': 'error', 'message': 'QR code has expired or is invalid'})
+    if not created:
+        return JsonResponse({'status': 'error', 'message': ALREADY_MARKED_MESSAGE})
+    # Only written check-ins count towards later anomaly flags
+    coordinates = _student_coordinates(checkin)
+    if coordinates:
+        record_location(checkin['qr_session'], *coordinates)
+    checkin['response_data'] = _success_payload(checkin)
+    return None
+
+
+def _remember(checkin):
+    remember_response(checkin['user_id'], checkin['response_data'], checkin['token'], checkin['request_id'])
+    return None
+
+
+async def _areplay(checkin):
+    replayed = await aget_replay(checkin['user_id'], checkin['token'], checkin['request_id'])
+    if replayed:
+        return replay_response(replayed)
+    return None
+
+
+async def _aload_session(checkin):
+    checkin['qr_session'] = await aget_qr_session(checkin['token'])
+    if not checkin['qr_session']:
+        return JsonResponse({'status': 'error', 'message': 'QR code has expired or is invalid'})
+    return None
+
+
+async def _aresolve_student(checkin):
+    checkin['student_id'] = (await aget_qr_roster(checkin['qr_session'])).get(checkin['user_id'])
+    if checkin['student_id'] is None:
+        return JsonResponse({'status': 'error', 'message': 'You are not enrolled in this subject'})
+    return None
+
+
+async def _acheck_marked(checkin):
+    if await ais_already_marked(checkin['qr_session'], checkin['student_id']):
+        return JsonResponse({'status': 'error', 'message': ALREADY_MARKED_MESSAGE})
+    return None
+
+
+async def _asave(checkin):
+    try:
+        _, created = await acheck_in(checkin['qr_session'], checkin['student_id'], **_report_fields(checkin))
+    except QRSessionClosed:
+        return JsonResponse({'status': 'error', 'message': 'QR code has expired or is invalid'})
+    if not created:
+        return JsonResponse({'status': 'error', 'message': ALREADY_MARKED_MESSAGE})
+    coordinates = _student_coordinates(checkin)
+    if coordinates:
+        await arecord_location(checkin['qr_session'], *coordinates)
+    checkin['response_data'] = _success_payload(checkin)
+    return None
+
+
+async def _aremember(checkin):
+    await aremember_response(checkin['user_id'], checkin['response_data'], checkin['token'], checkin['request_id'])
+    return None
+
+
+CHECKIN_STAGES = (
+    ('replay', _replay),
+    ('session', _load_session),
+    ('roster', _resolve_student),
+    ('marked', _check_marked),
+    ('geofence', _verify_geofence),
+    ('location', _verify_location),
+    ('network', _verify_network),
+    ('anomaly', _flag_anomalies),
+    ('save', _save),
+    ('remember', _remember),
+)
+
+ASYNC_CHECKIN_STAGES = (
+    ('replay', _areplay),
+    ('session', _aload_session),
+    ('roster', _aresolve_student),
+    ('marked', _acheck_marked),
+    ('geofence', _averify_geofence),
+    ('location', _verify_location),
+    ('network', _verify_network),
+    ('anomaly', _aflag_anomalies),
+    ('save', _asave),
+    ('remember', _aremember),
+)
+
+
+def _new_checkin(request, user_id, token, data, request_id, verification_extra):
+    return {
+        'request': request,
+        'user_id': user_id,
+        'token': token,
+        'data': data,
+        'request_id': request_id,
+        'verification_extra': verification_extra or {},
+        'location_verified': True,
+        'location_details': None,
+        'anomalies': None,
+    }
+
+
+def _elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def run_checkin(request, user_id, token, data, request_id=None, verification_extra=None):
+    """
+    Check a student in with a QR token.
+
+    Parameters:
+    - request: The view's request (client IP for the network check; timings are stored on it)
+    - user_id: CustomUser id of the student
+    - token: QR token, "<token>.<frame>" for rotating codes
+    - data: Mapping with latitude, longitude, accuracy and network_ssid
+    - request_id: Client request id for replay
+    - verification_extra: Extra verification_details entries (e.g. shared_image_uploads)
+
+    Returns:
+    - JsonResponse: The success response or the first stage's error
+    """
+    checkin = _new_checkin(request, user_id, token, data, request_id, verification_extra)
+    request.checkin_timings = timings = []
+    for name, stage in CHECKIN_STAGES:
+        started = time.perf_counter()
+        try:
+            response = stage(checkin)
+        finally:
+            timings.append((name, _elapsed_ms(started)))
+        if response is not None:
+            return response
+    return JsonResponse(checkin['response_data'])
+
+
+async def arun_checkin(request, user_id, token, data, request_id=None, verification_extra=None):
+    """Async variant of run_checkin."""
+    checkin = _new_checkin(request, user_id, token, data, request_id, verification_extra)
+    request.checkin_timings = timings = []
+    for name, stage in ASYNC_CHECKIN_STAGES:
+        started = time.perf_counter()
+        try:
+            response = stage(checkin)
+            if asyncio.iscoroutine(response):
+                response = await response
+        finally:
+            timings.append((name, _elapsed_ms(started)))
+        if response is not None:
+            return response
+    return JsonResponse(checkin['response_data'])
+
+
+def _add_server_timing(request, response):
+    timings = getattr(request, 'qr_decode_timings', None) or []
+    timings = timings + (getattr(request, 'checkin_timings', None) or [])
+    if timings:
+        response['Server-Timing'] = server_timing(timings)
+    return response
+
+
+def report_checkin_timings(view):
+    """Add a Server-Timing header with the decode and check-in stage timings stored on the request."""
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            return _add_server_timing(request, await view(request, *args, **kwargs))
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return _add_server_timing(request, view(request, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,90 @@
+"""
+Absent fill when a QR attendance session closes.
+
+QR check-ins only write present rows, so a student who never scans would have
+no AttendanceReport at all and be missing from absence counts and exports.
+Closing a QR code takes the eligible roster minus every student who already
+has a report for its day's Attendance row (a set difference) and inserts the
+rest as absent in one bulk_create. The day is the one check-ins were recorded
+under (qr_attendance_date, see qr_session.py).
+
+A QR code is closed when it expires (close_qr_sessions, run from cron) or when
+the teacher ends the session (staff_close_qr). AttendanceQRCode.closed_at
+records the close-out, and students who already have a report are never
+touched, so closing again is a no-op. While another QR code for the same class
+and day is still open the close-out is deferred, since its students may still
+scan, and likewise while check-ins for the class are still waiting in a
+write-behind buffer; a student scanning a later QR code the same day turns
+an absent row into a present one (see checkin.py).
+"""
+from django.db import transaction
+from django.utils.timezone import now
+
+from . import write_behind
+from .models import Attendance, AttendanceQRCode, AttendanceReport, Students
+from .qr_session import qr_attendance_date
+
+
+def has_open_sibling(qr_code, attendance_date):
+    """True if another active, unexpired QR code feeds the same Attendance row."""
+    siblings = AttendanceQRCode.objects.filter(
+        subject_id=qr_code.subject_id,
+        session_year_id=qr_code.session_year_id,
+        is_active=True,
+        expiry_time__gte=now()
+    ).exclude(id=qr_code.id).only('activated_at', 'expiry_time')
+    return any(qr_attendance_date(sibling) == attendance_date for sibling in siblings)
+
+
+def close_out_qr_code(qr_code):
+    """
+    Mark every eligible student without a report for the QR code's day as absent.
+
+    Parameters:
+    - qr_code: AttendanceQRCode (with subject loaded, or loadable)
+
+    Returns:
+    - int: Number of absent reports created, or None if the close-out was
+      deferred because another QR code for the class is still open or
+      check-ins for it are still buffered (see write_behind.py)
+    """
+    attendance_date = qr_attendance_date(qr_code)
+    if has_open_sibling(qr_code, attendance_date):
+        return None
+
+    # Buffered check-ins must be in the table before absentees are worked out,
+    # including those still in other workers' buffers
+    if write_behind.is_enabled():
+        write_behind.flush_pending_reports()
+        attendance_id = Attendance.objects.filter(
+            subject_id_id=qr_code.subject_id,
+            session_year_id_id=qr_code.session_year_id,
+            attendance_date=attendance_date
+        ).values_list('id', flat=True).first()
+        if attendance_id and not write_behind.wait_for_pending(attendance_id):
+            return None
+
+    with transaction.atomic():
+        attendance, _ = Attendance.objects.get_or_create(
+            subject_id_id=qr_code.subject_id,
+            session_year_id_id=qr_code.session_year_id,
+            attendance_date=attendance_date
+        )
+        roster = set(Students.objects.filter(
+            course_id=qr_code.subject.course_id_id,
+            session_year_id=qr_code.session_year_id
+        ).values_list('id', flat=True))
+        reported = set(
+            AttendanceReport.objects.filter(attendance_id=attendance).values_list('student_id', flat=True)
+        )
+        absent = roster - reported
+
+        # Conflicts are reports written since the set was read (e.g. a late scan); those rows win
+        AttendanceReport.objects.bulk_create(
+            [AttendanceReport(student_id_id=student_id, attendance_id=attendance, status=False)
+             for student_id in sorted(absent)],
+            ignore_conflicts=True
+        )
+        AttendanceQRCode.objects.filter(id=qr_code.id).update(closed_at=now())
+
+    return len(absent)
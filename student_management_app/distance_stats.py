@@ -0,0 +1,196 @@
+"""
+Running distance statistics for a QR session.
+
+Every check-in written with a distance (see checkin.py) updates a handful of
+cache counters for its token: the count, how many were reliable, the sum of
+distances in centimeters, and one counter per bucket of a log-scale histogram.
+Bucket i holds distances in (gamma^(i-1), gamma^i] meters, with
+gamma = (1 + a) / (1 - a) and a = settings.QR_DISTANCE_STATS_ACCURACY, so any
+percentile read back from it is within a relative error of a (the DDSketch
+construction). Distances up to 1 m share bucket 0.
+
+Updating is a few cache.incr calls per check-in. Reading is one get_many over
+the buckets up to the session's allowed radius (accepted check-ins are never
+farther), so the teacher's page gets count, mean, percentiles and the share of
+reliable fixes without touching AttendanceReport. The counters expire with the
+session, like the live feed (see qr_events.py), and like it they need a cache
+shared by the workers (REDIS_URL in production).
+
+When the teacher ends the session, summarize_distances computes the final,
+exact numbers from the saved reports instead (one query), so they never
+depend on the cache.
+"""
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import AttendanceReport
+from .qr_session import qr_attendance_date, session_timeout
+
+# Keep the counters a little past expiry so the teacher's page can read the final numbers
+STATS_GRACE_SECONDS = 300
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def qr_distance_stats_cache_key(token, name):
+    return f"qr_distance_stats_{token}_{name}"
+
+
+def _gamma():
+    accuracy = settings.QR_DISTANCE_STATS_ACCURACY
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def bucket_index(distance, gamma=None):
+    """Histogram bucket of a distance in meters."""
+    if distance <= 1:
+        return 0
+    return math.ceil(math.log(distance) / math.log(gamma or _gamma()))
+
+
+def bucket_value(index, gamma=None):
+    """Representative distance of a bucket (within the relative accuracy of every value in it)."""
+    if index == 0:
+        return 0.5
+    gamma = gamma or _gamma()
+    return 2 * gamma ** index / (gamma + 1)
+
+
+def _top_bucket(qr_session):
+    return bucket_index(max(float(qr_session['allowed_radius']), 1.0))
+
+
+def _updates(qr_session, report_fields):
+    """(cache key, increment) pairs for a check-in, or [] if it has no distance."""
+    details = report_fields.get('verification_details') or {}
+    distance = details.get('distance')
+    if distance is None:
+        return []
+
+    token = qr_session['token']
+    bucket = min(bucket_index(distance), _top_bucket(qr_session))
+    updates = [
+        (qr_distance_stats_cache_key(token, 'count'), 1),
+        (qr_distance_stats_cache_key(token, 'sum_cm'), int(round(distance * 100))),
+        (qr_distance_stats_cache_key(token, f'bucket_{bucket}'), 1),
+    ]
+    if details.get('is_reliable'):
+        updates.append((qr_distance_stats_cache_key(token, 'reliable'), 1))
+    return updates
+
+
+def record_distance(qr_session, report_fields):
+    """Add a written check-in's distance to the session's running statistics."""
+    timeout = session_timeout(qr_session) + STATS_GRACE_SECONDS
+    for key, delta in _updates(qr_session, report_fields):
+        cache.add(key, 0, timeout=timeout)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # Expired between add and incr; the session is over
+            return
+
+
+async def arecord_distance(qr_session, report_fields):
+    """Async variant of record_distance."""
+    timeout = session_timeout(qr_session) + STATS_GRACE_SECONDS
+    for key, delta in _updates(qr_session, report_fields):
+        await cache.aadd(key, 0, timeout=timeout)
+        try:
+            await cache.aincr(key, delta)
+        except ValueError:
+            return
+
+
+def _stats_keys(qr_session):
+    token = qr_session['token']
+    names = ['count', 'sum_cm', 'reliable'] + [f'bucket_{i}' for i in range(_top_bucket(qr_session) + 1)]
+    return {name: qr_distance_stats_cache_key(token, name) for name in names}
+
+
+def _summarize(qr_session, keys, found):
+    count = found.get(keys['count'], 0)
+    stats = {
+        'count': count,
+        'allowed_radius': float(qr_session['allowed_radius']),
+        'mean': None,
+        'reliable_fraction': None,
+        'percentiles': {},
+    }
+    if not count:
+        return stats
+
+    gamma = _gamma()
+    buckets = [(int(name[len('bucket_'):]), found[key]) for name, key in keys.items()
+               if name.startswith('bucket_') and found.get(key)]
+    total = sum(n for _, n in buckets)
+    stats['mean'] = round(found.get(keys['sum_cm'], 0) / 100 / count, 2)
+    stats['reliable_fraction'] = round(found.get(keys['reliable'], 0) / count, 3)
+
+    # Nearest-rank percentiles over the buckets in order
+    for percentile in PERCENTILES:
+        rank = max(math.ceil(percentile / 100 * total), 1)
+        seen = 0
+        for index, n in buckets:
+            seen += n
+            if seen >= rank:
+                stats['percentiles'][f'p{percentile}'] = round(bucket_value(index, gamma), 1)
+                break
+    return stats
+
+
+def get_distance_stats(qr_session):
+    """
+    The session's distance statistics, from the cache.
+
+    Returns:
+    - dict: count, allowed_radius, mean (meters), reliable_fraction and
+      percentiles ({'p50': meters, ...}); mean and reliable_fraction are None
+      before the first check-in with a distance
+    """
+    keys = _stats_keys(qr_session)
+    return _summarize(qr_session, keys, cache.get_many(list(keys.values())))
+
+
+async def aget_distance_stats(qr_session):
+    """Async variant of get_distance_stats."""
+    keys = _stats_keys(qr_session)
+    return _summarize(qr_session, keys, await cache.aget_many(list(keys.values())))
+
+
+def summarize_distances(qr_code):
+    """
+    Exact distance statistics over the saved check-ins for a QR code's class
+    and day, for the teacher when the session ends. One query.
+
+    Returns:
+    - dict: the same shape as get_distance_stats, with nearest-rank percentiles
+    """
+    rows = AttendanceReport.objects.filter(
+        attendance_id__subject_id=qr_code.subject_id,
+        attendance_id__session_year_id=qr_code.session_year_id,
+        attendance_id__attendance_date=qr_attendance_date(qr_code),
+        status=True,
+        verification_details__isnull=False
+    ).values_list('verification_details', flat=True)
+
+    measured = [details for details in rows if details.get('distance') is not None]
+    distances = sorted(float(details['distance']) for details in measured)
+    stats = {
+        'count': len(distances),
+        'allowed_radius': float(qr_code.allowed_radius),
+        'mean': None,
+        'reliable_fraction': None,
+        'percentiles': {},
+    }
+    if not distances:
+        return stats
+
+    stats['mean'] = round(sum(distances) / len(distances), 2)
+    stats['reliable_fraction'] = round(sum(1 for details in measured if details.get('is_reliable')) / len(distances), 3)
+    for percentile in PERCENTILES:
+        rank = max(math.ceil(percentile / 100 * len(distances)), 1)
+        stats['percentiles'][f'p{percentile}'] = round(distances[rank - 1], 1)
+    return stats
@@ -0,0 +1,185 @@
+"""
+In-process spatial index of classroom and building geofences.
+
+A QR session can reference a Geofence (a circle or polygon stored once by an
+admin) instead of a radius around the teacher's phone. Scans check the
+student's position against that outline and report every room it falls in.
+
+Each web worker process keeps a uniform grid over latitude/longitude: a fence
+is listed in every cell its bounding box (grown by GEOFENCE_TOLERANCE_METERS)
+touches, so a lookup hashes the point to one cell and runs the exact test
+only on the few fences listed there. Polygons are projected once to local
+meters around their center (the equirectangular kernel, see utils.py), which
+is exact to well under a centimeter at building scale.
+
+The index is versioned by the geofence table itself: the latest updated_at
+and the row count, so a save (e.g. in the admin) or a delete in any process
+is picked up by every other one. Each process reads the version at most
+every settings.GEOFENCE_INDEX_CHECK_SECONDS and rebuilds its index when the
+version changed.
+"""
+import math
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Max
+
+from .models import Geofence
+from .utils import WGS84_A, WGS84_E2
+
+_index = None
+_index_version = None
+_index_checked_at = 0.0
+_index_lock = threading.Lock()
+
+
+def _meters_per_degree(latitude):
+    """(meters per degree of latitude, meters per degree of longitude) at a latitude."""
+    phi = math.radians(latitude)
+    w = 1 - WGS84_E2 * math.sin(phi) ** 2
+    prime_vertical = WGS84_A / math.sqrt(w)
+    meridional = prime_vertical * (1 - WGS84_E2) / w
+    return math.radians(1) * meridional, math.radians(1) * prime_vertical * math.cos(phi)
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length_squared = dx * dx + dy * dy
+    t = 0.0 if length_squared == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_squared))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+class IndexedFence:
+    """A geofence prepared for lookups: local planar outline in meters around its center."""
+    __slots__ = ('id', 'name', 'building', 'center', 'scale', 'radius', 'vertices', 'extent')
+
+    def __init__(self, fence):
+        self.id = fence.id
+        self.name = str(fence)
+        self.building = fence.building
+        self.center = (float(fence.center_latitude), float(fence.center_longitude))
+        self.scale = _meters_per_degree(self.center[0])
+        if fence.shape == "circle":
+            self.radius = float(fence.radius)
+            self.vertices = None
+            self.extent = self.radius
+        else:
+            self.radius = None
+            self.vertices = [self._project(float(lat), float(lon)) for lat, lon in fence.polygon]
+            self.extent = max(math.hypot(x, y) for x, y in self.vertices)
+
+    def _project(self, latitude, longitude):
+        # Shortest way round across the antimeridian
+        delta_lon = (longitude - self.center[1] + 180) % 360 - 180
+        return delta_lon * self.scale[1], (latitude - self.center[0]) * self.scale[0]
+
+    def distance_outside(self, latitude, longitude):
+        """0 if the point is inside the fence, otherwise meters to its boundary."""
+        x, y = self._project(latitude, longitude)
+        if self.vertices is None:
+            return max(math.hypot(x, y) - self.radius, 0.0)
+
+        inside = False
+        nearest = float('inf')
+        previous = self.vertices[-1]
+        for vertex in self.vertices:
+            (ax, ay), (bx, by) = previous, vertex
+            if (ay > y) != (by > y) and x < (bx - ax) * (y - ay) / (by - ay) + ax:
+                inside = not inside
+            nearest = min(nearest, _segment_distance(x, y, ax, ay, bx, by))
+            previous = vertex
+        return 0.0 if inside else nearest
+
+
+class GeofenceIndex:
+    """Uniform latitude/longitude grid of fences (settings.GEOFENCE_GRID_CELL_DEGREES per cell)."""
+
+    def __init__(self, fences, cell_degrees, tolerance):
+        self.cell_degrees = cell_degrees
+        self.tolerance = tolerance
+        self.fences = {}
+        self.cells = {}
+        for fence in fences:
+            indexed = IndexedFence(fence)
+            self.fences[indexed.id] = indexed
+            for cell in self._cells_covering(indexed):
+                self.cells.setdefault(cell, []).append(indexed)
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees)
+
+    def _cells_covering(self, fence):
+        reach = fence.extent + self.tolerance
+        lat_reach = reach / fence.scale[0]
+        lon_reach = reach / max(fence.scale[1], 1e-9)
+        low_lat, low_lon = self._cell(fence.center[0] - lat_reach, fence.center[1] - lon_reach)
+        high_lat, high_lon = self._cell(fence.center[0] + lat_reach, fence.center[1] + lon_reach)
+        for cell_lat in range(low_lat, high_lat + 1):
+            for cell_lon in range(low_lon, high_lon + 1):
+                yield cell_lat, cell_lon
+
+    def locate(self, latitude, longitude):
+        """
+        Fences containing the point (within the tolerance), closest first and
+        the smaller of two containing fences (the room, then its building) first.
+
+        Returns:
+        - list: (IndexedFence, meters outside it, 0 if inside) pairs
+        """
+        found = []
+        for fence in self.cells.get(self._cell(latitude, longitude), ()):
+            outside = fence.distance_outside(latitude, longitude)
+            if outside <= self.tolerance:
+                found.append((fence, outside))
+        found.sort(key=lambda pair: (pair[1], pair[0].extent))
+        return found
+
+    def check(self, fence_id, latitude, longitude):
+        """Meters outside one fence (0 if inside), or None if it is not indexed (deleted or inactive)."""
+        fence = self.fences.get(fence_id)
+        if fence is None:
+            return None
+        return fence.distance_outside(latitude, longitude)
+
+
+def _index_version_from_db():
+    version = Geofence.objects.aggregate(latest=Max('updated_at'), fences=Count('id'))
+    return version['latest'], version['fences']
+
+
+def _refresh_index():
+    global _index, _index_version, _index_checked_at
+    with _index_lock:
+        if _index is not None and time.monotonic() - _index_checked_at < settings.GEOFENCE_INDEX_CHECK_SECONDS:
+            return _index
+        version = _index_version_from_db()
+        if _index is None or _index_version != version:
+            fences = Geofence.objects.filter(is_active=True, center_latitude__isnull=False)
+            _index = GeofenceIndex(
+                fences,
+                cell_degrees=settings.GEOFENCE_GRID_CELL_DEGREES,
+                tolerance=settings.GEOFENCE_TOLERANCE_METERS
+            )
+            _index_version = version
+        _index_checked_at = time.monotonic()
+        return _index
+
+
+def _is_fresh():
+    return _index is not None and time.monotonic() - _index_checked_at < settings.GEOFENCE_INDEX_CHECK_SECONDS
+
+
+def get_geofence_index():
+    """This process's index, rebuilt from the database if a geofence changed since it was built."""
+    if _is_fresh():
+        return _index
+    return _refresh_index()
+
+
+async def aget_geofence_index():
+    """Async variant of get_geofence_index (the version check and rebuild run off the event loop)."""
+    if _is_fresh():
+        return _index
+    return await sync_to_async(_refresh_index)()
@@ -0,0 +1,95 @@
+"""
+Replay of successful QR check-ins.
+
+Students on flaky networks often resend a scan that already succeeded. The
+success response is cached under (token, user) and, when the client sends one,
+under its request id (Idempotency-Key / X-Request-ID header or a request_id
+field). A retry is answered from the cache before any QR, roster or database
+lookup, with the original response body and an Idempotent-Replayed header.
+
+Only successful responses are stored: a failed scan (e.g. out of range) must be
+re-evaluated when the student tries again.
+"""
+import re
+
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from .qr_tokens import split_frame_token
+
+# Long enough to cover retries after the QR code expires
+REPLAY_CACHE_TIMEOUT = 15 * 60
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+
+def scan_replay_cache_key(token, user_id):
+    return f"qr_scan_replay_{token}_{user_id}"
+
+
+def request_replay_cache_key(user_id, request_id):
+    # Scoped to the user so one student cannot replay another's response
+    return f"qr_request_replay_{user_id}_{request_id}"
+
+
+def get_client_request_id(request, data=None):
+    """Client-supplied request id from the headers or the request data, or None if absent or malformed."""
+    request_id = (
+        request.headers.get('Idempotency-Key')
+        or request.headers.get('X-Request-ID')
+        or (data or {}).get('request_id')
+    )
+    if isinstance(request_id, str) and REQUEST_ID_PATTERN.match(request_id):
+        return request_id
+    return None
+
+
+def _replay_keys(user_id, token, request_id):
+    keys = []
+    if request_id:
+        keys.append(request_replay_cache_key(user_id, request_id))
+    if token:
+        # Every frame of a rotating QR code replays the same response
+        keys.append(scan_replay_cache_key(split_frame_token(token)[0], user_id))
+    return keys
+
+
+def _first_hit(keys, found):
+    for key in keys:
+        if key in found:
+            return found[key]
+    return None
+
+
+def get_replay(user_id, token=None, request_id=None):
+    """Return the stored response payload for a retried scan, or None."""
+    keys = _replay_keys(user_id, token, request_id)
+    if not keys:
+        return None
+    return _first_hit(keys, cache.get_many(keys))
+
+
+async def aget_replay(user_id, token=None, request_id=None):
+    """Async variant of get_replay."""
+    keys = _replay_keys(user_id, token, request_id)
+    if not keys:
+        return None
+    return _first_hit(keys, await cache.aget_many(keys))
+
+
+def remember_response(user_id, payload, token=None, request_id=None):
+    """Store a successful scan response for replay."""
+    keys = _replay_keys(user_id, token, request_id)
+    cache.set_many({key: payload for key in keys}, timeout=REPLAY_CACHE_TIMEOUT)
+
+
+async def aremember_response(user_id, payload, token=None, request_id=None):
+    """Async variant of remember_response."""
+    keys = _replay_keys(user_id, token, request_id)
+    await cache.aset_many({key: payload for key in keys}, timeout=REPLAY_CACHE_TIMEOUT)
+
+
+def replay_response(payload):
+    response = JsonResponse(payload)
+    response['Idempotent-Replayed'] = 'true'
+    return response
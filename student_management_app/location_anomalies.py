@@ -0,0 +1,240 @@
+"""
+Spoofed-location detection for QR check-ins.
+
+Students who fake their location tend to share one set of coordinates (from a
+group chat or a mock-location app), so several check-ins arrive with identical
+or nearly identical positions. Real phones in a classroom scatter by meters.
+
+Every saved check-in is bucketed into a spatial hash for its QR session: one
+cache counter per exact coordinate pair and one per grid cell of
+settings.QR_SPOOF_CELL_METERS. Before a check-in is saved, peek_location reads
+its coordinate pair, its cell and the eight neighbouring cells in one
+get_many, whatever the class size. It is flagged in
+verification_details['anomalies'] when:
+
+- identical_coordinates: an earlier check-in sent exactly the same coordinates
+- tight_cluster: at least settings.QR_SPOOF_CLUSTER_SIZE check-ins, this one
+  included, fall in its cell and the cells around it
+- teacher_coordinates: the coordinates equal the teacher's
+
+Only once the check-in is written (check_in created the report) does
+record_location add it to the counters, so rejected, duplicate and replayed
+scans never count. The counters are shared between workers through the cache
+(REDIS_URL in production).
+
+Flags are only a signal for the teacher; the check-in still succeeds. The
+first student of a group, or two scans arriving together, are not flagged when
+they scan, so the teacher's summary when the session ends
+(summarize_anomalies) recomputes groups over the whole class from a single
+query.
+"""
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import AttendanceReport
+from .qr_session import qr_attendance_date, session_timeout
+from .utils import EARTH_MEAN_RADIUS
+
+METERS_PER_DEGREE = math.radians(1) * EARTH_MEAN_RADIUS
+
+# Keep the counters a little past expiry for check-ins still in flight
+ANOMALY_GRACE_SECONDS = 60
+
+NEIGHBOUR_OFFSETS = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)]
+
+
+def qr_coords_cache_key(token, latitude, longitude):
+    return f"qr_coords_{token}_{latitude!r}_{longitude!r}"
+
+
+def qr_cell_cache_key(token, cell):
+    return f"qr_cell_{token}_{cell[0]}_{cell[1]}"
+
+
+def coordinate_cell(latitude, longitude, cell_meters=None):
+    """
+    Grid cell of a position, about cell_meters on a side. The longitude scale
+    is taken at the latitude rounded to 0.1 degrees, so every scan in one
+    classroom uses the same grid.
+    """
+    cell_meters = cell_meters or settings.QR_SPOOF_CELL_METERS
+    lon_scale = math.cos(math.radians(round(latitude, 1)))
+    return (
+        math.floor(latitude * METERS_PER_DEGREE / cell_meters),
+        math.floor(longitude * METERS_PER_DEGREE * lon_scale / cell_meters),
+    )
+
+
+def _keys(qr_session, latitude, longitude):
+    token = qr_session['token']
+    cell = coordinate_cell(latitude, longitude)
+    return (
+        qr_coords_cache_key(token, latitude, longitude),
+        qr_cell_cache_key(token, cell),
+        [qr_cell_cache_key(token, (cell[0] + i, cell[1] + j)) for i, j in NEIGHBOUR_OFFSETS],
+    )
+
+
+def _flags(qr_session, latitude, longitude, identical, cluster):
+    """The anomalies entry for verification_details, or None for an unremarkable check-in."""
+    flags = []
+    if identical:
+        flags.append('identical_coordinates')
+    if cluster >= settings.QR_SPOOF_CLUSTER_SIZE:
+        flags.append('tight_cluster')
+    if (qr_session['teacher_latitude'], qr_session['teacher_longitude']) == (latitude, longitude):
+        flags.append('teacher_coordinates')
+    if not flags:
+        return None
+    return {'flags': flags, 'identical': identical, 'cluster': cluster}
+
+
+def _incr(key, timeout):
+    cache.add(key, 0, timeout=timeout)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Expired between add and incr; the session is over
+        pass
+
+
+async def _aincr(key, timeout):
+    await cache.aadd(key, 0, timeout=timeout)
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        pass
+
+
+def _counts(keys, found):
+    coords_key, cell_key, neighbour_keys = keys
+    identical = found.get(coords_key, 0)
+    # This check-in is not counted yet
+    cluster = 1 + found.get(cell_key, 0) + sum(found.get(key, 0) for key in neighbour_keys)
+    return identical, cluster
+
+
+def _all_keys(keys):
+    coords_key, cell_key, neighbour_keys = keys
+    return [coords_key, cell_key] + neighbour_keys
+
+
+def peek_location(qr_session, latitude, longitude):
+    """
+    Anomaly flags for a check-in about to be saved, from the check-ins saved so far.
+
+    Returns:
+    - dict: {'flags': [...], 'identical': earlier check-ins at these exact
+      coordinates, 'cluster': check-ins in the 3x3 cells around it}, or None
+    """
+    keys = _keys(qr_session, latitude, longitude)
+    identical, cluster = _counts(keys, cache.get_many(_all_keys(keys)))
+    return _flags(qr_session, latitude, longitude, identical, cluster)
+
+
+async def apeek_location(qr_session, latitude, longitude):
+    """Async variant of peek_location."""
+    keys = _keys(qr_session, latitude, longitude)
+    identical, cluster = _counts(keys, await cache.aget_many(_all_keys(keys)))
+    return _flags(qr_session, latitude, longitude, identical, cluster)
+
+
+def record_location(qr_session, latitude, longitude):
+    """Add a saved check-in's coordinates to the session's spatial hash."""
+    coords_key, cell_key, _ = _keys(qr_session, latitude, longitude)
+    timeout = session_timeout(qr_session) + ANOMALY_GRACE_SECONDS
+    _incr(coords_key, timeout)
+    _incr(cell_key, timeout)
+
+
+async def arecord_location(qr_session, latitude, longitude):
+    """Async variant of record_location."""
+    coords_key, cell_key, _ = _keys(qr_session, latitude, longitude)
+    timeout = session_timeout(qr_session) + ANOMALY_GRACE_SECONDS
+    await _aincr(coords_key, timeout)
+    await _aincr(cell_key, timeout)
+
+
+def _dense_components(by_cell):
+    """Groups of touching cells whose 3x3 neighbourhood holds a tight cluster."""
+    def neighbourhood(cell):
+        return [(cell[0] + i, cell[1] + j) for i, j in NEIGHBOUR_OFFSETS + [(0, 0)]]
+
+    dense = {
+        cell for cell in by_cell
+        if sum(len(by_cell.get(other, ())) for other in neighbourhood(cell)) >= settings.QR_SPOOF_CLUSTER_SIZE
+    }
+    components = []
+    seen = set()
+    for start in dense:
+        if start in seen:
+            continue
+        seen.add(start)
+        stack, component = [start], []
+        while stack:
+            cell = stack.pop()
+            component.append(cell)
+            for other in neighbourhood(cell):
+                # Sparse cells next to a dense one belong to its cluster too
+                if other in by_cell and other not in seen:
+                    seen.add(other)
+                    if other in dense:
+                        stack.append(other)
+                    else:
+                        component.append(other)
+        components.append(component)
+    return components
+
+
+def summarize_anomalies(qr_code):
+    """
+    Identical-coordinate groups and tight clusters among the check-ins for a
+    QR code's class and day, for the teacher when the session ends. One query.
+
+    Returns:
+    - dict: checked (check-ins with a location), identical and clusters
+      (lists of {'students': [names], ...}) and flagged (students in any group)
+    """
+    rows = AttendanceReport.objects.filter(
+        attendance_id__subject_id=qr_code.subject_id,
+        attendance_id__session_year_id=qr_code.session_year_id,
+        attendance_id__attendance_date=qr_attendance_date(qr_code),
+        status=True,
+        student_latitude__isnull=False,
+        student_longitude__isnull=False
+    ).values_list(
+        'student_id', 'student_id__admin__first_name', 'student_id__admin__last_name',
+        'student_latitude', 'student_longitude'
+    )
+
+    by_coords = defaultdict(list)
+    by_cell = defaultdict(list)
+    for student_id, first_name, last_name, latitude, longitude in rows:
+        member = (student_id, f"{first_name} {last_name}".strip(), (latitude, longitude))
+        by_coords[(latitude, longitude)].append(member)
+        by_cell[coordinate_cell(latitude, longitude)].append(member)
+
+    identical = [
+        {'latitude': latitude, 'longitude': longitude, 'members': members}
+        for (latitude, longitude), members in by_coords.items() if len(members) > 1
+    ]
+
+    clusters = []
+    for component in _dense_components(by_cell):
+        members = [member for cell in component for member in by_cell[cell]]
+        # A cluster that is just one identical group is already reported above
+        if len({coords for _, _, coords in members}) > 1:
+            clusters.append({'members': members})
+
+    flagged = {student_id for group in identical + clusters for student_id, _, _ in group['members']}
+    for group in identical + clusters:
+        group['students'] = sorted(name for _, name, _ in group.pop('members'))
+    return {
+        'checked': sum(len(members) for members in by_coords.values()),
+        'identical': identical,
+        'clusters': clusters,
+        'flagged': len(flagged),
+    }
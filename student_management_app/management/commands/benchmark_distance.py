@@ -0,0 +1,94 @@
+import math
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from geopy.distance import geodesic
+
+from student_management_app.utils import DISTANCE_KERNELS
+
+# Distance bands for the error report, in meters
+BANDS = ((10, 100), (100, 1000), (1000, 5000), (5000, 50000))
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the distance kernels against geopy geodesic: per-call time and error distribution'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=20000, help='Point pairs to generate')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed')
+        parser.add_argument('--min-distance', type=float, default=10, help='Shortest pair distance in meters')
+        parser.add_argument('--max-distance', type=float, default=50000, help='Longest pair distance in meters')
+        parser.add_argument('--max-latitude', type=float, default=85, help='Sample latitudes within +/- this')
+
+    def handle(self, *args, **options):
+        if not 0 < options['min_distance'] < options['max_distance']:
+            raise CommandError("Need 0 < --min-distance < --max-distance")
+
+        pairs = self.build_pairs(options)
+        self.stdout.write(
+            f"{len(pairs)} point pairs, {options['min_distance']:g}-{options['max_distance']:g} m, "
+            f"latitudes within +/-{options['max_latitude']:g}"
+        )
+
+        timings = {name: self.time_kernel(kernel, pairs) for name, kernel in DISTANCE_KERNELS.items()}
+        reference = timings['geodesic']
+        self.stdout.write(f"\n{'kernel':<16} {'us/call':>9} {'speedup':>9}")
+        for name, per_call in timings.items():
+            self.stdout.write(f"{name:<16} {per_call * 1e6:>9.2f} {reference / per_call:>8.1f}x")
+
+        self.report_errors(pairs)
+
+    def build_pairs(self, options):
+        """
+        Random pairs whose exact geodesic distance is known: the second point
+        is the geodesic destination from the first at a log-uniform distance
+        and uniform bearing.
+        """
+        rng = random.Random(options['seed'])
+        low, high = math.log(options['min_distance']), math.log(options['max_distance'])
+        pairs = []
+        for _ in range(options['samples']):
+            lat = rng.uniform(-options['max_latitude'], options['max_latitude'])
+            lon = rng.uniform(-180, 180)
+            meters = math.exp(rng.uniform(low, high))
+            destination = geodesic(meters=meters).destination((lat, lon), rng.uniform(0, 360))
+            pairs.append((lat, lon, destination.latitude, destination.longitude, meters))
+        return pairs
+
+    def time_kernel(self, kernel, pairs):
+        """Seconds per call, best of three passes."""
+        best = float('inf')
+        for _ in range(3):
+            started = time.perf_counter()
+            for lat1, lon1, lat2, lon2, _ in pairs:
+                kernel(lat1, lon1, lat2, lon2)
+            best = min(best, time.perf_counter() - started)
+        return best / len(pairs)
+
+    def report_errors(self, pairs):
+        self.stdout.write("\nAbsolute error against geodesic in meters (p50 / p99 / max)")
+        header = f"{'kernel':<16}" + "".join(f"{f'{low:g}-{high:g} m':>30}" for low, high in BANDS)
+        self.stdout.write(header)
+        for name, kernel in DISTANCE_KERNELS.items():
+            if name == 'geodesic':
+                continue
+            row = f"{name:<16}"
+            for low, high in BANDS:
+                errors = [
+                    abs(kernel(lat1, lon1, lat2, lon2) - meters)
+                    for lat1, lon1, lat2, lon2, meters in pairs if low <= meters < high
+                ]
+                if not errors:
+                    row += f"{'-':>30}"
+                    continue
+                cell = f"{_percentile(errors, 0.5):.2g} / {_percentile(errors, 0.99):.2g} / {max(errors):.2g}"
+                row += f"{cell:>30}"
+            self.stdout.write(row)
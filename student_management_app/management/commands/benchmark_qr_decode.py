@@ -0,0 +1,205 @@
+import datetime
+import io
+import itertools
+import json
+import random
+import statistics
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, ImageFilter
+
+from student_management_app.qr_decode import (
+    DECODERS, INSTALLED_BACKENDS, _load, decode_qr_image
+)
+from student_management_app.qr_render import render_png, scan_url_prefix
+from student_management_app.qr_tokens import make_qr_token
+
+# Corpus grid: photo size, QR code width as a fraction of the short side, blur
+# radius, perspective skew (fraction of the width) and JPEG quality
+RESOLUTIONS = ((1280, 960), (2016, 1512), (4032, 3024))
+CODE_FRACTIONS = (0.12, 0.25, 0.5)
+BLURS = (0, 1.5, 3)
+SKEWS = (0, 0.12, 0.25)
+QUALITIES = (90, 60, 30)
+
+
+def _perspective_coeffs(source, target):
+    """PIL PERSPECTIVE coefficients mapping target corners back to source corners."""
+    rows = []
+    for (x, y), (u, v) in zip(target, source):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+    return np.linalg.solve(np.array(rows, dtype=float), np.array(source, dtype=float).reshape(8)).tolist()
+
+
+def make_sample(payload, variant, rng):
+    """JPEG bytes of a photo-like image containing the QR code for payload."""
+    width, height = variant['resolution']
+    np_rng = np.random.default_rng(rng.getrandbits(32))
+    # Uneven lighting plus sensor noise
+    shade = np.linspace(120, 190, width)[None, :] + np.linspace(-20, 20, height)[:, None]
+    background = (shade + np_rng.normal(0, 8, (height, width))).clip(0, 255).astype(np.uint8)
+    photo = Image.fromarray(background).convert('RGB')
+
+    size = int(min(width, height) * variant['code_fraction'])
+    code = Image.open(io.BytesIO(render_png(payload))).convert('RGB').resize((size, size), Image.Resampling.BILINEAR)
+    left = rng.randint(0, width - size)
+    top = rng.randint(0, height - size)
+    photo.paste(code, (left, top))
+
+    if variant['skew']:
+        inset = int(width * variant['skew'] / 2)
+        corners = [(0, 0), (width, 0), (width, height), (0, height)]
+        skewed = [(inset, 0), (width - inset, inset), (width, height), (0, height - inset)]
+        photo = photo.transform(
+            (width, height), Image.Transform.PERSPECTIVE,
+            _perspective_coeffs(corners, skewed), Image.Resampling.BILINEAR, fillcolor=(150, 150, 150)
+        )
+    if variant['blur']:
+        photo = photo.filter(ImageFilter.GaussianBlur(variant['blur']))
+
+    buffer = io.BytesIO()
+    photo.save(buffer, format='JPEG', quality=variant['quality'])
+    return buffer.getvalue()
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark QR decode success rate and latency per backend, downscale size and decoder order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=60, help='Images to draw from the corpus grid')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed for the corpus')
+        parser.add_argument('--sides', default='640,800,1024,1600,full',
+                            help="Comma-separated longest sides to measure ('full' = no downscaling)")
+        parser.add_argument('--base-url', default='https://attendance.example.com',
+                            help='Site URL encoded in the QR codes')
+        parser.add_argument('--json', dest='json_path', help='Also write per-image results to this file')
+
+    def handle(self, *args, **options):
+        backends = [name for name in DECODERS if INSTALLED_BACKENDS[name]]
+        if not backends:
+            raise CommandError("Neither pyzbar nor OpenCV is installed")
+        try:
+            sides = [None if side == 'full' else int(side) for side in options['sides'].split(',')]
+        except ValueError:
+            raise CommandError(f"Invalid --sides {options['sides']!r}")
+
+        corpus = self.build_corpus(options['samples'], options['seed'], options['base_url'])
+        self.stdout.write(f"Corpus: {len(corpus)} images, backends: {', '.join(backends)}")
+
+        results = []
+        for sample in corpus:
+            results.append(self.measure(sample, backends, sides))
+
+        self.report_backends(results, backends, sides)
+        self.report_orders(results)
+        self.suggest(results, backends, sides)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w', encoding='utf-8') as output:
+                json.dump(results, output, indent=1)
+            self.stdout.write(f"Per-image results written to {options['json_path']}")
+
+    def build_corpus(self, samples, seed, base_url):
+        """Payloads in the same format as staff_generate_qr, rendered into distorted photos."""
+        rng = random.Random(seed)
+        grid = list(itertools.product(RESOLUTIONS, CODE_FRACTIONS, BLURS, SKEWS, QUALITIES))
+        compact = settings.QR_COMPACT_TOKENS
+        url_prefix = scan_url_prefix(base_url, compact)
+        expiry_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=30)
+
+        corpus = []
+        for resolution, code_fraction, blur, skew, quality in rng.sample(grid, min(samples, len(grid))):
+            qr_id = uuid.UUID(int=rng.getrandbits(128))
+            token = make_qr_token(qr_id, rng.randint(1, 500), rng.randint(1, 20), expiry_time, compact=compact)
+            variant = {
+                'resolution': resolution, 'code_fraction': code_fraction,
+                'blur': blur, 'skew': skew, 'quality': quality,
+            }
+            payload = f"{url_prefix}{token}"
+            corpus.append({'payload': payload, 'variant': variant, 'data': make_sample(payload, variant, rng)})
+        return corpus
+
+    def measure(self, sample, backends, sides):
+        """Decode one image with every backend at every size, and through the pipeline in every order."""
+        data, payload = sample['data'], sample['payload']
+        result = {'variant': sample['variant'], 'bytes': len(data), 'single': {}, 'pipeline': {}}
+
+        for side in sides:
+            started = time.perf_counter()
+            image = _load(data, side)
+            load_ms = (time.perf_counter() - started) * 1000
+            for backend in backends:
+                started = time.perf_counter()
+                decoded = DECODERS[backend](image)
+                decode_ms = (time.perf_counter() - started) * 1000
+                result['single'][f"{backend}@{side or 'full'}"] = {
+                    'ok': decoded == payload, 'ms': load_ms + decode_ms,
+                }
+
+        configured_sides = tuple(getattr(settings, 'QR_DECODE_DOWNSCALE_SIDES', ()))
+        for order in itertools.permutations(backends):
+            started = time.perf_counter()
+            decoded, _ = decode_qr_image(data, backends=order, downscale_sides=configured_sides)
+            result['pipeline'][','.join(order)] = {
+                'ok': decoded == payload, 'ms': (time.perf_counter() - started) * 1000,
+            }
+        return result
+
+    def _summary(self, entries):
+        latencies = [entry['ms'] for entry in entries]
+        successes = sum(1 for entry in entries if entry['ok'])
+        return successes, statistics.median(latencies), _percentile(latencies, 0.95)
+
+    def report_backends(self, results, backends, sides):
+        self.stdout.write("\nSingle attempt (load at size + decode)")
+        self.stdout.write(f"{'backend':<8} {'side':>6} {'success':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        for backend, side in itertools.product(backends, sides):
+            key = f"{backend}@{side or 'full'}"
+            successes, p50, p95 = self._summary([result['single'][key] for result in results])
+            self.stdout.write(
+                f"{backend:<8} {side or 'full':>6} {successes:>4}/{len(results):<4} {p50:>9.1f} {p95:>9.1f}"
+            )
+
+    def report_orders(self, results):
+        sides = getattr(settings, 'QR_DECODE_DOWNSCALE_SIDES', ())
+        self.stdout.write(f"\nFull pipeline (downscale sides {tuple(sides)}, then crops and full resolution)")
+        self.stdout.write(f"{'order':<16} {'success':>9} {'p50 ms':>9} {'p95 ms':>9}")
+        for order in results[0]['pipeline']:
+            successes, p50, p95 = self._summary([result['pipeline'][order] for result in results])
+            self.stdout.write(f"{order:<16} {successes:>4}/{len(results):<4} {p50:>9.1f} {p95:>9.1f}")
+
+    def suggest(self, results, backends, sides):
+        """Order backends by success then speed; pick the cheapest sizes that keep most of the success rate."""
+        def backend_score(backend):
+            entries = [result['single'][f"{backend}@{side or 'full'}"] for result in results for side in sides]
+            successes, p50, _ = self._summary(entries)
+            return -successes, p50
+
+        order = sorted(backends, key=backend_score)
+        first = order[0]
+        by_side = {
+            side: self._summary([result['single'][f"{first}@{side or 'full'}"] for result in results])[0]
+            for side in sides if side
+        }
+        suggested_sides = ()
+        if by_side:
+            best = max(by_side.values())
+            cheap = min((side for side, ok in by_side.items() if ok >= 0.8 * best), default=None)
+            wide = min((side for side, ok in by_side.items() if ok >= best), default=None)
+            suggested_sides = tuple(sorted({side for side in (cheap, wide) if side}))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"\nSuggested: QR_DECODE_BACKENDS = {tuple(order)!r}, QR_DECODE_DOWNSCALE_SIDES = {suggested_sides!r}"
+        ))
@@ -0,0 +1,154 @@
+import datetime
+import json
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from student_management_app.models import AttendanceQRCode
+from student_management_app.qr_render import qr_render_cache_key
+from student_management_app.qr_session import qr_session_cache_keys
+
+QR_IMAGE_DIR = 'qr_codes'
+
+
+class Command(BaseCommand):
+    help = 'Deactivate expired QR codes, delete their images and archive or purge rows past the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.QR_CODE_RETENTION_DAYS,
+                            help='Keep expired QR code rows this many days before purging them')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per UPDATE/DELETE statement')
+        parser.add_argument('--archive', action='store_true',
+                            help='Append purged rows to a JSONL file under QR_CODE_ARCHIVE_DIR (local disk) before deleting them')
+        parser.add_argument('--orphaned-files', action='store_true',
+                            help=f'Also delete files under MEDIA_ROOT/{QR_IMAGE_DIR}/ that no QR code row references')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be done without changing anything')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.dry_run = options['dry_run']
+        cutoff = now() - datetime.timedelta(days=options['retention_days'])
+
+        deactivated = self.deactivate_expired()
+        files = self.delete_images()
+        purged = self.purge_rows(cutoff, options['archive'])
+        orphans = self.delete_orphaned_files() if options['orphaned_files'] else 0
+
+        prefix = "[dry run] " if self.dry_run else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}Deactivated {deactivated} expired QR codes, deleted {files} images, "
+            f"purged {purged} rows older than {options['retention_days']} days"
+            + (f", removed {orphans} orphaned files" if options['orphaned_files'] else "")
+        ))
+
+    def batches(self, queryset, *fields):
+        """Yield lists of value tuples, re-running the query after each batch is processed."""
+        while True:
+            batch = list(queryset.order_by('expiry_time').values_list(*fields)[:self.batch_size])
+            if not batch:
+                return
+            yield batch
+            if self.dry_run:
+                # Nothing changed, so the same rows would come back again
+                return
+
+    def count_or_run(self, queryset, *fields):
+        if self.dry_run:
+            return queryset.count(), []
+        return None, self.batches(queryset, *fields)
+
+    def deactivate_expired(self):
+        expired = AttendanceQRCode.objects.filter(is_active=True, expiry_time__lt=now())
+        count, batches = self.count_or_run(expired, 'id', 'token')
+        if count is not None:
+            return count
+
+        total = 0
+        for batch in batches:
+            ids = [qr_id for qr_id, _ in batch]
+            total += AttendanceQRCode.objects.filter(id__in=ids).update(is_active=False)
+            # Expired sessions are refused by their expiry timestamp anyway; dropping them frees
+            # the cache, and only reaches the web workers when the cache is shared (REDIS_URL)
+            keys = []
+            for qr_id, token in batch:
+                keys += qr_session_cache_keys(token) + [qr_render_cache_key(qr_id)]
+            cache.delete_many(keys)
+        return total
+
+    def delete_images(self):
+        # Pre-generated codes are inactive until activated, so only expired rows lose their image
+        with_images = AttendanceQRCode.objects.filter(
+            is_active=False, expiry_time__lt=now()
+        ).exclude(qr_code_image='')
+        count, batches = self.count_or_run(with_images, 'id', 'qr_code_image')
+        if count is not None:
+            return count
+
+        total = 0
+        for batch in batches:
+            for _, name in batch:
+                try:
+                    default_storage.delete(name)
+                except OSError as e:
+                    self.stderr.write(f"Could not delete {name}: {e}")
+            total += AttendanceQRCode.objects.filter(id__in=[qr_id for qr_id, _ in batch]).update(qr_code_image='')
+        return total
+
+    def purge_rows(self, cutoff, archive):
+        old = AttendanceQRCode.objects.filter(is_active=False, expiry_time__lt=cutoff)
+        if self.dry_run:
+            return old.count()
+
+        archive_file = None
+        if archive:
+            os.makedirs(settings.QR_CODE_ARCHIVE_DIR, exist_ok=True)
+            archive_path = os.path.join(settings.QR_CODE_ARCHIVE_DIR, f"qr_codes-{now():%Y%m%d}.jsonl")
+            archive_file = open(archive_path, 'a', encoding='utf-8')
+
+        fields = (
+            'id', 'subject_id', 'session_year_id', 'expiry_time', 'token',
+            'teacher_latitude', 'teacher_longitude', 'allowed_radius', 'rotation_seconds',
+            'timetable_entry_id', 'activated_at'
+        )
+        total = 0
+        try:
+            for batch in self.batches(old, *fields):
+                if archive_file:
+                    for row in batch:
+                        record = dict(zip(fields, row))
+                        record['id'] = str(record['id'])
+                        record['expiry_time'] = record['expiry_time'].isoformat()
+                        if record['activated_at']:
+                            record['activated_at'] = record['activated_at'].isoformat()
+                        archive_file.write(json.dumps(record) + "\n")
+                    archive_file.flush()
+                    os.fsync(archive_file.fileno())
+                deleted, _ = AttendanceQRCode.objects.filter(id__in=[row[0] for row in batch]).delete()
+                total += deleted
+        finally:
+            if archive_file:
+                archive_file.close()
+        return total
+
+    def delete_orphaned_files(self):
+        try:
+            _, filenames = default_storage.listdir(QR_IMAGE_DIR)
+        except FileNotFoundError:
+            return 0
+
+        referenced = set(
+            AttendanceQRCode.objects.exclude(qr_code_image='').values_list('qr_code_image', flat=True)
+        )
+        removed = 0
+        for filename in filenames:
+            name = f"{QR_IMAGE_DIR}/{filename}"
+            if name in referenced:
+                continue
+            removed += 1
+            if not self.dry_run:
+                default_storage.delete(name)
+        return removed
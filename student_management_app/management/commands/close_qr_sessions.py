@@ -0,0 +1,51 @@
+import datetime
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils.timezone import now
+
+from student_management_app.closeout import close_out_qr_code
+from student_management_app.models import AttendanceQRCode
+
+
+class Command(BaseCommand):
+    help = 'Mark students who did not check in as absent for QR codes that have expired'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=1,
+                            help='Only close QR codes that expired within this many days')
+        parser.add_argument('--qr-id', action='append', dest='qr_ids', default=[],
+                            help='Fill in absentees for these QR codes now, even if not yet expired (repeatable)')
+
+    def handle(self, *args, **options):
+        if options['qr_ids']:
+            try:
+                qr_ids = [uuid.UUID(qr_id) for qr_id in options['qr_ids']]
+            except ValueError:
+                raise CommandError(f"Invalid --qr-id in {options['qr_ids']!r}")
+            qr_codes = AttendanceQRCode.objects.filter(id__in=qr_ids)
+        else:
+            current_time = now()
+            qr_codes = AttendanceQRCode.objects.filter(
+                closed_at__isnull=True,
+                expiry_time__lt=current_time,
+                expiry_time__gte=current_time - datetime.timedelta(days=options['days'])
+            ).filter(
+                # Pre-generated codes that were never activated had no session to close
+                Q(activated_at__isnull=False) | Q(timetable_entry__isnull=True)
+            )
+
+        closed = deferred = absent = 0
+        for qr_code in qr_codes.select_related('subject').order_by('expiry_time'):
+            marked = close_out_qr_code(qr_code)
+            if marked is None:
+                deferred += 1
+                continue
+            closed += 1
+            absent += marked
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Closed {closed} QR sessions, marked {absent} students absent"
+            + (f", deferred {deferred} with another QR code still open or check-ins still buffered" if deferred else "")
+        ))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from student_management_app.write_behind import get_write_buffer
+
+
+class Command(BaseCommand):
+    help = 'Insert QR check-ins left in the write-behind spool (e.g. by a crashed worker)'
+
+    def handle(self, *args, **options):
+        flushed = get_write_buffer().flush()
+        self.stdout.write(self.style.SUCCESS(f"Flushed {flushed} buffered attendance reports"))
@@ -0,0 +1,310 @@
+import http.cookiejar
+import io
+import json
+import math
+import random
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from student_management_app.models import (
+    CustomUser, Staffs, Students, Courses, Subjects,
+    SessionYearModel, Attendance, AttendanceReport, AttendanceQRCode
+)
+from student_management_app.qr_tokens import is_compact_token
+
+ENDPOINTS = ('scan', 'redirect', 'upload', 'scan-async', 'redirect-async')
+
+SCAN_PATHS = {
+    'scan': '/student_process_qr_scan/',
+    'scan-async': '/student_process_qr_scan_async/',
+}
+REDIRECT_PATHS = {
+    'redirect': '/scan-attendance/',
+    'redirect-async': '/scan-attendance-async/',
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(pct / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[rank]
+
+
+def jitter_location(latitude, longitude, max_meters):
+    """Random point within max_meters of (latitude, longitude)."""
+    distance = max_meters * math.sqrt(random.random())
+    bearing = random.uniform(0, 2 * math.pi)
+    dlat = distance * math.cos(bearing) / 111320.0
+    dlon = distance * math.sin(bearing) / (111320.0 * math.cos(math.radians(latitude)))
+    return latitude + dlat, longitude + dlon
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Client:
+    """Minimal cookie-keeping HTTP client (one per simulated user)."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect()
+        )
+
+    def request(self, method, path, data=None, headers=None):
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers or {}, method=method)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                return response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+
+    def login(self, email, password):
+        body = urllib.parse.urlencode({'email': email, 'password': password}).encode()
+        status, _, _ = self.request('POST', '/doLogin/', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 302:
+            raise CommandError(f"Login failed for {email} (HTTP {status})")
+
+
+class Command(BaseCommand):
+    help = 'Load-test the QR check-in endpoints: seed students and a live QR code, fire concurrent scans, report latency and duplicates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='Server to test (runserver or gunicorn)')
+        parser.add_argument('--students', type=int, default=300, help='Number of students to seed and scan per endpoint')
+        parser.add_argument('--concurrency', type=int, default=50, help='Concurrent in-flight requests')
+        parser.add_argument('--endpoint', choices=ENDPOINTS + ('all',), default='scan')
+        parser.add_argument('--repeat', type=int, default=1, help='Scans per student (>1 simulates retries)')
+        parser.add_argument('--radius', type=float, default=100, help='Allowed radius of the QR code in meters')
+        parser.add_argument('--latitude', type=float, default=12.9716)
+        parser.add_argument('--longitude', type=float, default=77.5946)
+        parser.add_argument('--prefix', default='loadtest', help='Prefix for seeded usernames and names')
+        parser.add_argument('--password', default='loadtest-password')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the seeded data after the run')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible locations')
+
+    def handle(self, *args, **options):
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+
+        # Each endpoint gets its own students; reusing them would turn every later run into "already marked"
+        endpoints = ENDPOINTS if options['endpoint'] == 'all' else (options['endpoint'],)
+        staff_user, subject, session_year, students = self.seed(options, options['students'] * len(endpoints))
+        self.stdout.write(f"Seeded {len(students)} students for subject '{subject.subject_name}'")
+
+        # Generate the QR code through the real endpoint so the server warms its own caches
+        staff_client = Client(options['base_url'])
+        staff_client.login(staff_user.email, options['password'])
+        token, qr_data = self.generate_qr(staff_client, subject, session_year, options)
+        self.stdout.write(f"Live QR token: {token}")
+
+        self.stdout.write(f"Logging in {len(students)} students...")
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            clients = list(pool.map(lambda user: self.student_client(user, options), students))
+
+        for i, endpoint in enumerate(endpoints):
+            endpoint_clients = clients[i * options['students']:(i + 1) * options['students']]
+            self.run_endpoint(endpoint, endpoint_clients, token, qr_data, options)
+
+        self.report_duplicates(subject, session_year)
+
+        if options['cleanup']:
+            self.cleanup(options['prefix'])
+            self.stdout.write("Seeded data removed")
+
+    def seed(self, options, count):
+        prefix = options['prefix']
+        password_hash = make_password(options['password'])
+
+        course, _ = Courses.objects.get_or_create(course_name=f"{prefix} course")
+        session_year, _ = SessionYearModel.objects.get_or_create(
+            session_start_year='2000-01-01', session_end_year='2100-12-31'
+        )
+
+        staff_user = CustomUser.objects.filter(username=f"{prefix}_staff").first()
+        if not staff_user:
+            staff_user = CustomUser.objects.create_user(
+                username=f"{prefix}_staff", email=f"{prefix}_staff@loadtest.local",
+                password=options['password'], user_type='2'
+            )
+        staff, _ = Staffs.objects.get_or_create(admin=staff_user)
+        subject, _ = Subjects.objects.get_or_create(
+            subject_name=f"{prefix} subject", course_id=course, defaults={'staff_id': staff}
+        )
+
+        # Bulk insert users with a shared precomputed hash: hashing 300 passwords would dominate seeding
+        existing = set(CustomUser.objects.filter(username__startswith=f"{prefix}_student_").values_list('username', flat=True))
+        new_users = [
+            CustomUser(
+                username=f"{prefix}_student_{i}", email=f"{prefix}_student_{i}@loadtest.local",
+                password=password_hash, user_type='3', first_name="Load", last_name=f"Student {i}"
+            )
+            for i in range(count) if f"{prefix}_student_{i}" not in existing
+        ]
+        CustomUser.objects.bulk_create(new_users)
+
+        users = list(CustomUser.objects.filter(username__startswith=f"{prefix}_student_").order_by('id')[:count])
+        with_profile = set(Students.objects.filter(admin__in=users).values_list('admin_id', flat=True))
+        Students.objects.bulk_create([
+            Students(admin=user, course_id=course, session_year_id=session_year)
+            for user in users if user.id not in with_profile
+        ])
+        Students.objects.filter(admin__in=users).update(course_id=course, session_year_id=session_year)
+
+        return staff_user, subject, session_year, users
+
+    def generate_qr(self, staff_client, subject, session_year, options):
+        body = urllib.parse.urlencode({
+            'subject': subject.id,
+            'session_year': session_year.id,
+            'expiry_time': 30,
+            'latitude': options['latitude'],
+            'longitude': options['longitude'],
+            'radius': options['radius'],
+        }).encode()
+        status, content, _ = staff_client.request(
+            'POST', '/staff_generate_qr/', body, {'Content-Type': 'application/x-www-form-urlencoded'}
+        )
+        if status != 200:
+            raise CommandError(f"QR generation failed (HTTP {status}): {content[:200]!r}")
+
+        qr_code = AttendanceQRCode.objects.filter(subject=subject, is_active=True).order_by('-expiry_time').first()
+        if not qr_code:
+            raise CommandError("QR code was not created")
+        base_url = options['base_url'].rstrip('/')
+        if is_compact_token(qr_code.token):
+            qr_data = f"{base_url}/Q/{qr_code.token}"
+        else:
+            qr_data = f"{base_url}/scan-attendance/?token={qr_code.token}"
+        return qr_code.token, qr_data
+
+    def student_client(self, user, options):
+        client = Client(options['base_url'])
+        client.login(user.email, options['password'])
+        return client
+
+    def scan_payload(self, options):
+        latitude, longitude = jitter_location(options['latitude'], options['longitude'], options['radius'] * 0.6)
+        return latitude, longitude, round(random.uniform(5, 30), 1)
+
+    def fire(self, endpoint, client, token, qr_png, options):
+        latitude, longitude, accuracy = self.scan_payload(options)
+
+        if endpoint in SCAN_PATHS:
+            body = json.dumps({
+                'token': token, 'latitude': latitude, 'longitude': longitude,
+                'accuracy': accuracy, 'network_ssid': None
+            }).encode()
+            request = ('POST', SCAN_PATHS[endpoint], body, {'Content-Type': 'application/json'})
+        elif endpoint in REDIRECT_PATHS:
+            request = ('GET', f"{REDIRECT_PATHS[endpoint]}?token={urllib.parse.quote(token)}", None, {})
+        else:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for name, value in (('latitude', latitude), ('longitude', longitude)):
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="qr_image"; filename="qr.png"\r\n'
+                f'Content-Type: image/png\r\n\r\n'.encode() + qr_png + b'\r\n'
+            )
+            parts.append(f'--{boundary}--\r\n'.encode())
+            request = ('POST', '/student_upload_qr/', b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+        started = time.perf_counter()
+        try:
+            status, content, headers = client.request(*request)
+        except Exception as e:
+            return time.perf_counter() - started, 'exception', str(e)
+        elapsed = time.perf_counter() - started
+
+        if endpoint in REDIRECT_PATHS:
+            return elapsed, ('ok' if status == 302 else 'error'), f"HTTP {status}"
+        if status != 200:
+            return elapsed, 'error', f"HTTP {status}"
+        try:
+            result = json.loads(content)
+        except ValueError:
+            return elapsed, 'error', 'non-JSON response'
+        if result.get('status') == 'success':
+            if headers.get('Idempotent-Replayed'):
+                return elapsed, 'replayed', ''
+            return elapsed, 'ok', ''
+        if 'already marked' in result.get('message', ''):
+            return elapsed, 'duplicate', result['message']
+        return elapsed, 'error', result.get('message', '')
+
+    def run_endpoint(self, endpoint, clients, token, qr_data, options):
+        qr_png = b''
+        if endpoint == 'upload':
+            import qrcode
+            buffer = io.BytesIO()
+            qrcode.make(qr_data).save(buffer, format='PNG')
+            qr_png = buffer.getvalue()
+
+        jobs = [client for client in clients for _ in range(options['repeat'])]
+        random.shuffle(jobs)
+
+        self.stdout.write(f"\n[{endpoint}] {len(jobs)} requests, concurrency {options['concurrency']}")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            results = list(pool.map(lambda client: self.fire(endpoint, client, token, qr_png, options), jobs))
+        wall_time = time.perf_counter() - started
+
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in results)
+        outcomes = {}
+        messages = {}
+        for _, outcome, message in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome in ('error', 'exception'):
+                messages[message] = messages.get(message, 0) + 1
+
+        total = len(results)
+        failed = outcomes.get('error', 0) + outcomes.get('exception', 0)
+        self.stdout.write(f"  throughput : {total / wall_time:.1f} req/s over {wall_time:.2f}s")
+        self.stdout.write(
+            f"  latency ms : p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  "
+            f"p99 {percentile(latencies, 99):.1f}  max {latencies[-1] if latencies else 0:.1f}"
+        )
+        self.stdout.write(
+            f"  outcomes   : ok {outcomes.get('ok', 0)}  replayed {outcomes.get('replayed', 0)}  "
+            f"already-marked {outcomes.get('duplicate', 0)}  "
+            f"errors {failed} ({failed / total * 100 if total else 0:.1f}%)"
+        )
+        for message, count in sorted(messages.items(), key=lambda item: -item[1])[:5]:
+            self.stdout.write(f"    {count} x {message[:100]}")
+
+    def report_duplicates(self, subject, session_year):
+        duplicate_attendance = (
+            Attendance.objects.filter(subject_id=subject, session_year_id=session_year)
+            .values('attendance_date').annotate(rows=Count('id')).filter(rows__gt=1).count()
+        )
+        duplicate_reports = (
+            AttendanceReport.objects.filter(attendance_id__subject_id=subject)
+            .values('attendance_id', 'student_id').annotate(rows=Count('id')).filter(rows__gt=1).count()
+        )
+        present = AttendanceReport.objects.filter(attendance_id__subject_id=subject, status=True).count()
+        self.stdout.write(
+            f"\nDatabase: {present} present reports, {duplicate_attendance} duplicated Attendance days, "
+            f"{duplicate_reports} duplicated student reports"
+        )
+
+    def cleanup(self, prefix):
+        subjects = Subjects.objects.filter(subject_name=f"{prefix} subject")
+        AttendanceReport.objects.filter(attendance_id__subject_id__in=subjects).delete()
+        Attendance.objects.filter(subject_id__in=subjects).delete()
+        AttendanceQRCode.objects.filter(subject__in=subjects).delete()
+        subjects.delete()
+        CustomUser.objects.filter(username__startswith=f"{prefix}_").delete()
+        Courses.objects.filter(course_name=f"{prefix} course").delete()
@@ -0,0 +1,120 @@
+import datetime
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.timezone import localdate, make_aware, now
+
+from student_management_app.models import AttendanceQRCode, TimetableEntry
+from student_management_app.qr_render import render_qr, scan_url_prefix
+from student_management_app.qr_tokens import make_qr_token
+
+QR_IMAGE_DIR = 'qr_codes'
+
+
+class Command(BaseCommand):
+    help = "Pre-generate inactive QR codes for a day's timetable so teachers only have to activate them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Day to generate QR codes for (YYYY-MM-DD, default today)')
+        parser.add_argument('--base-url', default=settings.QR_SCAN_BASE_URL,
+                            help='Site URL the QR codes point at, e.g. https://attendance.example.com')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes used to render the QR images')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per INSERT statement')
+
+    def handle(self, *args, **options):
+        if not options['base_url']:
+            raise CommandError("Set --base-url or QR_SCAN_BASE_URL to the site URL students scan")
+        try:
+            day = datetime.date.fromisoformat(options['date']) if options['date'] else localdate()
+        except ValueError:
+            raise CommandError(f"Invalid --date {options['date']!r}, expected YYYY-MM-DD")
+
+        qr_codes = self.plan(day)
+        if not qr_codes:
+            self.stdout.write(f"No QR codes to generate for {day:%A %Y-%m-%d}")
+            return
+
+        with transaction.atomic():
+            AttendanceQRCode.objects.bulk_create(qr_codes, batch_size=options['batch_size'])
+
+        # Rotating codes are drawn frame by frame on the teacher's page, so only static ones get an image.
+        # Without QR_STORE_IMAGE, staff_activate_qr renders the image when the code is switched on.
+        static = [qr_code for qr_code in qr_codes if not qr_code.rotation_seconds]
+        if settings.QR_STORE_IMAGE and static:
+            self.store_images(static, options['base_url'], options['workers'], options['batch_size'])
+            rendered = f"{len(static)} images rendered"
+        else:
+            rendered = "images rendered on activation"
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Pre-generated {len(qr_codes)} QR codes for {day:%A %Y-%m-%d} ({rendered})"
+        ))
+
+    def store_images(self, qr_codes, base_url, workers, batch_size):
+        """Render and save the images of inserted QR codes. Files are only written once the rows exist."""
+        url_prefix = scan_url_prefix(base_url, settings.QR_COMPACT_TOKENS)
+        image_format = settings.QR_RENDER_FORMAT
+        images = self.render([f"{url_prefix}{qr_code.token}" for qr_code in qr_codes], image_format, workers)
+
+        for qr_code, (image, _) in zip(qr_codes, images):
+            qr_code.qr_code_image = default_storage.save(
+                f"{QR_IMAGE_DIR}/qr_{qr_code.id}.{image_format}", ContentFile(image)
+            )
+        AttendanceQRCode.objects.bulk_update(qr_codes, ['qr_code_image'], batch_size=batch_size)
+
+    def plan(self, day):
+        """Unsaved, inactive QR codes for the day's timetable entries that do not have one yet."""
+        entries = TimetableEntry.objects.filter(is_active=True, weekday=day.weekday())
+        compact = settings.QR_COMPACT_TOKENS
+        current_time = now()
+
+        planned = []
+        for entry in entries:
+            start = make_aware(datetime.datetime.combine(day, entry.start_time))
+            expiry_time = start + datetime.timedelta(minutes=entry.attendance_minutes)
+            if expiry_time > current_time:
+                planned.append((entry, expiry_time))
+
+        # Running the command twice for the same day must not duplicate codes
+        existing = set(AttendanceQRCode.objects.filter(
+            timetable_entry__in=[entry for entry, _ in planned],
+            expiry_time__in=[expiry_time for _, expiry_time in planned]
+        ).values_list('timetable_entry_id', 'expiry_time'))
+
+        qr_codes = []
+        for entry, expiry_time in planned:
+            if (entry.id, expiry_time) in existing:
+                continue
+            qr_id = uuid.uuid4()
+            qr_codes.append(AttendanceQRCode(
+                id=qr_id,
+                subject_id=entry.subject_id,
+                session_year_id=entry.session_year_id,
+                expiry_time=expiry_time,
+                is_active=False,
+                token=make_qr_token(qr_id, entry.subject_id, entry.session_year_id, expiry_time, compact=compact),
+                teacher_latitude=entry.latitude,
+                teacher_longitude=entry.longitude,
+                allowed_radius=entry.allowed_radius,
+                geofence_id=entry.geofence_id,
+                rotation_seconds=entry.rotation_seconds,
+                timetable_entry=entry
+            ))
+        return qr_codes
+
+    def render(self, payloads, image_format, workers):
+        """Render QR images across worker processes, in the order of payloads."""
+        if workers <= 1 or len(payloads) <= 1:
+            return [render_qr(payload, image_format) for payload in payloads]
+
+        chunksize = max(len(payloads) // (workers * 4), 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(render_qr, payloads, repeat(image_format), chunksize=chunksize))
@@ -0,0 +1,230 @@
+import datetime
+import time
+from collections import defaultdict
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils.timezone import localdate, now
+
+from student_management_app.models import AttendanceQRCode, AttendanceReport
+from student_management_app.utils import distance_array, within_radius_arrays
+
+
+class Command(BaseCommand):
+    help = ("Re-run the location check for past QR check-ins (e.g. after fixing a room's coordinates "
+            "or radius) in one vectorized pass, and update location_verified and verification_details")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', required=True, help='First attendance date (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='date_to', help='Last attendance date (YYYY-MM-DD, default today)')
+        parser.add_argument('--subject', type=int, help='Only this subject id')
+        parser.add_argument('--latitude', type=float, help='Use this teacher latitude instead of the QR codes\' (needs --subject)')
+        parser.add_argument('--longitude', type=float, help='Use this teacher longitude instead of the QR codes\' (needs --subject)')
+        parser.add_argument('--radius', type=float, help='Use this allowed radius in meters instead of the QR codes\'')
+        parser.add_argument('--kernel', help='Distance kernel (default: QR_DISTANCE_KERNEL)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per executemany call')
+        parser.add_argument('--dry-run', action='store_true', help='Report the changes without saving them')
+
+    def handle(self, *args, **options):
+        try:
+            date_from = datetime.date.fromisoformat(options['date_from'])
+            date_to = datetime.date.fromisoformat(options['date_to']) if options['date_to'] else localdate()
+        except ValueError:
+            raise CommandError("Dates must be YYYY-MM-DD")
+        if (options['latitude'] is None) != (options['longitude'] is None):
+            raise CommandError("--latitude and --longitude go together")
+        if options['latitude'] is not None and not options['subject']:
+            raise CommandError("Overriding the teacher's location needs --subject")
+
+        started = time.perf_counter()
+        reports = self.load_reports(date_from, date_to, options['subject'])
+        if not len(reports['id']):
+            self.stdout.write("No QR check-ins with a student location in that range")
+            return
+
+        teacher_lat, teacher_lon, radius, purged = self.reference_locations(reports, date_from, date_to, options)
+        has_reference = ~np.isnan(teacher_lat) & ~np.isnan(teacher_lon)
+        loaded = time.perf_counter()
+
+        distance = distance_array(
+            reports['latitude'][has_reference], reports['longitude'][has_reference],
+            teacher_lat[has_reference], teacher_lon[has_reference], options['kernel']
+        )
+        checked = within_radius_arrays(distance, radius[has_reference], reports['accuracy'][has_reference])
+        computed = time.perf_counter()
+
+        updates, newly_failed, newly_passed = self.build_updates(
+            reports, np.flatnonzero(has_reference), distance, radius[has_reference], checked
+        )
+        if not options['dry_run'] and updates:
+            self.save(updates, options['batch_size'])
+        finished = time.perf_counter()
+
+        prefix = "[dry run] " if options['dry_run'] else ""
+        self.stdout.write(
+            f"Loaded {len(reports['id'])} check-ins in {loaded - started:.2f}s, "
+            f"checked {int(has_reference.sum())} in {computed - loaded:.3f}s, "
+            f"saved in {finished - computed:.2f}s"
+        )
+        purged_reports = sum(purged.values())
+        if purged:
+            self.stdout.write(
+                f"Skipped {len(purged)} class sessions ({purged_reports} check-ins) whose QR codes were "
+                "already purged (see QR_CODE_RETENTION_DAYS)"
+            )
+        other_skipped = int((~has_reference).sum()) - purged_reports
+        if other_skipped:
+            self.stdout.write(
+                f"Skipped {other_skipped} check-ins without a teacher location (none set, or a classroom geofence)"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}Updated {len(updates)} reports: {newly_failed} now outside the radius, {newly_passed} now inside"
+        ))
+
+    def load_reports(self, date_from, date_to, subject_id):
+        """Present QR check-ins that carry a student location, as column arrays."""
+        reports = AttendanceReport.objects.filter(
+            status=True,
+            student_latitude__isnull=False,
+            student_longitude__isnull=False,
+            attendance_id__attendance_date__range=(date_from, date_to)
+        )
+        if subject_id:
+            reports = reports.filter(attendance_id__subject_id=subject_id)
+
+        rows = list(reports.order_by('id').values_list(
+            'id', 'student_latitude', 'student_longitude', 'student_accuracy', 'location_verified',
+            'verification_details', 'created_at', 'attendance_id__subject_id', 'attendance_id__session_year_id',
+            'attendance_id__attendance_date'
+        ))
+        columns = list(zip(*rows)) or [()] * 10
+        return {
+            'id': np.array(columns[0], dtype=np.int64),
+            'latitude': np.array(columns[1], dtype=float),
+            'longitude': np.array(columns[2], dtype=float),
+            # None (no accuracy sent) becomes NaN
+            'accuracy': np.array(columns[3], dtype=float),
+            'location_verified': np.array(columns[4], dtype=bool),
+            'verification_details': columns[5],
+            'created_at': np.array([created.timestamp() for created in columns[6]], dtype=float),
+            'class_day': list(zip(columns[7], columns[8], columns[9])),
+        }
+
+    def reference_locations(self, reports, date_from, date_to, options):
+        """
+        Teacher latitude, longitude and allowed radius per report, NaN where
+        unknown, and the number of reports per class session (subject, session
+        year, day) that has no QR code left.
+
+        A report belongs to the QR code of its class and day that expired first
+        after the check-in (the last one of the day for later check-ins).
+        Reports from QR codes with a classroom geofence were checked against
+        the room's outline, not a radius, so they are left as they are.
+        """
+        count = len(reports['id'])
+        teacher_lat = np.full(count, np.nan)
+        teacher_lon = np.full(count, np.nan)
+        radius = np.full(count, np.nan)
+        fenced = np.zeros(count, dtype=bool)
+        purged = {}
+
+        if options['latitude'] is not None:
+            teacher_lat[:] = options['latitude']
+            teacher_lon[:] = options['longitude']
+            radius[:] = options['radius'] if options['radius'] is not None else np.nan
+
+        need_codes = options['latitude'] is None or options['radius'] is None
+        if need_codes:
+            codes = defaultdict(list)
+            qr_codes = AttendanceQRCode.objects.filter(
+                expiry_time__date__range=(date_from, date_to + datetime.timedelta(days=1))
+            )
+            if options['subject']:
+                qr_codes = qr_codes.filter(subject_id=options['subject'])
+            rows = qr_codes.order_by('expiry_time').values_list(
+                'subject_id', 'session_year_id', 'expiry_time', 'activated_at', 'teacher_latitude',
+                'teacher_longitude', 'allowed_radius', 'geofence_id'
+            )
+            for subject_id, session_year_id, expiry_time, activated_at, lat, lon, allowed_radius, geofence_id in rows:
+                # Same day as the check-ins were recorded under (qr_attendance_date)
+                codes[(subject_id, session_year_id, localdate(activated_at or expiry_time))].append((
+                    expiry_time.timestamp(),
+                    np.nan if lat is None else lat,
+                    np.nan if lon is None else lon,
+                    allowed_radius,
+                    geofence_id is not None
+                ))
+
+            rows_by_class_day = defaultdict(list)
+            for index, class_day in enumerate(reports['class_day']):
+                rows_by_class_day[class_day].append(index)
+
+            for class_day, indexes in rows_by_class_day.items():
+                day_codes = codes.get(class_day)
+                if not day_codes:
+                    purged[class_day] = len(indexes)
+                    continue
+                indexes = np.array(indexes)
+                expiries, lats, lons, radii, geofenced = (np.array(column, dtype=float) for column in zip(*day_codes))
+                chosen = np.minimum(np.searchsorted(expiries, reports['created_at'][indexes]), len(expiries) - 1)
+                fenced[indexes] = geofenced[chosen].astype(bool)
+                if options['latitude'] is None:
+                    teacher_lat[indexes] = lats[chosen]
+                    teacher_lon[indexes] = lons[chosen]
+                if options['radius'] is None:
+                    radius[indexes] = radii[chosen]
+
+        if options['radius'] is not None:
+            radius[:] = options['radius']
+        # A known location with an unknown radius cannot be checked either
+        teacher_lat[np.isnan(radius) | fenced] = np.nan
+        return teacher_lat, teacher_lon, radius, purged
+
+    def build_updates(self, reports, indexes, distance, radius, checked):
+        """(id, location_verified, verification_details, updated_at) for rows whose result or details changed."""
+        updated_at = now()
+        updates = []
+        newly_failed = newly_passed = 0
+        for position, index in enumerate(indexes):
+            is_within = bool(checked['is_within'][position])
+            details = dict(reports['verification_details'][index] or {})
+            location_details = {
+                'distance': round(float(distance[position]), 2),
+                'allowed_radius': round(float(radius[position]), 2),
+                'effective_radius': round(float(checked['effective_radius'][position]), 2),
+                'error_margin': round(float(checked['error_margin'][position]), 2),
+                'is_reliable': bool(checked['is_reliable'][position]),
+            }
+            was_within = bool(reports['location_verified'][index])
+            if was_within == is_within and all(details.get(key) == value for key, value in location_details.items()):
+                continue
+
+            if was_within and not is_within:
+                newly_failed += 1
+            elif is_within and not was_within:
+                newly_passed += 1
+            details.update(location_details, reverified_at=updated_at.isoformat())
+            updates.append((int(reports['id'][index]), is_within, details, updated_at))
+        return updates, newly_failed, newly_passed
+
+    def save(self, updates, batch_size):
+        """
+        Write (id, location_verified, verification_details, updated_at) rows with
+        one parameterized UPDATE run through executemany. bulk_update's CASE
+        expressions cost far more per row for a semester of reports.
+        """
+        meta = AttendanceReport._meta
+        quote = connection.ops.quote_name
+        fields = [meta.get_field(name) for name in ('location_verified', 'verification_details', 'updated_at')]
+        sql = (
+            f"UPDATE {quote(meta.db_table)} SET "
+            + ", ".join(f"{quote(field.column)} = %s" for field in fields)
+            + f" WHERE {quote(meta.pk.column)} = %s"
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(updates), batch_size):
+                cursor.executemany(sql, [
+                    [field.get_db_prep_save(value, connection) for field, value in zip(fields, values)] + [report_id]
+                    for report_id, *values in updates[start:start + batch_size]
+                ])
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:14
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_attendance(apps, schema_editor):
+    """
+    Merge duplicate Attendance rows (same subject, session year and date) created
+    by concurrent check-ins into the oldest row before the unique constraint is added.
+    """
+    Attendance = apps.get_model('student_management_app', 'Attendance')
+    AttendanceReport = apps.get_model('student_management_app', 'AttendanceReport')
+
+    duplicates = (
+        Attendance.objects
+        .values('subject_id', 'session_year_id', 'attendance_date')
+        .annotate(keep_id=Min('id'), row_count=Count('id'))
+        .filter(row_count__gt=1)
+    )
+
+    for group in duplicates:
+        keep_id = group['keep_id']
+        extra_ids = list(
+            Attendance.objects.filter(
+                subject_id=group['subject_id'],
+                session_year_id=group['session_year_id'],
+                attendance_date=group['attendance_date'],
+            ).exclude(id=keep_id).values_list('id', flat=True)
+        )
+
+        # Move reports to the kept row, dropping those for students already recorded there
+        kept_students = set(
+            AttendanceReport.objects.filter(attendance_id=keep_id).values_list('student_id', flat=True)
+        )
+        for report in AttendanceReport.objects.filter(attendance_id__in=extra_ids).order_by('id'):
+            if report.student_id_id in kept_students:
+                report.delete()
+            else:
+                report.attendance_id_id = keep_id
+                report.save(update_fields=['attendance_id'])
+                kept_students.add(report.student_id_id)
+
+        Attendance.objects.filter(id__in=extra_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('student_management_app', '0002_alter_attendancereport_unique_together'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_attendance, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='attendance',
+            unique_together={('subject_id', 'session_year_id', 'attendance_date')},
+        ),
+    ]
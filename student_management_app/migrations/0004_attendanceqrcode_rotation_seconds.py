@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('student_management_app', '0003_attendance_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendanceqrcode',
+            name='rotation_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
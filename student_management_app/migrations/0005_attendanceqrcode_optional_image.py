@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('student_management_app', '0004_attendanceqrcode_rotation_seconds'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attendanceqrcode',
+            name='qr_code_image',
+            field=models.ImageField(blank=True, upload_to='qr_codes/'),
+        ),
+    ]
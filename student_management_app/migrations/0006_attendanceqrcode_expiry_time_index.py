@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-17 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('student_management_app', '0005_attendanceqrcode_optional_image'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attendanceqrcode',
+            name='expiry_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-17 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('student_management_app', '0007_timetable_pregenerated_qr_codes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendanceqrcode',
+            name='closed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
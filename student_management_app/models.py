@@ -1,4 +1,5 @@
 import uuid
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.timezone import now
 from django.contrib.auth.models import AbstractUser
@@ -85,6 +86,11 @@ class Attendance(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     objects = models.Manager()
 
+    class Meta:
+        # One attendance session per subject, session year and day, so concurrent
+        # QR check-ins can never create duplicate rows
+        unique_together = ('subject_id', 'session_year_id', 'attendance_date')
+
     def __str__(self):
         return f"{self.subject_id.subject_name} - {self.attendance_date.strftime('%B %d, %Y')}"
 
@@ -98,18 +104,98 @@ class Attendance(models.Model):
         """Return a short formatted date"""
         return self.attendance_date.strftime("%m/%d/%Y")
 
+# ✅ Geofence Model (classroom and building outlines)
+class Geofence(models.Model):
+    """A classroom or building outline that QR sessions check students against (see geofences.py)."""
+    SHAPE_CHOICES = (
+        ("circle", "Circle"),
+        ("polygon", "Polygon"),
+    )
+    id = models.AutoField(primary_key=True)
+    name = models.CharField(max_length=255)
+    building = models.CharField(max_length=255, blank=True)
+    shape = models.CharField(max_length=10, choices=SHAPE_CHOICES, default="circle")
+    center_latitude = models.FloatField(null=True, blank=True)  # Circles; filled with the vertex mean for polygons
+    center_longitude = models.FloatField(null=True, blank=True)
+    radius = models.FloatField(null=True, blank=True)  # Circles, in meters
+    polygon = models.JSONField(null=True, blank=True)  # Polygons: [[latitude, longitude], ...] vertices in order
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['building', 'name']
+
+    def clean(self):
+        if self.shape == "circle":
+            if self.center_latitude is None or self.center_longitude is None or not self.radius:
+                raise ValidationError("A circle needs a center and a radius.")
+        else:
+            try:
+                vertices = [(float(lat), float(lon)) for lat, lon in self.polygon or []]
+            except (TypeError, ValueError):
+                raise ValidationError("Polygon vertices must be [latitude, longitude] pairs.")
+            if len(vertices) < 3:
+                raise ValidationError("A polygon needs at least three vertices.")
+
+    def save(self, *args, **kwargs):
+        if self.shape == "polygon" and self.polygon:
+            self.center_latitude = sum(float(lat) for lat, _ in self.polygon) / len(self.polygon)
+            self.center_longitude = sum(float(lon) for _, lon in self.polygon) / len(self.polygon)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.building} - {self.name}" if self.building else self.name
+
+# ✅ Timetable Model (read by pregenerate_qr_codes)
+class TimetableEntry(models.Model):
+    WEEKDAY_CHOICES = (
+        (0, "Monday"), (1, "Tuesday"), (2, "Wednesday"), (3, "Thursday"),
+        (4, "Friday"), (5, "Saturday"), (6, "Sunday"),
+    )
+    id = models.AutoField(primary_key=True)
+    subject = models.ForeignKey(Subjects, on_delete=models.CASCADE)
+    session_year = models.ForeignKey(SessionYearModel, on_delete=models.CASCADE)
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAY_CHOICES)
+    start_time = models.TimeField()
+    attendance_minutes = models.PositiveIntegerField(default=30)  # How long the QR code stays valid after start_time
+    allowed_radius = models.FloatField(default=100)  # Radius in meters
+    latitude = models.FloatField(null=True, blank=True)  # Classroom location, replaced by the teacher's on activation
+    longitude = models.FloatField(null=True, blank=True)
+    rotation_seconds = models.PositiveIntegerField(default=0)
+    geofence = models.ForeignKey(Geofence, on_delete=models.SET_NULL, null=True, blank=True)  # Copied to the QR codes
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['weekday', 'start_time']
+
+    def __str__(self):
+        return f"{self.subject.subject_name} - {self.get_weekday_display()} {self.start_time:%H:%M}"
+
 # ✅ Attendance QR Code Model
 class AttendanceQRCode(models.Model):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True, editable=False)
     subject = models.ForeignKey(Subjects, on_delete=models.CASCADE)
     session_year = models.ForeignKey(SessionYearModel, on_delete=models.CASCADE, default=1)  # ✅ Added default
-    qr_code_image = models.ImageField(upload_to="qr_codes/")
-    expiry_time = models.DateTimeField()
+    qr_code_image = models.ImageField(upload_to="qr_codes/", blank=True)  # Optional, see settings.QR_STORE_IMAGE
+    expiry_time = models.DateTimeField(db_index=True)  # Indexed for cleanup_qr_codes
     is_active = models.BooleanField(default=True)
     token = models.CharField(max_length=50, unique=True)  # Unique Token for Attendance
     teacher_latitude = models.FloatField(null=True, blank=True)
     teacher_longitude = models.FloatField(null=True, blank=True)
     allowed_radius = models.FloatField(default=100)  # Radius in meters
+    rotation_seconds = models.PositiveIntegerField(default=0)  # Rotating frame interval, 0 = static QR code
+    # Pre-generated codes are created inactive and switched on by the teacher (staff_activate_qr)
+    timetable_entry = models.ForeignKey(TimetableEntry, on_delete=models.SET_NULL, null=True, blank=True)
+    activated_at = models.DateTimeField(null=True, blank=True)
+    # Set once absentees have been filled in (see closeout.py)
+    closed_at = models.DateTimeField(null=True, blank=True)
+    # Students are checked against this outline instead of the radius around the teacher
+    geofence = models.ForeignKey(Geofence, on_delete=models.SET_NULL, null=True, blank=True)
     # Network verification is handled via cache to avoid database changes
 
 # ✅ Attendance Report Model
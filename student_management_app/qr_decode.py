@@ -0,0 +1,287 @@
+"""
+In-memory QR decoding for student_upload_qr.
+
+Uploads are decoded straight from the request buffer, without a temporary
+file. A phone photo is often 12MP while the QR code in it needs only a few
+hundred pixels, so the image is first decoded downscaled (JPEGs through PIL's
+draft mode, which skips most of the full-size decode), then at a larger size,
+then as progressively larger centre crops of the full-resolution image and
+finally as a whole. Decoding stops at the first attempt that yields data.
+
+Every stage is timed; the view reports the timings in a Server-Timing header
+(together with the check-in stages, see checkin_pipeline) so slow uploads can
+be traced in the browser's network panel.
+
+Decoding is CPU-heavy, so decode_qr_upload runs it in a small process pool
+(settings.QR_DECODE_WORKERS per web worker process). At most
+QR_DECODE_MAX_IN_FLIGHT jobs may be running or queued across all web workers,
+counted in the shared cache; beyond that, or when a job exceeds
+QR_DECODE_TIMEOUT, DecoderBusy is raised and the view answers 503 with
+Retry-After instead of holding the request while uploads pile up.
+"""
+import concurrent.futures
+import io
+import multiprocessing
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from PIL import Image
+
+# OpenCV and pyzbar are optional for deployment
+try:
+    import cv2
+    OPENCV_AVAILABLE = True
+except ImportError:
+    OPENCV_AVAILABLE = False
+    print("OpenCV not available - QR scanning will use alternative methods")
+
+try:
+    from pyzbar.pyzbar import ZBarSymbol, decode as pyzbar_decode
+    PYZBAR_AVAILABLE = True
+except ImportError:
+    PYZBAR_AVAILABLE = False
+
+# Defaults for settings.QR_DECODE_BACKENDS / QR_DECODE_DOWNSCALE_SIDES (see benchmark_qr_decode)
+DEFAULT_BACKENDS = ('pyzbar', 'opencv')
+DEFAULT_DOWNSCALE_SIDES = (800, 1600)  # Longest side in pixels of the first attempts
+CROP_FRACTIONS = (0.5, 0.75)  # Centre crops of the full-resolution image, smallest first
+DECODE_RETRY_AFTER = 3  # Seconds, sent with the 503 when the pool is busy
+DECODE_BUSY_MESSAGE = "The server is busy reading other QR images. Please try again in a few seconds."
+DECODE_TIMEOUT_MESSAGE = "Reading the QR image took too long. Please try again with a closer, sharper photo."
+POOL_MAX_TASKS_PER_CHILD = 100  # Recycle decode processes to return memory from large images
+# The in-flight counter expires this long after a busy spell starts, so a slot leaked by a
+# killed web worker is not lost for good
+IN_FLIGHT_COUNTER_TIMEOUT = 60
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class DecoderBusy(Exception):
+    """The decode pool is saturated or the job timed out; the client should retry."""
+
+
+def _decode_pyzbar(image):
+    results = pyzbar_decode(image, symbols=[ZBarSymbol.QRCODE])
+    return results[0].data.decode('utf-8') if results else None
+
+
+def _decode_opencv(image):
+    data, _, _ = cv2.QRCodeDetector().detectAndDecode(np.asarray(image))
+    return data or None
+
+
+DECODERS = {
+    'pyzbar': _decode_pyzbar,
+    'opencv': _decode_opencv,
+}
+INSTALLED_BACKENDS = {'pyzbar': PYZBAR_AVAILABLE, 'opencv': OPENCV_AVAILABLE}
+
+
+def available_decoders(backends=DEFAULT_BACKENDS):
+    """(name, function) pairs for the installed decoders among backends, in that order."""
+    return [(name, DECODERS[name]) for name in backends if INSTALLED_BACKENDS.get(name)]
+
+
+def _timed(timings, stage, func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings.append((stage, (time.perf_counter() - started) * 1000))
+
+
+def _load(data, max_side=None):
+    """Grayscale image from bytes, no larger than max_side on its longest side."""
+    image = Image.open(io.BytesIO(data))
+    if max_side:
+        # Lets the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding
+        image.draft('L', (max_side, max_side))
+    image = image.convert('L')
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side))
+    return image
+
+
+def _centre_crop(image, fraction):
+    width, height = image.size
+    crop_width, crop_height = int(width * fraction), int(height * fraction)
+    left, top = (width - crop_width) // 2, (height - crop_height) // 2
+    return image.crop((left, top, left + crop_width, top + crop_height))
+
+
+def _try_decoders(timings, label, image, decoders, deadline=None):
+    for name, decoder in decoders:
+        if deadline and time.time() > deadline:
+            return None
+        data = _timed(timings, f"{label}-{name}", decoder, image)
+        if data:
+            return data
+    return None
+
+
+def decode_qr_image(data, deadline=None, backends=DEFAULT_BACKENDS, downscale_sides=DEFAULT_DOWNSCALE_SIDES):
+    """
+    Decode the first QR code found in image bytes.
+
+    Parameters:
+    - data: Image file contents
+    - deadline: time.time() after which no further attempt is started
+    - backends: Decoder names in the order they are tried
+    - downscale_sides: Longest sides of the downscaled attempts, smallest first
+
+    Returns:
+    - tuple: (decoded text or None, list of (stage, milliseconds))
+    """
+    timings = []
+    decoders = available_decoders(backends)
+    if not decoders:
+        return None, timings
+
+    try:
+        tried_side = 0
+        for side in downscale_sides:
+            image = _timed(timings, f"load-{side}", _load, data, side)
+            result = _try_decoders(timings, f"scale-{side}", image, decoders, deadline)
+            if result:
+                return result, timings
+            tried_side = max(image.size)
+            if tried_side < side:
+                # The image is smaller than this size, so it was already tried at full resolution
+                return None, timings
+
+        full = _timed(timings, "load-full", _load, data)
+        for fraction in CROP_FRACTIONS:
+            crop = _centre_crop(full, fraction)
+            result = _try_decoders(timings, f"crop-{int(fraction * 100)}", crop, decoders, deadline)
+            if result:
+                return result, timings
+
+        if max(full.size) > tried_side:
+            return _try_decoders(timings, "full", full, decoders, deadline), timings
+        return None, timings
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"QR image decode error: {e}")
+        return None, timings
+
+
+def qr_decode_in_flight_cache_key():
+    return "qr_decode_in_flight"
+
+
+def _acquire_slot():
+    """Count one more decode job across all web workers; False if the limit is reached."""
+    key = qr_decode_in_flight_cache_key()
+    if cache.add(key, 1, timeout=IN_FLIGHT_COUNTER_TIMEOUT):
+        in_flight = 1
+    else:
+        try:
+            in_flight = cache.incr(key)
+        except ValueError:
+            # Expired between the add and the incr
+            cache.set(key, 1, timeout=IN_FLIGHT_COUNTER_TIMEOUT)
+            in_flight = 1
+    if in_flight > settings.QR_DECODE_MAX_IN_FLIGHT:
+        _release_slot()
+        return False
+    return True
+
+
+def _release_slot():
+    try:
+        in_flight = cache.decr(qr_decode_in_flight_cache_key())
+    except ValueError:
+        # The counter expired while the job ran
+        return
+    if in_flight < 0:
+        # Jobs from before an expiry finishing after it; don't let them raise the limit
+        cache.incr(qr_decode_in_flight_cache_key(), -in_flight)
+
+
+def _get_pool():
+    """The process pool, created on first use in each web worker process."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a threaded web worker is not safe
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=settings.QR_DECODE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                max_tasks_per_child=POOL_MAX_TASKS_PER_CHILD
+            )
+        return _pool
+
+
+def _reset_pool(broken):
+    """Drop a pool whose worker died so the next upload starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _check_deadline(result, deadline):
+    """A decode that found nothing because it ran out of time is a timeout, not an unreadable image."""
+    if result[0] is None and time.time() > deadline:
+        raise DecoderBusy(DECODE_TIMEOUT_MESSAGE)
+    return result
+
+
+def decode_qr_upload(data):
+    """
+    Decode uploaded image bytes in the decode pool (inline if QR_DECODE_WORKERS is 0).
+
+    Returns:
+    - tuple: (decoded text or None, list of (stage, milliseconds))
+
+    Raises:
+    - DecoderBusy: QR_DECODE_MAX_IN_FLIGHT jobs are already running or queued
+      on any web worker, or the job took longer than QR_DECODE_TIMEOUT seconds
+    """
+    timeout = settings.QR_DECODE_TIMEOUT
+    deadline = time.time() + timeout
+    # Passed explicitly: the pool's processes do not load Django settings
+    options = {
+        'backends': tuple(getattr(settings, 'QR_DECODE_BACKENDS', DEFAULT_BACKENDS)),
+        'downscale_sides': tuple(getattr(settings, 'QR_DECODE_DOWNSCALE_SIDES', DEFAULT_DOWNSCALE_SIDES)),
+    }
+    if not settings.QR_DECODE_WORKERS:
+        return _check_deadline(decode_qr_image(data, deadline, **options), deadline)
+
+    if not _acquire_slot():
+        raise DecoderBusy(DECODE_BUSY_MESSAGE)
+
+    pool = _get_pool()
+    started = time.perf_counter()
+    try:
+        future = pool.submit(decode_qr_image, data, deadline, **options)
+    except (BrokenProcessPool, RuntimeError):
+        _release_slot()
+        _reset_pool(pool)
+        raise DecoderBusy("QR image reader is restarting. Please try again in a few seconds.")
+    # The slot is only freed when the job really finishes, even if the request stops waiting
+    future.add_done_callback(lambda _: _release_slot())
+
+    try:
+        token, timings = future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        raise DecoderBusy(DECODE_TIMEOUT_MESSAGE)
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        raise DecoderBusy("QR image reader is restarting. Please try again in a few seconds.")
+
+    # Queueing and transfer to the worker process, i.e. everything outside the decode stages
+    elapsed = (time.perf_counter() - started) * 1000
+    timings.insert(0, ('pool', max(elapsed - sum(ms for _, ms in timings), 0)))
+    return _check_deadline((token, timings), deadline)
+
+
+def server_timing(timings):
+    """Server-Timing header value for (stage, milliseconds) timings."""
+    return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in timings)
+
@@ -0,0 +1,225 @@
+"""
+Live check-in feed for the teacher's QR screen.
+
+Every successful check-in is appended to a per-token event log in the cache:
+a sequence number incremented with cache.incr and one entry per event. The
+teacher's page holds a single server-sent events connection that follows the
+log, so new check-ins (student name, distance and verification flags) and the
+present/total counter are pushed without polling get_attendance_student. A
+'stats' event with the session's running distance statistics (see
+distance_stats.py) follows the summary and every batch of new check-ins.
+
+The present counter is the number of students already marked when the QR code
+was generated (the baseline) plus the sequence number: check_in only reports a
+check-in once per student, so every event is a new student.
+
+The log, the sequence and the baseline are only shared between workers when
+the cache is (Redis via REDIS_URL); settings_production refuses to start
+several workers without it, since a teacher's feed would otherwise show only
+the scans that reached its own worker.
+
+Production (render.yaml, Procfile.asgi) runs uvicorn workers, where the feed
+is astream_checkin_events and an open connection only costs a sleeping
+coroutine. stream_checkin_events is the fallback for WSGI servers (runserver,
+the sync Procfile): there each open connection holds a worker until it ends,
+after settings.QR_EVENT_STREAM_MAX_DURATION seconds, and the browser
+reconnects with Last-Event-ID.
+"""
+import asyncio
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .distance_stats import get_distance_stats, aget_distance_stats
+from .qr_session import session_timeout
+
+# Keep the log around briefly after expiry so a reconnecting page can catch up
+EVENT_GRACE_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+
+
+def qr_events_seq_cache_key(token):
+    return f"qr_events_seq_{token}"
+
+
+def qr_event_cache_key(token, seq):
+    return f"qr_event_{token}_{seq}"
+
+
+def qr_events_baseline_cache_key(token):
+    return f"qr_events_baseline_{token}"
+
+
+def _event_timeout(qr_session):
+    return session_timeout(qr_session) + EVENT_GRACE_SECONDS
+
+
+def set_event_baseline(qr_session, present):
+    """Record how many students were already marked when the QR code was generated."""
+    cache.set(qr_events_baseline_cache_key(qr_session['token']), present, timeout=_event_timeout(qr_session))
+
+
+def build_checkin_event(student_id, report_fields):
+    details = report_fields.get('verification_details') or {}
+    return {
+        'student_id': student_id,
+        'distance': details.get('distance'),
+        'geofence': details.get('geofence'),
+        'location_verified': bool(report_fields.get('location_verified')),
+        'network_verified': details.get('network_verified'),
+        'shared_image_uploads': details.get('shared_image_uploads'),
+        'anomalies': (details.get('anomalies') or {}).get('flags'),
+        'time': time.time(),
+    }
+
+
+def publish_checkin(qr_session, student_id, report_fields):
+    """Append a check-in to the session's event log. Returns its sequence number."""
+    token = qr_session['token']
+    timeout = _event_timeout(qr_session)
+    seq_key = qr_events_seq_cache_key(token)
+
+    cache.add(seq_key, 0, timeout=timeout)
+    try:
+        seq = cache.incr(seq_key)
+    except ValueError:
+        # The log expired between add and incr; the session is over
+        return None
+
+    event = build_checkin_event(student_id, report_fields)
+    event['seq'] = seq
+    cache.set(qr_event_cache_key(token, seq), event, timeout=timeout)
+    return seq
+
+
+async def apublish_checkin(qr_session, student_id, report_fields):
+    """Async variant of publish_checkin."""
+    token = qr_session['token']
+    timeout = _event_timeout(qr_session)
+    seq_key = qr_events_seq_cache_key(token)
+
+    await cache.aadd(seq_key, 0, timeout=timeout)
+    try:
+        seq = await cache.aincr(seq_key)
+    except ValueError:
+        return None
+
+    event = build_checkin_event(student_id, report_fields)
+    event['seq'] = seq
+    await cache.aset(qr_event_cache_key(token, seq), event, timeout=timeout)
+    return seq
+
+
+def format_sse(event, data, event_id=None):
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class _FeedState:
+    """Bookkeeping shared by the sync and async stream generators."""
+
+    def __init__(self, qr_session, names, last_seq):
+        self.token = qr_session['token']
+        self.expiry_timestamp = qr_session['expiry_timestamp']
+        self.names = names
+        self.total = len(names)
+        self.last_seq = last_seq
+        self.baseline = 0
+        self.started = time.monotonic()
+        self.last_sent = self.started
+        self.max_duration = getattr(settings, 'QR_EVENT_STREAM_MAX_DURATION', 20)
+
+    def counter(self):
+        return {'present': self.baseline + self.last_seq, 'total': self.total}
+
+    def event_keys(self, seq):
+        return [qr_event_cache_key(self.token, n) for n in range(self.last_seq + 1, seq + 1)]
+
+    def render(self, seq, found):
+        """SSE messages for events last_seq+1..seq (entries evicted from the cache are skipped)."""
+        messages = []
+        for n in range(self.last_seq + 1, seq + 1):
+            event = found.get(qr_event_cache_key(self.token, n))
+            self.last_seq = n
+            if event is None:
+                continue
+            data = dict(event, name=self.names.get(event['student_id'], 'Unknown student'), **self.counter())
+            messages.append(format_sse('checkin', data, event_id=n))
+        return messages
+
+    def tick(self):
+        """Message to send after a poll with no new events, and whether the stream is over."""
+        now = time.monotonic()
+        if time.time() >= self.expiry_timestamp:
+            return format_sse('expired', self.counter(), event_id=self.last_seq), True
+        if now - self.started >= self.max_duration:
+            return None, True
+        if now - self.last_sent >= HEARTBEAT_SECONDS:
+            self.last_sent = now
+            return ": keep-alive\n\n", False
+        return None, False
+
+
+def stream_checkin_events(qr_session, names, last_seq=0):
+    """
+    Generator of SSE messages for a QR session, starting after last_seq.
+
+    Parameters:
+    - qr_session: Session dictionary from get_qr_session
+    - names: student id -> display name (get_qr_roster_names)
+    - last_seq: Last event id the client has seen (Last-Event-ID)
+    """
+    state = _FeedState(qr_session, names, last_seq)
+    poll_interval = getattr(settings, 'QR_EVENT_POLL_INTERVAL', 1.0)
+    state.baseline = cache.get(qr_events_baseline_cache_key(state.token)) or 0
+
+    yield "retry: 2000\n\n"
+    yield format_sse('summary', state.counter(), event_id=state.last_seq)
+    yield format_sse('stats', get_distance_stats(qr_session))
+
+    while True:
+        seq = cache.get(qr_events_seq_cache_key(state.token)) or 0
+        if seq > state.last_seq:
+            messages = state.render(seq, cache.get_many(state.event_keys(seq)))
+            if messages:
+                messages.append(format_sse('stats', get_distance_stats(qr_session)))
+                state.last_sent = time.monotonic()
+                yield ''.join(messages)
+
+        message, done = state.tick()
+        if message:
+            yield message
+        if done:
+            return
+        time.sleep(poll_interval)
+
+
+async def astream_checkin_events(qr_session, names, last_seq=0):
+    """Async variant of stream_checkin_events for ASGI servers."""
+    state = _FeedState(qr_session, names, last_seq)
+    poll_interval = getattr(settings, 'QR_EVENT_POLL_INTERVAL', 1.0)
+    state.baseline = await cache.aget(qr_events_baseline_cache_key(state.token)) or 0
+
+    yield "retry: 2000\n\n"
+    yield format_sse('summary', state.counter(), event_id=state.last_seq)
+    yield format_sse('stats', await aget_distance_stats(qr_session))
+
+    while True:
+        seq = await cache.aget(qr_events_seq_cache_key(state.token)) or 0
+        if seq > state.last_seq:
+            messages = state.render(seq, await cache.aget_many(state.event_keys(seq)))
+            if messages:
+                messages.append(format_sse('stats', await aget_distance_stats(qr_session)))
+                state.last_sent = time.monotonic()
+                yield ''.join(messages)
+
+        message, done = state.tick()
+        if message:
+            yield message
+        if done:
+            return
+        await asyncio.sleep(poll_interval)
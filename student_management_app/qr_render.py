@@ -0,0 +1,124 @@
+"""
+In-memory QR code rendering for staff_generate_qr.
+
+Codes are rendered straight to bytes, either as a compact SVG (one stroked
+path with a segment per run of dark modules) or as a PNG. The bytes are cached
+per QR code until it expires and served by staff_qr_image, so generating a
+code does not have to write to MEDIA_ROOT or inline a base64 copy in the JSON
+response. Writing the ImageField is optional (settings.QR_STORE_IMAGE).
+"""
+import io
+import os
+
+import qrcode
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+CONTENT_TYPES = {
+    'svg': 'image/svg+xml',
+    'png': 'image/png',
+}
+QUIET_ZONE = 4
+PNG_BOX_SIZE = 8
+
+
+def qr_render_cache_key(qr_id):
+    return f"qr_render_{qr_id}"
+
+
+def scan_url_prefix(origin, compact):
+    """
+    Scan URL that the token is appended to, for a site origin such as
+    "https://host". Compact tokens use the short /Q/ path with the scheme and
+    host in uppercase, so the whole URL stays in the QR alphanumeric
+    character set.
+    """
+    origin = origin.rstrip('/')
+    if not compact:
+        scan_url_name = 'scan_attendance_qr_async' if settings.QR_CHECKIN_ASYNC else 'scan_attendance_qr'
+        return f"{origin}{reverse(scan_url_name)}?token="
+
+    short_url_name = 'scan_attendance_qr_short_async' if settings.QR_CHECKIN_ASYNC else 'scan_attendance_qr_short'
+    return f"{origin.upper()}{reverse(short_url_name, args=['-'])[:-1]}"
+
+
+def _matrix(data):
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=QUIET_ZONE)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr
+
+
+def render_svg(data):
+    """
+    SVG bytes for data. Each row of dark modules is drawn as a 1-unit-wide
+    stroked line with relative moves between runs, which keeps the path short.
+    """
+    matrix = _matrix(data).get_matrix()
+    size = len(matrix)
+    rows = []
+    for y, row in enumerate(matrix):
+        runs = []
+        pen = 0
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < size and row[x]:
+                x += 1
+            runs.append(f"m{start - pen} 0h{x - start}")
+            pen = x
+        if runs:
+            # Absolute move to the row's start, then relative segments
+            rows.append(f"M0 {y}.5" + ''.join(runs))
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/>'
+        f'<path stroke="#000" d="{"".join(rows)}"/></svg>'
+    ).encode('ascii')
+
+
+def render_png(data):
+    qr = _matrix(data)
+    qr.box_size = PNG_BOX_SIZE
+    buffer = io.BytesIO()
+    qr.make_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def render_qr(data, image_format='svg'):
+    """
+    Render data as a QR code.
+
+    Returns:
+    - tuple: (image bytes, content type)
+    """
+    if image_format == 'png':
+        return render_png(data), CONTENT_TYPES['png']
+    return render_svg(data), CONTENT_TYPES['svg']
+
+
+def read_stored_qr(name):
+    """(image bytes, content type) of a stored QR image file, or None if it is missing."""
+    content_type = CONTENT_TYPES.get(os.path.splitext(name)[1].lstrip('.'))
+    if not content_type:
+        return None
+    try:
+        with default_storage.open(name, 'rb') as stored:
+            return stored.read(), content_type
+    except OSError:
+        return None
+
+
+def cache_rendered_qr(qr_id, image, content_type, timeout):
+    if timeout > 0:
+        cache.set(qr_render_cache_key(qr_id), (image, content_type), timeout=timeout)
+
+
+def get_rendered_qr(qr_id):
+    """Cached (image bytes, content type) for a QR code, or None."""
+    return cache.get(qr_render_cache_key(qr_id))
@@ -0,0 +1,304 @@
+"""
+Cached QR attendance sessions.
+
+When a teacher generates a QR code, everything the scan path needs to validate
+a token (subject, session year, teacher location, radius and network policy)
+is stored in the cache under the token and expires together with the QR code.
+Scans read the session from the cache instead of querying AttendanceQRCode on
+every request; a cache miss (e.g. another worker process) falls back to the
+database once and refills the cache. A teacher ending a session early leaves
+a closed marker next to it (close_qr_session), read together with the session.
+
+Next to each session the eligible roster is cached as a {user id: student id}
+mapping (the same Students query get_students uses), so the scan path can check
+enrollment and resolve the student without querying Students.
+
+Rotating QR codes are scanned as "<token>.<frame>"; the session is looked up by
+the token and the frame code must belong to the current rotation step. The
+teacher's views (e.g. the live feed) use get_staff_qr_session, which skips the
+frame check since they only know the bare token.
+
+The a-prefixed functions are async variants for the ASGI scan views, built on
+the async cache and ORM APIs.
+"""
+import datetime
+import time
+
+from django.core.cache import cache
+from django.utils.timezone import localdate, now
+
+from .models import AttendanceQRCode, Students
+from .qr_tokens import is_token_plausible, split_frame_token, verify_frame_code
+
+
+def qr_session_cache_key(token):
+    return f"qr_session_{token}"
+
+
+def qr_network_cache_key(token):
+    return f"qr_network_{token}"
+
+
+def qr_roster_cache_key(token):
+    return f"qr_roster_{token}"
+
+
+def qr_roster_names_cache_key(token):
+    return f"qr_roster_names_{token}"
+
+
+def qr_closed_cache_key(token):
+    return f"qr_closed_{token}"
+
+
+def qr_session_cache_keys(token):
+    """Every per-token cache key of a QR session, for dropping it when the code is deactivated."""
+    return [
+        qr_session_cache_key(token), qr_network_cache_key(token),
+        qr_roster_cache_key(token), qr_roster_names_cache_key(token),
+    ]
+
+
+def seconds_until_expiry(expiry_time):
+    """Number of whole seconds left before expiry_time (0 if already expired)."""
+    return max(int(expiry_time.timestamp() - time.time()), 0)
+
+
+def session_timeout(qr_session):
+    """Cache timeout for data that should live exactly as long as the QR session."""
+    return max(int(qr_session['expiry_timestamp'] - time.time()), 0)
+
+
+def qr_attendance_date(qr_code):
+    """
+    Day a QR code's check-ins are recorded under: the local day it was switched
+    on (generated or activated), so a session running past midnight stays on
+    one Attendance row. Check-ins and the close-out both use it.
+    """
+    return localdate(qr_code.activated_at or qr_code.expiry_time)
+
+
+def session_attendance_date(qr_session):
+    """qr_attendance_date of a cached session (today for sessions cached without it)."""
+    attendance_date = qr_session.get('attendance_date')
+    return datetime.date.fromisoformat(attendance_date) if attendance_date else localdate()
+
+
+def build_qr_session(qr_code, network_info=None):
+    """Build the plain dictionary stored in the cache for a QR code."""
+    return {
+        'qr_id': str(qr_code.id),
+        'token': qr_code.token,
+        'subject_id': qr_code.subject_id,
+        'subject_name': qr_code.subject.subject_name,
+        'course_id': qr_code.subject.course_id_id,
+        'session_year_id': qr_code.session_year_id,
+        'expiry_timestamp': qr_code.expiry_time.timestamp(),
+        'attendance_date': qr_attendance_date(qr_code).isoformat(),
+        'teacher_latitude': qr_code.teacher_latitude,
+        'teacher_longitude': qr_code.teacher_longitude,
+        'allowed_radius': float(qr_code.allowed_radius),
+        'geofence_id': qr_code.geofence_id,
+        'rotation_seconds': qr_code.rotation_seconds,
+        'network': network_info,
+    }
+
+
+def cache_qr_session(qr_code, network_info=None):
+    """
+    Store the session for qr_code in the cache until the QR code expires.
+    Returns the session dictionary.
+    """
+    session = build_qr_session(qr_code, network_info)
+    timeout = seconds_until_expiry(qr_code.expiry_time)
+    if timeout > 0:
+        cache.set(qr_session_cache_key(qr_code.token), session, timeout=timeout)
+    return session
+
+
+def _is_frame_valid(session, frame_code):
+    """Rotating sessions need a current frame code; static sessions accept none."""
+    rotation_seconds = session.get('rotation_seconds')
+    if rotation_seconds:
+        return verify_frame_code(session['token'], frame_code, rotation_seconds)
+    return frame_code is None
+
+
+def _load_qr_session(token):
+    """The session for an active, unexpired token (without frame code), from the cache or the database."""
+    found = cache.get_many([qr_session_cache_key(token), qr_closed_cache_key(token)])
+    if found.get(qr_closed_cache_key(token)):
+        return None
+    session = found.get(qr_session_cache_key(token))
+    if session is None:
+        qr_code = AttendanceQRCode.objects.select_related('subject').filter(
+            token=token,
+            is_active=True,
+            expiry_time__gte=now()
+        ).first()
+
+        if not qr_code:
+            return None
+
+        # Network policy only ever lives in the cache
+        network_info = cache.get(qr_network_cache_key(token))
+        session = cache_qr_session(qr_code, network_info)
+
+    if session['expiry_timestamp'] < time.time():
+        return None
+    return session
+
+
+def get_qr_session(token):
+    """
+    Return the cached session for an active, unexpired token, or None.
+
+    On a cache miss the QR code is loaded from the database and cached, so
+    each worker process hits the database at most once per QR code.
+    """
+    # Forged or expired signed tokens never reach the cache or the database
+    if not token or not is_token_plausible(token):
+        return None
+    token, frame_code = split_frame_token(token)
+
+    session = _load_qr_session(token)
+    if session is None or not _is_frame_valid(session, frame_code):
+        return None
+    return session
+
+
+def get_staff_qr_session(token):
+    """
+    Like get_qr_session, for the teacher's own views: they look the token up
+    from the QR code row, so there is no frame code to check on rotating codes.
+    """
+    if not token or not is_token_plausible(token):
+        return None
+    return _load_qr_session(split_frame_token(token)[0])
+
+
+async def acache_qr_session(qr_code, network_info=None):
+    """Async variant of cache_qr_session."""
+    session = build_qr_session(qr_code, network_info)
+    timeout = seconds_until_expiry(qr_code.expiry_time)
+    if timeout > 0:
+        await cache.aset(qr_session_cache_key(qr_code.token), session, timeout=timeout)
+    return session
+
+
+async def _aload_qr_session(token):
+    """Async variant of _load_qr_session."""
+    found = await cache.aget_many([qr_session_cache_key(token), qr_closed_cache_key(token)])
+    if found.get(qr_closed_cache_key(token)):
+        return None
+    session = found.get(qr_session_cache_key(token))
+    if session is None:
+        qr_code = await AttendanceQRCode.objects.select_related('subject').filter(
+            token=token,
+            is_active=True,
+            expiry_time__gte=now()
+        ).afirst()
+
+        if not qr_code:
+            return None
+
+        network_info = await cache.aget(qr_network_cache_key(token))
+        session = await acache_qr_session(qr_code, network_info)
+
+    if session['expiry_timestamp'] < time.time():
+        return None
+    return session
+
+
+async def aget_qr_session(token):
+    """Async variant of get_qr_session."""
+    if not token or not is_token_plausible(token):
+        return None
+    token, frame_code = split_frame_token(token)
+
+    session = await _aload_qr_session(token)
+    if session is None or not _is_frame_valid(session, frame_code):
+        return None
+    return session
+
+
+def invalidate_qr_session(token):
+    """Drop the cached session, e.g. after the QR code is deactivated."""
+    cache.delete(qr_session_cache_key(token))
+
+
+def close_qr_session(qr_code):
+    """
+    Stop scans for a QR code the teacher ended early (already deactivated in
+    the database): drop its cached session and leave a closed marker until it
+    would have expired, which the lookups above check in the same round trip.
+    """
+    cache.delete_many(qr_session_cache_keys(qr_code.token))
+    timeout = seconds_until_expiry(qr_code.expiry_time)
+    if timeout > 0:
+        cache.set(qr_closed_cache_key(qr_code.token), True, timeout=timeout)
+
+
+def build_qr_roster(qr_session):
+    """Map user id -> student id for every student eligible for the session's subject."""
+    return dict(
+        Students.objects.filter(
+            course_id=qr_session['course_id'],
+            session_year_id=qr_session['session_year_id']
+        ).values_list('admin_id', 'id')
+    )
+
+
+def cache_qr_roster(qr_session):
+    """Snapshot the eligible roster next to the session. Returns the roster."""
+    roster = build_qr_roster(qr_session)
+    timeout = session_timeout(qr_session)
+    if timeout > 0:
+        cache.set(qr_roster_cache_key(qr_session['token']), roster, timeout=timeout)
+    return roster
+
+
+def get_qr_roster(qr_session):
+    """Return the cached roster, rebuilding the snapshot on a cache miss."""
+    roster = cache.get(qr_roster_cache_key(qr_session['token']))
+    if roster is None:
+        roster = cache_qr_roster(qr_session)
+    return roster
+
+
+def get_qr_roster_names(qr_session):
+    """
+    Map student id -> display name for the eligible roster, cached for the
+    session so the teacher's live feed resolves names without queries.
+    """
+    cache_key = qr_roster_names_cache_key(qr_session['token'])
+    names = cache.get(cache_key)
+    if names is None:
+        names = {
+            student_id: f"{first_name} {last_name}"
+            for student_id, first_name, last_name in Students.objects.filter(
+                course_id=qr_session['course_id'],
+                session_year_id=qr_session['session_year_id']
+            ).values_list('id', 'admin__first_name', 'admin__last_name')
+        }
+        timeout = session_timeout(qr_session)
+        if timeout > 0:
+            cache.set(cache_key, names, timeout=timeout)
+    return names
+
+
+async def aget_qr_roster(qr_session):
+    """Async variant of get_qr_roster."""
+    roster = await cache.aget(qr_roster_cache_key(qr_session['token']))
+    if roster is None:
+        roster = {
+            admin_id: student_id
+            async for admin_id, student_id in Students.objects.filter(
+                course_id=qr_session['course_id'],
+                session_year_id=qr_session['session_year_id']
+            ).values_list('admin_id', 'id')
+        }
+        timeout = session_timeout(qr_session)
+        if timeout > 0:
+            await cache.aset(qr_roster_cache_key(qr_session['token']), roster, timeout=timeout)
+    return roster
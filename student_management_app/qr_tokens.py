@@ -0,0 +1,261 @@
+"""
+Signed, self-describing QR attendance tokens.
+
+A token carries the QR code id, subject id, session year id and expiry time,
+authenticated with an HMAC derived from settings.SECRET_KEY. Forged, corrupted
+or expired tokens are rejected before any cache or database lookup.
+
+Binary layout (base64url-encoded without padding, about 42 characters):
+
+    version (1 byte) | QR id (16 byte UUID) | subject id (varint)
+    | session year id (varint) | expiry (uint32, unix seconds) | MAC (8 bytes)
+
+Compact tokens (version 2) carry only the first 8 bytes of the QR id and are
+base32-encoded in uppercase (about 38 characters), so together with an
+uppercase short URL ("HTTPS://HOST/Q/<token>") the whole payload fits the QR
+alphanumeric mode and needs a smaller QR version. Both formats are accepted.
+
+A 64-bit MAC is plenty for tokens that are only valid for minutes and can only
+be checked online. Tokens issued before signing was introduced are plain
+uuid4 strings; they are still accepted and validated against the database.
+
+Rotating QR codes append a frame code to the token: "<token>.<frame>". The
+frame code is an HMAC of the time step (unix time // rotation seconds) under a
+key derived from the token, so the teacher's page can be given the whole window
+of frames up front and the scan path checks a frame with two HMACs and a
+constant-time compare, without storing anything per frame.
+"""
+import base64
+import struct
+import time
+import uuid
+from urllib.parse import parse_qs, urlsplit
+
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+TOKEN_VERSION = 1
+COMPACT_TOKEN_VERSION = 2
+COMPACT_ID_LENGTH = 8
+MAC_LENGTH = 8
+BASE32_ALPHABET = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567")
+KEY_SALT = "student_management_app.qr_tokens"
+
+FRAME_SEPARATOR = "."
+FRAME_CODE_LENGTH = 6
+COMPACT_FRAME_CODE_LENGTH = 5  # 8 base32 characters
+FRAME_KEY_SALT = "student_management_app.qr_tokens.frames"
+# A frame stays valid for this many steps after it is replaced on screen
+FRAME_GRACE_STEPS = 1
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def _mac(payload):
+    return salted_hmac(KEY_SALT, payload, algorithm='sha256').digest()[:MAC_LENGTH]
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(token):
+    return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+
+
+def _b32encode(data):
+    return base64.b32encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b32decode(token):
+    return base64.b32decode(token + '=' * (-len(token) % 8))
+
+
+def make_qr_token(qr_id, subject_id, session_year_id, expiry_time, compact=False):
+    """
+    Build a signed token for a QR code.
+
+    Parameters:
+    - qr_id: UUID (or UUID string) of the AttendanceQRCode row
+    - subject_id, session_year_id: Primary keys the token is valid for
+    - expiry_time: Aware datetime after which the token is rejected
+    - compact: Build an uppercase base32 version 2 token
+    """
+    qr_id_bytes = uuid.UUID(str(qr_id)).bytes
+    payload = (
+        bytes([COMPACT_TOKEN_VERSION if compact else TOKEN_VERSION])
+        + (qr_id_bytes[:COMPACT_ID_LENGTH] if compact else qr_id_bytes)
+        + _encode_varint(int(subject_id))
+        + _encode_varint(int(session_year_id))
+        + struct.pack('>I', int(expiry_time.timestamp()))
+    )
+    if compact:
+        return _b32encode(payload + _mac(payload))
+    return _b64encode(payload + _mac(payload))
+
+
+def is_compact_token(token):
+    return bool(token) and set(token) <= BASE32_ALPHABET
+
+
+def is_legacy_token(token):
+    """True for the plain uuid4 tokens issued before tokens were signed."""
+    if not token or len(token) != 36:
+        return False
+    try:
+        uuid.UUID(token)
+    except ValueError:
+        return False
+    return True
+
+
+def verify_qr_token(token, at_time=None):
+    """
+    Verify a signed token.
+
+    Returns:
+    - dict with qr_id (hex of its first 8 bytes for compact tokens), subject_id,
+      session_year_id and expiry_timestamp, or None if the token is malformed,
+      forged or expired
+    """
+    if not token or len(token) > 64:
+        return None
+
+    compact = is_compact_token(token)
+    encode, decode = (_b32encode, _b32decode) if compact else (_b64encode, _b64decode)
+    try:
+        raw = decode(token)
+    except (ValueError, TypeError):
+        return None
+
+    # Reject non-canonical encodings (e.g. altered padding bits) so each token has one spelling
+    version = COMPACT_TOKEN_VERSION if compact else TOKEN_VERSION
+    if len(raw) <= MAC_LENGTH or raw[0] != version or encode(raw) != token:
+        return None
+
+    payload, mac = raw[:-MAC_LENGTH], raw[-MAC_LENGTH:]
+    if not constant_time_compare(mac, _mac(payload)):
+        return None
+
+    try:
+        if compact:
+            qr_id = payload[1:1 + COMPACT_ID_LENGTH].hex()
+            offset = 1 + COMPACT_ID_LENGTH
+        else:
+            qr_id = str(uuid.UUID(bytes=payload[1:17]))
+            offset = 17
+        subject_id, offset = _decode_varint(payload, offset)
+        session_year_id, offset = _decode_varint(payload, offset)
+        (expiry_timestamp,) = struct.unpack('>I', payload[offset:offset + 4])
+    except (ValueError, IndexError, struct.error):
+        return None
+
+    if expiry_timestamp < (at_time if at_time is not None else time.time()):
+        return None
+
+    return {
+        'qr_id': qr_id,
+        'subject_id': subject_id,
+        'session_year_id': session_year_id,
+        'expiry_timestamp': expiry_timestamp,
+    }
+
+
+def split_frame_token(token):
+    """Split "<token>.<frame>" into (token, frame code); the frame code is None for static tokens."""
+    if token and FRAME_SEPARATOR in token:
+        token, frame_code = token.split(FRAME_SEPARATOR, 1)
+        return token, frame_code
+    return token, None
+
+
+def is_token_plausible(token):
+    """
+    Cheap pre-check for the scan path: signed tokens must verify, legacy tokens
+    are passed through to the database lookup. A frame suffix is checked later
+    against the session's rotation settings.
+    """
+    token, _ = split_frame_token(token)
+    return is_legacy_token(token) or verify_qr_token(token) is not None
+
+
+def frame_step(rotation_seconds, at_time=None):
+    """Index of the rotation step containing at_time (default: now)."""
+    return int((at_time if at_time is not None else time.time()) // rotation_seconds)
+
+
+def make_frame_code(token, step):
+    """Frame code for one step; compact tokens get uppercase base32 codes to stay alphanumeric."""
+    key = salted_hmac(FRAME_KEY_SALT, token, algorithm='sha256').digest()
+    mac = salted_hmac(FRAME_KEY_SALT, str(step), secret=key, algorithm='sha256').digest()
+    if is_compact_token(token):
+        return _b32encode(mac[:COMPACT_FRAME_CODE_LENGTH])
+    return _b64encode(mac[:FRAME_CODE_LENGTH])
+
+
+def make_frame_window(token, rotation_seconds, expiry_timestamp, at_time=None):
+    """
+    Frame codes for every step from now until expiry.
+
+    Returns:
+    - tuple: (first step, list of frame codes)
+    """
+    first_step = frame_step(rotation_seconds, at_time)
+    last_step = frame_step(rotation_seconds, expiry_timestamp)
+    return first_step, [make_frame_code(token, step) for step in range(first_step, last_step + 1)]
+
+
+def verify_frame_code(token, frame_code, rotation_seconds, at_time=None):
+    """True if frame_code belongs to the current step or one of the grace steps before it."""
+    if not frame_code or len(frame_code) > 16:
+        return False
+    current = frame_step(rotation_seconds, at_time)
+    valid = False
+    # Compare against every candidate so timing does not reveal which step matched
+    for step in range(current - FRAME_GRACE_STEPS, current + 1):
+        valid |= constant_time_compare(frame_code, make_frame_code(token, step))
+    return valid
+
+
+def extract_token(qr_data):
+    """
+    Token from the decoded contents of a QR code: a scan URL with ?token=, a
+    short /Q/<token> (or /QA/<token>) URL, or a bare token. Returns None for
+    URLs that carry no token.
+    """
+    qr_data = (qr_data or '').strip()
+    parsed = urlsplit(qr_data)
+    if not (parsed.scheme and parsed.netloc):
+        return qr_data or None
+
+    token = parse_qs(parsed.query).get('token')
+    if token:
+        return token[0]
+
+    segments = [segment for segment in parsed.path.split('/') if segment]
+    if len(segments) == 2 and segments[0].upper() in ('Q', 'QA'):
+        return segments[1]
+    return None
@@ -0,0 +1,66 @@
+"""
+Decode cache for student_upload_qr.
+
+Students share one screenshot of the teacher's QR code in group chats, so the
+same image is uploaded many times. Each upload is fingerprinted by a content
+hash (BLAKE2b of the file bytes); an exact copy seen before maps straight to
+the decoded QR data, so pyzbar/OpenCV are skipped.
+
+The content hash also counts how many different students uploaded the same
+file. A check-in from a file that other students uploaded too is flagged
+(verification_details['shared_image_uploads']) and shown on the teacher's
+live feed: one image shared by several students is a cheap sign that they
+were not all in the room.
+"""
+import hashlib
+
+from django.core.cache import cache
+
+# Longer than the longest QR code validity
+UPLOAD_CACHE_TIMEOUT = 3 * 60 * 60
+
+
+def qr_upload_cache_key(fingerprint):
+    return f"qr_upload_{fingerprint}"
+
+
+def qr_upload_seen_cache_key(fingerprint, user_id):
+    return f"qr_upload_seen_{fingerprint}_{user_id}"
+
+
+def qr_upload_users_cache_key(fingerprint):
+    return f"qr_upload_users_{fingerprint}"
+
+
+def fingerprint_upload(data):
+    """Content hash of an uploaded image."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def get_cached_decode(fingerprint):
+    """Decoded QR data for a byte-identical image seen before, or None."""
+    return cache.get(qr_upload_cache_key(fingerprint))
+
+
+def cache_decode(fingerprint, decoded):
+    cache.set(qr_upload_cache_key(fingerprint), decoded, timeout=UPLOAD_CACHE_TIMEOUT)
+
+
+def record_uploader(fingerprint, user_id):
+    """
+    Count the student as an uploader of this exact file.
+
+    Returns:
+    - int: Number of different students who uploaded the same bytes,
+      including this one
+    """
+    count_key = qr_upload_users_cache_key(fingerprint)
+    if not cache.add(qr_upload_seen_cache_key(fingerprint, user_id), 1, timeout=UPLOAD_CACHE_TIMEOUT):
+        # A repeat upload by the same student does not count twice
+        return cache.get(count_key) or 1
+
+    cache.add(count_key, 0, timeout=UPLOAD_CACHE_TIMEOUT)
+    try:
+        return cache.incr(count_key)
+    except ValueError:
+        return 1
@@ -1,3 +1,939 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import AsyncClient, Client, TestCase, override_settings
+from django.utils.timezone import localtime, now
+import numpy as np
+from PIL import Image
+import qrcode
+
+from . import qr_decode, write_behind
+from .checkin import attendance_marked_cache_key, check_in, get_session_attendance_id, QRSessionClosed
+from .closeout import close_out_qr_code
+from .distance_stats import get_distance_stats, record_distance, summarize_distances
+from .geofences import GeofenceIndex
+from .location_anomalies import apeek_location, arecord_location
+from .management.commands.benchmark_qr_decode import make_sample
+from .models import (
+    Attendance, AttendanceQRCode, AttendanceReport, Courses, CustomUser, Geofence,
+    SessionYearModel, Subjects, TimetableEntry
+)
+from .qr_decode import decode_qr_image, decode_qr_upload, server_timing
+from .qr_session import (
+    close_qr_session, get_qr_roster, get_qr_session, get_staff_qr_session, qr_roster_cache_key
+)
+from .qr_tokens import (
+    extract_token, frame_step, is_compact_token, make_frame_code, make_qr_token, verify_qr_token
+)
+from .qr_upload_cache import fingerprint_upload, get_cached_decode, record_uploader
+from .utils import (
+    distance_array, equirectangular_distance, geodesic_distance, get_distance_kernel, haversine_distance
+)
+
+
+class QRAttendanceTestCase(TestCase):
+    """A course with one teacher and three enrolled students."""
+
+    def setUp(self):
+        cache.clear()
+        self.session_year = SessionYearModel.objects.create(
+            session_start_year=datetime.date(2026, 1, 1),
+            session_end_year=datetime.date(2027, 1, 1)
+        )
+        self.course = Courses.objects.create(course_name="Physics")
+        self.staff_user = CustomUser.objects.create_user(
+            username="teacher", email="teacher@example.com", password="password", user_type='2'
+        )
+        self.subject = Subjects.objects.create(
+            subject_name="Mechanics", course_id=self.course, staff_id=self.staff_user.staffs
+        )
+        self.student_users = []
+        for i in range(3):
+            user = CustomUser.objects.create_user(
+                username=f"student{i}", email=f"student{i}@example.com", password="password", user_type='3'
+            )
+            user.students.course_id = self.course
+            user.students.session_year_id = self.session_year
+            user.students.save()
+            self.student_users.append(user)
+
+        self.staff_client = Client()
+        self.staff_client.force_login(self.staff_user)
+
+    def generate_qr(self, **extra):
+        data = {
+            'subject': self.subject.id,
+            'session_year': self.session_year.id,
+            'expiry_time': 5,
+            'latitude': '12.0',
+            'longitude': '77.0',
+            'radius': 100,
+        }
+        data.update(extra)
+        response = self.staff_client.post('/staff_generate_qr/', data)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def scan(self, user, token, latitude=12.0001, longitude=77.0001, accuracy=5):
+        client = Client()
+        client.force_login(user)
+        body = {'token': token, 'latitude': latitude, 'longitude': longitude, 'accuracy': accuracy}
+        return client.post('/student_process_qr_scan/', json.dumps(body), content_type='application/json').json()
+
+    def read_stream(self, url):
+        with self.settings(QR_EVENT_STREAM_MAX_DURATION=0.3, QR_EVENT_POLL_INTERVAL=0.1):
+            response = self.staff_client.get(url)
+            if response.status_code != 200:
+                return response, ''
+            return response, b''.join(response.streaming_content).decode()
+
+
+class CheckInTests(QRAttendanceTestCase):
+
+    def test_duplicate_scan_writes_one_report(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.get()
+
+        self.assertEqual(self.scan(self.student_users[0], qr_code.token)['status'], 'success')
+        self.scan(self.student_users[0], qr_code.token)
+
+        self.assertEqual(AttendanceReport.objects.count(), 1)
+        self.assertEqual(Attendance.objects.count(), 1)
+
+    def test_check_in_reports_duplicate(self):
+        self.generate_qr()
+        qr_session = get_qr_session(AttendanceQRCode.objects.get().token)
+        student_id = self.student_users[0].students.id
+
+        _, created = check_in(qr_session, student_id)
+        self.assertTrue(created)
+        cache.clear()  # the database constraint still catches the duplicate
+        report, created = check_in(qr_session, student_id)
+        self.assertFalse(created)
+        self.assertIsNone(report)
+
+    def test_later_code_turns_absent_into_present(self):
+        self.generate_qr()
+        first = AttendanceQRCode.objects.get()
+        self.scan(self.student_users[0], first.token)
+        self.staff_client.post(f'/staff_close_qr/{first.id}/')
+        student = self.student_users[1].students
+        self.assertFalse(AttendanceReport.objects.get(student_id=student).status)
+
+        self.generate_qr()
+        second = AttendanceQRCode.objects.exclude(id=first.id).get()
+        self.assertEqual(self.scan(self.student_users[1], second.token)['status'], 'success')
+
+        self.assertTrue(AttendanceReport.objects.get(student_id=student).status)
+        self.assertEqual(AttendanceReport.objects.count(), 3)
+
+    def test_closed_code_does_not_undo_close_out(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.get()
+        qr_session = get_qr_session(qr_code.token)
+        self.staff_client.post(f'/staff_close_qr/{qr_code.id}/')
+        student = self.student_users[0].students
+
+        # A scan that got past the session lookup before the close
+        with self.assertRaises(QRSessionClosed):
+            check_in(qr_session, student.id)
+        self.assertFalse(AttendanceReport.objects.get(student_id=student).status)
+        self.assertIsNone(get_qr_session(qr_code.token))
+
+
+class TokenTests(QRAttendanceTestCase):
+
+    def test_forged_token_rejected(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        forged = token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB')
+
+        self.assertIsNone(verify_qr_token(forged))
+        self.assertIsNone(get_qr_session(forged))
+        self.assertEqual(self.scan(self.student_users[0], forged)['status'], 'error')
+
+    def test_expired_token_rejected(self):
+        expiry_time = now() + datetime.timedelta(minutes=5)
+        token = make_qr_token(
+            '6f1c2f5e-1d2b-4c3a-9a7e-0b8d4e2f1a3c', self.subject.id, self.session_year.id, expiry_time
+        )
+
+        self.assertIsNotNone(verify_qr_token(token))
+        self.assertIsNone(verify_qr_token(token, at_time=expiry_time.timestamp() + 1))
+
+    def test_expired_code_rejected(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.get()
+        AttendanceQRCode.objects.filter(id=qr_code.id).update(expiry_time=now() - datetime.timedelta(minutes=1))
+        cache.clear()
+
+        self.assertEqual(self.scan(self.student_users[0], qr_code.token)['status'], 'error')
+        self.assertFalse(AttendanceReport.objects.exists())
+
+
+class RotatingFrameTests(QRAttendanceTestCase):
+
+    def test_current_and_grace_frames_accepted(self):
+        rotation = self.generate_qr(rotation_seconds=10)['rotation']
+        token = rotation['token']
+        current = rotation['frames'][frame_step(10) - rotation['first_step']]
+
+        self.assertEqual(self.scan(self.student_users[0], f"{token}.{current}")['status'], 'success')
+        previous = make_frame_code(token, frame_step(10) - 1)
+        self.assertEqual(self.scan(self.student_users[1], f"{token}.{previous}")['status'], 'success')
+
+    def test_missing_stale_and_forged_frames_rejected(self):
+        token = self.generate_qr(rotation_seconds=10)['rotation']['token']
+        stale = make_frame_code(token, frame_step(10) - 2)
+
+        for scanned in (token, f"{token}.{stale}", f"{token}.xxxxxxxx"):
+            self.assertEqual(self.scan(self.student_users[0], scanned)['status'], 'error', scanned)
+        self.assertFalse(AttendanceReport.objects.exists())
+
+    def test_static_code_rejects_frame(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        self.assertEqual(self.scan(self.student_users[0], f"{token}.abc")['status'], 'error')
+
+
+class CloseOutTests(QRAttendanceTestCase):
+
+    def test_marks_absentees_once(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.select_related('subject').get()
+        self.scan(self.student_users[0], qr_code.token)
+        AttendanceQRCode.objects.filter(id=qr_code.id).update(is_active=False)
+
+        self.assertEqual(close_out_qr_code(qr_code), 2)
+        self.assertEqual(AttendanceReport.objects.filter(status=False).count(), 2)
+        self.assertEqual(close_out_qr_code(qr_code), 0)
+        self.assertIsNotNone(AttendanceQRCode.objects.get(id=qr_code.id).closed_at)
+
+    def test_deferred_while_sibling_open(self):
+        self.generate_qr()
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.select_related('subject').first()
+        AttendanceQRCode.objects.filter(id=qr_code.id).update(is_active=False)
+
+        self.assertIsNone(close_out_qr_code(qr_code))
+        self.assertFalse(AttendanceReport.objects.exists())
+
+    def test_same_day_as_check_ins(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.select_related('subject').get()
+        AttendanceQRCode.objects.filter(id=qr_code.id).update(activated_at=now() - datetime.timedelta(days=1))
+        qr_code.refresh_from_db()
+        cache.clear()
+        self.scan(self.student_users[0], qr_code.token)
+        AttendanceQRCode.objects.filter(id=qr_code.id).update(is_active=False)
+
+        close_out_qr_code(qr_code)
+        self.assertEqual(Attendance.objects.count(), 1)
+        self.assertEqual(AttendanceReport.objects.count(), 3)
+
+
+class GeofenceIndexTests(TestCase):
+    # About 16 m either side of the center
+    HALF_SIDE = 0.00015
+
+    def setUp(self):
+        d = self.HALF_SIDE
+        self.room = Geofence(
+            id=1, name="R101", building="Main", shape="polygon",
+            polygon=[[12.0 - d, 77.0 - d], [12.0 - d, 77.0 + d], [12.0 + d, 77.0 + d], [12.0 + d, 77.0 - d]]
+        )
+        self.room.center_latitude, self.room.center_longitude = 12.0, 77.0
+        self.building = Geofence(
+            id=2, name="Main", shape="circle", center_latitude=12.0, center_longitude=77.0, radius=80
+        )
+        self.index = GeofenceIndex([self.room, self.building], cell_degrees=0.001, tolerance=10)
+
+    def test_point_inside_room_and_building(self):
+        found = self.index.locate(12.0001, 77.0001)
+        self.assertEqual([fence.id for fence, _ in found], [1, 2])
+        self.assertEqual([outside for _, outside in found], [0.0, 0.0])
+
+    def test_point_outside_room_inside_building(self):
+        self.assertGreater(self.index.check(1, 12.0006, 77.0), 10)
+        self.assertEqual(self.index.check(2, 12.0006, 77.0), 0.0)
+        self.assertEqual([fence.id for fence, _ in self.index.locate(12.0006, 77.0)], [2])
+
+    def test_tolerance_at_the_wall(self):
+        # About 5.5 m outside the room's north wall
+        outside = self.index.check(1, 12.0 + self.HALF_SIDE + 0.00005, 77.0)
+        self.assertTrue(0 < outside <= 10)
+        self.assertIn(1, [fence.id for fence, _ in self.index.locate(12.0 + self.HALF_SIDE + 0.00005, 77.0)])
+
+    def test_unknown_fence(self):
+        self.assertIsNone(self.index.check(99, 12.0, 77.0))
+        self.assertEqual(self.index.locate(13.0, 78.0), [])
+
+
+class DistanceStatsTests(QRAttendanceTestCase):
+
+    def test_percentiles_within_accuracy(self):
+        qr_session = {'token': 'stats', 'expiry_timestamp': time.time() + 60, 'allowed_radius': 500}
+        rng = random.Random(3)
+        distances = sorted(min(rng.lognormvariate(3, 1), 500) for _ in range(2000))
+        for distance in distances:
+            record_distance(qr_session, {'verification_details': {'distance': distance, 'is_reliable': True}})
+
+        stats = get_distance_stats(qr_session)
+        self.assertEqual(stats['count'], len(distances))
+        self.assertEqual(stats['reliable_fraction'], 1.0)
+        for percentile in (50, 90, 95, 99):
+            exact = distances[math.ceil(percentile / 100 * len(distances)) - 1]
+            estimate = stats['percentiles'][f'p{percentile}']
+            self.assertLess(abs(estimate - exact) / exact, 0.051, percentile)
+
+    def test_summary_from_reports(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.get()
+        for user, latitude in zip(self.student_users, (12.0001, 12.0002, 12.0004)):
+            self.scan(user, qr_code.token, latitude=latitude, longitude=77.0)
+
+        stats = summarize_distances(qr_code)
+        self.assertEqual(stats['count'], 3)
+        self.assertAlmostEqual(stats['percentiles']['p50'], 22.1, delta=0.2)
+        self.assertAlmostEqual(stats['percentiles']['p99'], 44.2, delta=0.3)
+
+
+class AttendanceStreamTests(QRAttendanceTestCase):
+
+    def test_static_code_stream(self):
+        stream_url = self.generate_qr()['stream_url']
+        token = AttendanceQRCode.objects.get().token
+        self.scan(self.student_users[0], token)
+        self.scan(self.student_users[1], token)
+
+        response, body = self.read_stream(stream_url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(body.count('event: checkin'), 2)
+        self.assertIn('"present":2,"total":3', body)
+
+    def test_rotating_code_stream(self):
+        data = self.generate_qr(rotation_seconds=10)
+        rotation = data['rotation']
+        current = rotation['frames'][frame_step(10) - rotation['first_step']]
+        self.scan(self.student_users[0], f"{rotation['token']}.{current}")
+
+        self.assertIsNotNone(get_staff_qr_session(rotation['token']))
+        response, body = self.read_stream(data['stream_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body.count('event: checkin'), 1)
+
+    def test_other_teacher_gets_no_stream(self):
+        stream_url = self.generate_qr()['stream_url']
+        other = CustomUser.objects.create_user(
+            username="teacher2", email="teacher2@example.com", password="password", user_type='2'
+        )
+        client = Client()
+        client.force_login(other)
+        self.assertEqual(client.get(stream_url).status_code, 204)
+
+
+class WriteBehindTests(QRAttendanceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        settings = self.settings(
+            ATTENDANCE_WRITE_BEHIND=True,
+            ATTENDANCE_WRITE_BEHIND_DIR=self.spool_dir,
+            ATTENDANCE_WRITE_BEHIND_INTERVAL=1000
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        write_behind._buffer = None
+        self.addCleanup(setattr, write_behind, '_buffer', None)
+        # Nothing may be left for the atexit flush once the test database is gone
+        self.addCleanup(write_behind.flush_pending_reports)
+
+    def test_flush_inserts_buffered_check_ins(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        for user in self.student_users:
+            self.assertEqual(self.scan(user, token)['status'], 'success')
+        self.scan(self.student_users[0], token)
+
+        self.assertFalse(AttendanceReport.objects.exists())
+        self.assertEqual(write_behind.flush_pending_reports(), 3)
+        self.assertEqual(AttendanceReport.objects.filter(status=True).count(), 3)
+
+    def test_unknown_attendance_is_quarantined(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        self.scan(self.student_users[0], token)
+        write_behind.get_write_buffer().enqueue({
+            'student_id_id': self.student_users[1].students.id,
+            'attendance_id_id': Attendance.objects.get().id + 1000,
+        })
+
+        self.assertEqual(write_behind.flush_pending_reports(), 2)
+        self.assertEqual(AttendanceReport.objects.count(), 1)
+        quarantine_dir = os.path.join(self.spool_dir, 'quarantine')
+        self.assertEqual(len(os.listdir(quarantine_dir)), 1)
+        self.assertEqual(write_behind.flush_pending_reports(), 0)
+
+    def test_failed_enqueue_releases_marker(self):
+        self.generate_qr()
+        qr_session = get_qr_session(AttendanceQRCode.objects.get().token)
+        student_id = self.student_users[0].students.id
+
+        with mock.patch.object(write_behind.AttendanceWriteBuffer, 'enqueue', side_effect=OSError):
+            with self.assertRaises(OSError):
+                check_in(qr_session, student_id)
+        _, created = check_in(qr_session, student_id)
+        self.assertTrue(created)
+
+    def test_closed_session_is_not_buffered(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.get()
+        qr_session = get_qr_session(qr_code.token)
+        student_id = self.student_users[0].students.id
+        close_qr_session(qr_code)
+
+        with self.assertRaises(QRSessionClosed):
+            check_in(qr_session, student_id)
+        attendance_id = get_session_attendance_id(qr_session, now().date())
+        self.assertIsNone(cache.get(attendance_marked_cache_key(attendance_id, student_id)))
+        self.assertEqual(write_behind.flush_pending_reports(), 0)
+
+
+class RosterTests(QRAttendanceTestCase):
+
+    def test_roster_snapshot_at_generation(self):
+        self.generate_qr()
+        qr_session = get_qr_session(AttendanceQRCode.objects.get().token)
+        roster = cache.get(qr_roster_cache_key(qr_session['token']))
+        self.assertEqual(roster, {user.id: user.students.id for user in self.student_users})
+        self.assertEqual(get_qr_roster(qr_session), roster)
+
+    def test_student_from_other_course_is_rejected(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        outsider = CustomUser.objects.create_user(
+            username="outsider", email="outsider@example.com", password="password", user_type='3'
+        )
+        outsider.students.course_id = Courses.objects.create(course_name="Chemistry")
+        outsider.students.session_year_id = self.session_year
+        outsider.students.save()
+
+        response = self.scan(outsider, token)
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('not enrolled', response['message'])
+        self.assertFalse(AttendanceReport.objects.exists())
+
+    def test_roster_rebuilt_on_cache_miss(self):
+        self.generate_qr()
+        qr_session = get_qr_session(AttendanceQRCode.objects.get().token)
+        cache.delete(qr_roster_cache_key(qr_session['token']))
+
+        self.assertEqual(len(get_qr_roster(qr_session)), 3)
+        self.assertEqual(self.scan(self.student_users[0], qr_session['token'])['status'], 'success')
+
+
+class AsyncCheckInTests(QRAttendanceTestCase):
+
+    async def ascan(self, user, token):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(user)
+        body = {'token': token, 'latitude': 12.0001, 'longitude': 77.0001, 'accuracy': 5}
+        response = await client.post('/student_process_qr_scan_async/', json.dumps(body), content_type='application/json')
+        return response.json()
+
+    async def test_async_scan_marks_once(self):
+        await sync_to_async(self.generate_qr)()
+        token = (await AttendanceQRCode.objects.aget()).token
+
+        self.assertEqual((await self.ascan(self.student_users[0], token))['status'], 'success')
+        self.assertEqual((await self.ascan(self.student_users[0], token))['status'], 'success')
+        self.assertEqual((await self.ascan(self.student_users[1], token))['status'], 'success')
+        self.assertEqual((await self.ascan(self.student_users[2], 'invalid'))['status'], 'error')
+        self.assertEqual(await AttendanceReport.objects.acount(), 2)
+
+    async def test_async_redirect_to_scan_page(self):
+        await sync_to_async(self.generate_qr)()
+        token = (await AttendanceQRCode.objects.aget()).token
+
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.student_users[0])
+        response = await client.get(f'/scan-attendance-async/?token={token}')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('student_scan_qr', response['Location'])
+
+        response = await AsyncClient().get(f'/scan-attendance-async/?token={token}')
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('student_scan_qr', response['Location'])
+
+
+class IdempotencyTests(QRAttendanceTestCase):
+
+    def test_retry_is_replayed(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        client = Client()
+        client.force_login(self.student_users[0])
+        body = json.dumps({'token': token, 'latitude': 12.0001, 'longitude': 77.0001, 'accuracy': 5})
+
+        first = client.post('/student_process_qr_scan/', body, content_type='application/json', HTTP_IDEMPOTENCY_KEY='scan-1')
+        retry = client.post('/student_process_qr_scan/', body, content_type='application/json', HTTP_IDEMPOTENCY_KEY='scan-1')
+        self.assertEqual(first.json(), retry.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(AttendanceReport.objects.count(), 1)
+
+    def test_request_id_is_scoped_per_user(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        client = Client()
+        client.force_login(self.student_users[0])
+        body = {'token': token, 'latitude': 12.0001, 'longitude': 77.0001, 'accuracy': 5, 'request_id': 'scan-1'}
+        client.post('/student_process_qr_scan/', json.dumps(body), content_type='application/json')
+
+        other = Client()
+        other.force_login(self.student_users[1])
+        response = other.post(
+            '/student_process_qr_scan/', json.dumps({'token': 'invalid', 'request_id': 'scan-1'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['status'], 'error')
+
+        # The upload path answers a retry before decoding the image
+        response = client.post('/student_upload_qr/', {
+            'qr_image': SimpleUploadedFile('qr.png', b'not an image'), 'request_id': 'scan-1'
+        })
+        self.assertEqual(response.json()['status'], 'success')
+
+
+class QRRenderTests(QRAttendanceTestCase):
+
+    def test_svg_rendered_without_storing(self):
+        data = self.generate_qr()
+        self.assertFalse(AttendanceQRCode.objects.get().qr_code_image)
+
+        response = self.staff_client.get(data['qr_code_url'])
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+        cache.clear()
+        self.assertEqual(self.staff_client.get(data['qr_code_url']).content, response.content)
+
+    def test_stored_png(self):
+        with self.settings(QR_STORE_IMAGE=True, QR_RENDER_FORMAT='png', MEDIA_ROOT=tempfile.mkdtemp()):
+            data = self.generate_qr()
+            self.assertTrue(AttendanceQRCode.objects.get().qr_code_image.name.endswith('.png'))
+            response = self.staff_client.get(data['qr_code_url'])
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertTrue(response.content.startswith(b'\x89PNG'))
+
+    def test_other_teacher_gets_404(self):
+        data = self.generate_qr()
+        other = CustomUser.objects.create_user(
+            username="teacher2", email="teacher2@example.com", password="password", user_type='2'
+        )
+        client = Client()
+        client.force_login(other)
+        cache.clear()
+        self.assertEqual(client.get(data['qr_code_url']).status_code, 404)
+
+
+class CleanupQRCodesTests(QRAttendanceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        settings = self.settings(MEDIA_ROOT=self.media_root, QR_CODE_ARCHIVE_DIR=tempfile.mkdtemp())
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.generate_qr()
+        self.old = AttendanceQRCode.objects.get()
+        self.old.qr_code_image.save('qr_old.png', ContentFile(b'png'), save=True)
+        AttendanceQRCode.objects.filter(id=self.old.id).update(expiry_time=now() - datetime.timedelta(days=200))
+        for i in range(3):
+            AttendanceQRCode.objects.create(
+                subject=self.subject, session_year=self.session_year, token=f"expired{i}",
+                expiry_time=now() - datetime.timedelta(minutes=i + 1)
+            )
+        self.live = AttendanceQRCode.objects.create(
+            subject=self.subject, session_year=self.session_year, token="live",
+            expiry_time=now() + datetime.timedelta(minutes=5)
+        )
+
+    def test_dry_run_changes_nothing(self):
+        path = self.old.qr_code_image.path
+        call_command('cleanup_qr_codes', '--dry-run', stdout=io.StringIO())
+        self.assertEqual(AttendanceQRCode.objects.filter(is_active=True).count(), 5)
+        self.assertTrue(os.path.exists(path))
+
+    def test_deactivates_and_purges_past_retention(self):
+        path = self.old.qr_code_image.path
+        out = io.StringIO()
+        call_command('cleanup_qr_codes', '--batch-size', '2', '--archive', stdout=out)
+
+        self.assertIn('Deactivated 4 expired QR codes, deleted 1 images, purged 1 rows', out.getvalue())
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(AttendanceQRCode.objects.filter(id=self.old.id).exists())
+        self.assertEqual(list(AttendanceQRCode.objects.filter(is_active=True)), [self.live])
+        self.assertEqual(AttendanceQRCode.objects.count(), 4)
+
+    def test_rows_kept_within_retention(self):
+        call_command('cleanup_qr_codes', '--retention-days', '365', stdout=io.StringIO())
+        self.assertEqual(AttendanceQRCode.objects.count(), 5)
+
+
+class CompactTokenTests(QRAttendanceTestCase):
+
+    def test_short_url_stores_token(self):
+        data = self.generate_qr(rotation_seconds=10)
+        qr_code = AttendanceQRCode.objects.get()
+        self.assertTrue(is_compact_token(qr_code.token))
+        self.assertTrue(data['rotation']['url_prefix'].upper().endswith('/Q/'))
+
+        client = Client()
+        client.force_login(self.student_users[0])
+        token = f"{qr_code.token}.{data['rotation']['frames'][0]}"
+        response = client.get(f'/Q/{token}')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(client.session['attendance_token'], token)
+
+    def test_legacy_tokens_still_accepted(self):
+        with self.settings(QR_COMPACT_TOKENS=False):
+            self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        self.assertFalse(is_compact_token(token))
+        self.assertEqual(self.scan(self.student_users[0], token)['status'], 'success')
+
+    def test_extract_token(self):
+        self.assertEqual(extract_token('https://example.com/scan-attendance/?token=abc'), 'abc')
+        self.assertEqual(extract_token('HTTPS://EXAMPLE.COM/Q/ABC.DEF'), 'ABC.DEF')
+        self.assertEqual(extract_token('https://example.com/QA/ABC'), 'ABC')
+        self.assertEqual(extract_token(' ABC '), 'ABC')
+        self.assertIsNone(extract_token('https://example.com/other/'))
+        self.assertIsNone(extract_token(''))
+
+
+class PregenerateQRCodesTests(QRAttendanceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        today = localtime(now())
+        start = (today - datetime.timedelta(minutes=5)).time()
+        for i in range(3):
+            TimetableEntry.objects.create(
+                subject=self.subject, session_year=self.session_year, weekday=today.weekday(),
+                start_time=start, attendance_minutes=20 + i, latitude=12.0, longitude=77.0,
+                rotation_seconds=10 if i == 2 else 0
+            )
+        TimetableEntry.objects.create(
+            subject=self.subject, session_year=self.session_year, weekday=(today.weekday() + 1) % 7, start_time=start
+        )
+
+    def test_creates_inactive_codes_once(self):
+        call_command('pregenerate_qr_codes', '--base-url', 'http://testserver', stdout=io.StringIO())
+        self.assertEqual(AttendanceQRCode.objects.filter(is_active=False).count(), 3)
+        call_command('pregenerate_qr_codes', '--base-url', 'http://testserver', stdout=io.StringIO())
+        self.assertEqual(AttendanceQRCode.objects.count(), 3)
+
+    def test_stored_images_rendered_in_pool(self):
+        with self.settings(QR_STORE_IMAGE=True, MEDIA_ROOT=tempfile.mkdtemp()):
+            call_command('pregenerate_qr_codes', '--base-url', 'http://testserver', '--workers', '2', stdout=io.StringIO())
+            # Rotating codes are drawn in the browser, so only the static ones get an image
+            self.assertEqual(AttendanceQRCode.objects.exclude(qr_code_image='').count(), 2)
+
+    def test_activate_makes_code_scannable(self):
+        call_command('pregenerate_qr_codes', '--base-url', 'http://testserver', stdout=io.StringIO())
+        qr_code = AttendanceQRCode.objects.filter(rotation_seconds=0).first()
+        self.assertEqual(self.scan(self.student_users[0], qr_code.token)['status'], 'error')
+
+        self.assertContains(self.staff_client.get('/staff_take_attendance/'), f'/staff_activate_qr/{qr_code.id}/')
+        data = self.staff_client.post(f'/staff_activate_qr/{qr_code.id}/', {'latitude': '12.0', 'longitude': '77.0'}).json()
+        self.assertEqual(data['status'], 'success')
+        self.assertGreater(data['expires_in'], 0)
+        self.assertEqual(self.staff_client.post(f'/staff_activate_qr/{qr_code.id}/').status_code, 404)
+        self.assertEqual(self.scan(self.student_users[0], qr_code.token)['status'], 'success')
+
+
+def qr_photo(data, size=(4000, 3000), image_format='JPEG'):
+    """A QR code in the middle of a large photo-like image."""
+    code = qrcode.make(data).get_image().convert('L').resize((600, 600))
+    photo = Image.new('L', size, 200)
+    photo.paste(code, ((size[0] - 600) // 2, (size[1] - 600) // 2))
+    buffer = io.BytesIO()
+    photo.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class QRDecodeTests(TestCase):
+
+    def test_large_photo_decoded_downscaled(self):
+        data, timings = decode_qr_image(qr_photo('https://example.com/Q/ABC'))
+        self.assertEqual(data, 'https://example.com/Q/ABC')
+        self.assertEqual(timings[0][0], 'load-800')
+        self.assertNotIn('load-full', [stage for stage, _ in timings])
+
+    def test_unreadable_image(self):
+        self.assertEqual(decode_qr_image(b'not an image')[0], None)
+        blank = io.BytesIO()
+        Image.new('L', (300, 300), 255).save(blank, format='PNG')
+        data, timings = decode_qr_image(blank.getvalue())
+        self.assertIsNone(data)
+        # A small image is only tried once, at full resolution
+        self.assertEqual([stage for stage, _ in timings if stage.startswith('load')], ['load-800'])
+
+    def test_inline_upload_decode(self):
+        with self.settings(QR_DECODE_WORKERS=0):
+            data, timings = decode_qr_upload(qr_photo('ABC', size=(1000, 1000), image_format='PNG'))
+        self.assertEqual(data, 'ABC')
+        self.assertIn(';dur=', server_timing(timings))
+
+
+class DecodeLimitTests(QRAttendanceTestCase):
+
+    def test_in_flight_limit_shared_through_cache(self):
+        with self.settings(QR_DECODE_MAX_IN_FLIGHT=2):
+            self.assertTrue(qr_decode._acquire_slot())
+            self.assertTrue(qr_decode._acquire_slot())
+            self.assertFalse(qr_decode._acquire_slot())
+            self.assertEqual(cache.get(qr_decode.qr_decode_in_flight_cache_key()), 2)
+            qr_decode._release_slot()
+            self.assertTrue(qr_decode._acquire_slot())
+
+    def test_release_after_counter_expired(self):
+        qr_decode._release_slot()
+        self.assertIsNone(cache.get(qr_decode.qr_decode_in_flight_cache_key()))
+        cache.set(qr_decode.qr_decode_in_flight_cache_key(), 0)
+        qr_decode._release_slot()
+        self.assertEqual(cache.get(qr_decode.qr_decode_in_flight_cache_key()), 0)
+
+    def test_busy_upload_gets_503(self):
+        self.generate_qr()
+        cache.set(qr_decode.qr_decode_in_flight_cache_key(), 8)
+        client = Client()
+        client.force_login(self.student_users[0])
+        with self.settings(QR_DECODE_MAX_IN_FLIGHT=8):
+            response = client.post('/student_upload_qr/', {
+                'qr_image': SimpleUploadedFile('qr.png', qr_photo('ABC', size=(1000, 1000), image_format='PNG'))
+            })
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(qr_decode.DECODE_RETRY_AFTER))
+        self.assertTrue(response.json()['retry'])
+
+
+class UploadCacheTests(QRAttendanceTestCase):
+
+    def upload(self, user, image_data):
+        client = Client()
+        client.force_login(user)
+        return client.post('/student_upload_qr/', {
+            'qr_image': SimpleUploadedFile('qr.png', image_data, 'image/png'),
+            'latitude': '12.0001', 'longitude': '77.0001',
+        })
+
+    def test_shared_image_skips_decode_and_is_flagged(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        image_data = qr_photo(f'HTTP://TESTSERVER/Q/{token}', size=(1000, 1000), image_format='PNG')
+
+        first = self.upload(self.student_users[0], image_data)
+        second = self.upload(self.student_users[1], image_data)
+        self.assertEqual(first.json()['status'], 'success')
+        self.assertEqual(second.json()['status'], 'success')
+        self.assertTrue(second['Server-Timing'].startswith('cache;dur=0.0'))
+
+        details = [report.verification_details for report in AttendanceReport.objects.order_by('id')]
+        self.assertNotIn('shared_image_uploads', details[0])
+        self.assertEqual(details[1]['shared_image_uploads'], 2)
+
+    def test_repeat_upload_counted_once(self):
+        fingerprint = fingerprint_upload(b'image')
+        self.assertEqual(record_uploader(fingerprint, 1), 1)
+        self.assertEqual(record_uploader(fingerprint, 1), 1)
+        self.assertEqual(record_uploader(fingerprint, 2), 2)
+        self.assertIsNone(get_cached_decode(fingerprint))
+        self.assertIsNone(get_cached_decode(fingerprint_upload(b'other image')))
+
+
+class DecodeBenchmarkTests(TestCase):
+
+    def test_corpus_sample_decodes(self):
+        variant = {'resolution': (1280, 960), 'code_fraction': 0.5, 'blur': 0, 'skew': 0, 'quality': 90}
+        data = make_sample('HTTP://EXAMPLE.COM/Q/ABC', variant, random.Random(1))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (1280, 960))
+        self.assertEqual(decode_qr_image(data)[0], 'HTTP://EXAMPLE.COM/Q/ABC')
+
+    def test_benchmark_command(self):
+        json_path = os.path.join(tempfile.mkdtemp(), 'results.json')
+        out = io.StringIO()
+        call_command('benchmark_qr_decode', '--samples', '2', '--sides', '800', '--json', json_path, stdout=out)
+        self.assertIn('Suggested: QR_DECODE_BACKENDS', out.getvalue())
+        with open(json_path, encoding='utf-8') as results:
+            self.assertEqual(len(json.load(results)), 2)
+
+
+class CheckInPipelineTests(QRAttendanceTestCase):
+
+    def upload(self, client, token, **fields):
+        image_data = qr_photo(f'HTTP://TESTSERVER/Q/{token}', size=(1000, 1000), image_format='PNG')
+        data = {'qr_image': SimpleUploadedFile('qr.png', image_data, 'image/png')}
+        data.update(fields)
+        return client.post('/student_upload_qr/', data)
+
+    def test_upload_uses_scan_checks(self):
+        self.generate_qr(enableNetwork='on')
+        token = AttendanceQRCode.objects.get().token
+
+        outside = Client(REMOTE_ADDR='10.9.9.9')
+        outside.force_login(self.student_users[0])
+        response = self.upload(outside, token, latitude='12.0001', longitude='77.0001')
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertIn('network_details', response.json())
+        self.assertIn('network;dur=', response['Server-Timing'])
+
+        client = Client()
+        client.force_login(self.student_users[1])
+        response = self.upload(client, token, latitude='12.0001', longitude='77.0001', accuracy='8')
+        self.assertEqual(response.json()['status'], 'success')
+        report = AttendanceReport.objects.get()
+        self.assertEqual(report.student_accuracy, 8.0)
+        self.assertTrue(report.verification_details['network_verified'])
+
+    def test_same_location_error_on_both_paths(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        scanned = self.scan(self.student_users[0], token, latitude=12.01, longitude=77.01)
+
+        client = Client()
+        client.force_login(self.student_users[1])
+        uploaded = self.upload(client, token, latitude='12.01', longitude='77.01').json()
+        self.assertEqual(scanned['status'], 'error')
+        self.assertEqual(uploaded['status'], 'error')
+        self.assertEqual(scanned['message'], uploaded['message'])
+        self.assertFalse(AttendanceReport.objects.exists())
+
+    def test_scan_reports_stage_timings(self):
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        client = Client()
+        client.force_login(self.student_users[0])
+        body = {'token': token, 'latitude': 12.0001, 'longitude': 77.0001}
+        response = client.post('/student_process_qr_scan/', json.dumps(body), content_type='application/json')
+        for stage in ('session', 'roster', 'location', 'save'):
+            self.assertIn(f'{stage};dur=', response['Server-Timing'])
+
+
+class DistanceKernelTests(TestCase):
+
+    def test_kernels_agree_with_geodesic(self):
+        rng = random.Random(1)
+        for _ in range(50):
+            lat, lon = rng.uniform(-60, 60), rng.uniform(-180, 180)
+            other = (lat + rng.uniform(-0.005, 0.005), lon + rng.uniform(-0.005, 0.005))
+            reference = geodesic_distance(lat, lon, *other)
+            # Within a classroom radius the fast kernel is off by millimetres, haversine by its sphere (0.5%)
+            self.assertAlmostEqual(equirectangular_distance(lat, lon, *other), reference, delta=0.01)
+            self.assertAlmostEqual(haversine_distance(lat, lon, *other), reference, delta=reference * 0.005 + 0.01)
+
+    def test_array_kernels_match_scalar(self):
+        lat1, lon1 = np.array([12.0, 51.5, -33.9]), np.array([77.0, -0.1, 179.999])
+        lat2, lon2 = np.array([12.001, 51.502, -33.901]), np.array([77.001, -0.099, -179.999])
+        for name, scalar in (('equirectangular', equirectangular_distance), ('haversine', haversine_distance)):
+            distances = distance_array(lat1, lon1, lat2, lon2, kernel=name)
+            for i, distance in enumerate(distances):
+                self.assertAlmostEqual(distance, scalar(lat1[i], lon1[i], lat2[i], lon2[i]), places=6)
+
+    def test_unknown_kernel(self):
+        with self.assertRaises(ValueError):
+            get_distance_kernel('manhattan')
+        with self.settings(QR_DISTANCE_KERNEL='manhattan'):
+            with self.assertRaises(ImproperlyConfigured):
+                apps.get_app_config('student_management_app').ready()
+
+
+class ReverifyLocationsTests(QRAttendanceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.generate_qr()
+        token = AttendanceQRCode.objects.get().token
+        for user in self.student_users[:2]:
+            self.assertEqual(self.scan(user, token)['status'], 'success')
+
+    def reverify(self, *args):
+        out = io.StringIO()
+        call_command('reverify_locations', '--from', '2026-01-01', *args, stdout=out)
+        return out.getvalue()
+
+    def test_moved_room(self):
+        self.assertIn('Updated 0 reports', self.reverify())
+
+        # The room is really 1 km further north
+        AttendanceQRCode.objects.update(teacher_latitude=12.01)
+        self.assertIn('2 now outside', self.reverify('--dry-run'))
+        self.assertEqual(AttendanceReport.objects.filter(location_verified=True).count(), 2)
+        self.reverify()
+        self.assertEqual(AttendanceReport.objects.filter(location_verified=True).count(), 0)
+        self.assertIn('reverified_at', AttendanceReport.objects.first().verification_details)
+
+        self.assertIn('2 now inside', self.reverify('--radius', '5000'))
+
+    def test_reports_purged_sessions(self):
+        AttendanceQRCode.objects.all().delete()
+        output = self.reverify()
+        self.assertIn('Skipped 1 class sessions (2 check-ins) whose QR codes were already purged', output)
+        self.assertIn('Updated 0 reports', output)
+
+
+class LocationAnomalyTests(QRAttendanceTestCase):
+
+    def anomalies(self):
+        return {
+            report.student_id.admin.username: report.verification_details.get('anomalies')
+            for report in AttendanceReport.objects.select_related('student_id__admin')
+        }
+
+    @override_settings(QR_SPOOF_CLUSTER_SIZE=3)
+    def test_identical_and_clustered_coordinates(self):
+        self.generate_qr()
+        qr_code = AttendanceQRCode.objects.get()
+        self.scan(self.student_users[0], qr_code.token)
+        # A repeat scan is not a check-in and must not count as a second phone
+        self.scan(self.student_users[0], qr_code.token)
+        self.scan(self.student_users[1], qr_code.token)
+        self.scan(self.student_users[2], qr_code.token, latitude=12.000103)
+
+        anomalies = self.anomalies()
+        self.assertIsNone(anomalies['student0'])
+        self.assertEqual(anomalies['student1']['flags'], ['identical_coordinates'])
+        self.assertEqual(anomalies['student1']['identical'], 1)
+        self.assertIn('tight_cluster', anomalies['student2']['flags'])
+        self.assertEqual(anomalies['student2']['cluster'], 3)
+
+        summary = self.staff_client.post(f'/staff_close_qr/{qr_code.id}/').json()['anomalies']
+        self.assertEqual(summary['flagged'], 3)
+        self.assertEqual(len(summary['identical']), 1)
+        self.assertEqual(len(summary['clusters']), 1)
+
+    async def test_peek_does_not_count(self):
+        qr_session = {
+            'token': 'token', 'expiry_timestamp': time.time() + 60,
+            'teacher_latitude': 12.0, 'teacher_longitude': 77.0,
+        }
+        self.assertIsNone(await apeek_location(qr_session, 12.001, 77.001))
+        self.assertIsNone(await apeek_location(qr_session, 12.001, 77.001))
+        await arecord_location(qr_session, 12.001, 77.001)
+        self.assertEqual((await apeek_location(qr_session, 12.001, 77.001))['identical'], 1)
+        self.assertEqual((await apeek_location(qr_session, 12.0, 77.0))['flags'], ['teacher_coordinates'])
@@ -9,6 +9,9 @@ urlpatterns = [
     path('get_user_details/', views.get_user_details, name="get_user_details"),
     path('logout_user/', views.logout_user, name="logout_user"),
     path('scan-attendance/', views.scan_attendance_qr, name="scan_attendance_qr"),
+    path('scan-attendance-async/', views.scan_attendance_qr_async, name="scan_attendance_qr_async"),
+    path('Q/<str:token>', views.scan_attendance_qr, name="scan_attendance_qr_short"),
+    path('QA/<str:token>', views.scan_attendance_qr_async, name="scan_attendance_qr_short_async"),
     path('admin_home/', HodViews.admin_home, name="admin_home"),
     path('add_staff/', HodViews.add_staff, name="add_staff"),
     path('add_staff_save/', HodViews.add_staff_save, name="add_staff_save"),
@@ -59,6 +62,10 @@ urlpatterns = [
     path('update_attendance_data/', StaffViews.update_attendance_data, name="update_attendance_data"),
     path('staff_view_attendance/', StaffViews.staff_view_attendance, name="staff_view_attendance"),
     path("staff_generate_qr/", StaffViews.staff_generate_qr, name="staff_generate_qr"),
+    path("staff_qr_image/<uuid:qr_id>/", StaffViews.staff_qr_image, name="staff_qr_image"),
+    path("staff_activate_qr/<uuid:qr_id>/", StaffViews.staff_activate_qr, name="staff_activate_qr"),
+    path("staff_close_qr/<uuid:qr_id>/", StaffViews.staff_close_qr, name="staff_close_qr"),
+    path("staff_qr_attendance_stream/<uuid:qr_id>/", StaffViews.staff_qr_attendance_stream, name="staff_qr_attendance_stream"),
     # Network info URL removed
     path('staff_profile/', StaffViews.staff_profile, name="staff_profile"),
     path('staff_profile_update/', StaffViews.staff_profile_update, name="staff_profile_update"),
@@ -79,6 +86,7 @@ urlpatterns = [
     path('student_upload_qr/', StudentViews.student_upload_qr, name="student_upload_qr"),
     path('student_scan_qr/', StudentViews.student_scan_qr, name="student_scan_qr"),
     path('student_process_qr_scan/', StudentViews.student_process_qr_scan, name="student_process_qr_scan"),
+    path('student_process_qr_scan_async/', StudentViews.student_process_qr_scan_async, name="student_process_qr_scan_async"),
     path('student_export_attendance/', StudentViews.student_export_attendance, name="student_export_attendance"),
     path('student_export_attendance_data/', StudentViews.student_export_attendance_data, name="student_export_attendance_data"),
     path('student_profile/', StudentViews.student_profile, name="student_profile"),
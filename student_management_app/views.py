@@ -1,3 +1,4 @@
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login, logout
 from django.http import HttpResponseRedirect, HttpResponse
 from django.shortcuts import render, redirect
@@ -5,6 +6,7 @@ from django.contrib import messages
 from django.urls import reverse
 
 from student_management_app.EmailBackEnd import EmailBackEnd
+from student_management_app.qr_tokens import is_token_plausible
 
 
 def home(request):
@@ -63,19 +65,24 @@ def logout_user(request):
     return HttpResponseRedirect('/')
 
 
-def scan_attendance_qr(request):
+def scan_attendance_qr(request, token=None):
     """
     Handle QR code scanning from external sources.
-    This function accepts a token parameter and:
+    This function accepts a token (the ?token= parameter or the /Q/<token> short URL) and:
     1. If user is logged in as a student, processes the attendance
     2. If user is not logged in, saves the token in session and redirects to login
     """
-    token = request.GET.get('token')
+    token = token or request.GET.get('token')
 
     if not token:
         messages.error(request, "Invalid QR code. No token provided.")
         return redirect('login')
 
+    # Reject forged or expired signed tokens before touching the session or database
+    if not is_token_plausible(token):
+        messages.error(request, "This QR code is invalid or has expired.")
+        return redirect('login')
+
     # If user is already logged in and is a student
     if request.user.is_authenticated and request.user.user_type == '3':
         # Redirect to student scan processing with the token in session
@@ -88,3 +95,28 @@ def scan_attendance_qr(request):
     return redirect('login')
 
 
+async def scan_attendance_qr_async(request, token=None):
+    """
+    Async variant of scan_attendance_qr for ASGI deployments. The session and
+    user are loaded off the event loop; everything else is in memory.
+    """
+    token = token or request.GET.get('token')
+
+    if not token:
+        messages.error(request, "Invalid QR code. No token provided.")
+        return redirect('login')
+
+    if not is_token_plausible(token):
+        messages.error(request, "This QR code is invalid or has expired.")
+        return redirect('login')
+
+    is_student = await sync_to_async(lambda: request.user.is_authenticated and request.user.user_type == '3')()
+    request.session['attendance_token'] = token
+
+    if is_student:
+        return redirect('student_scan_qr')
+
+    messages.info(request, "Please log in to mark your attendance.")
+    return redirect('login')
+
+
@@ -0,0 +1,338 @@
+"""
+Write-behind buffer for QR check-ins.
+
+When settings.ATTENDANCE_WRITE_BEHIND is enabled, validated scans are not saved
+one by one. Each report is appended (and fsynced) to a per-process spool file
+under settings.ATTENDANCE_WRITE_BEHIND_DIR and acknowledged immediately. A
+background thread periodically claims the spool file and inserts its records
+with bulk_create in batches, so a burst of scans turns into a handful of
+INSERT statements instead of hundreds of competing transactions.
+
+Guarantees:
+- A record is on disk before the scan is acknowledged; spool files left behind
+  by a crashed process are picked up by the next flush (or by the
+  flush_attendance_buffer management command).
+- Records that can never be inserted (the Attendance or student row was
+  deleted before the flush) are moved to spool_dir/quarantine/ and the rest
+  of the spool keeps draining.
+- The buffer is flushed when a QR session expires, when the teacher loads the
+  attendance list, and at process exit, so the teacher's view is complete once
+  the QR code closes.
+- Spool files belong to one worker (and one machine), so no other process can
+  flush them. Instead every Attendance row has a pending counter in the
+  cache, raised on enqueue and lowered once the records are inserted;
+  wait_for_pending lets the close-out (see closeout.py) wait until every
+  worker's buffer for the class is saved. With several workers this needs a
+  shared cache (REDIS_URL), as does the duplicate marker in checkin.py.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.utils.timezone import now
+
+from .models import Attendance, AttendanceReport, Students
+
+
+# Pending counters outlive any QR session; they only need to survive until the buffer drains
+PENDING_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def is_enabled():
+    return getattr(settings, 'ATTENDANCE_WRITE_BEHIND', False)
+
+
+def attendance_pending_cache_key(attendance_id):
+    return f"attendance_pending_{attendance_id}"
+
+
+def _add_pending(attendance_id, delta):
+    key = attendance_pending_cache_key(attendance_id)
+    cache.add(key, 0, timeout=PENDING_CACHE_TIMEOUT)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Evicted between add and incr; a lost count only shortens wait_for_pending
+        pass
+
+
+def wait_for_pending(attendance_id, timeout=None):
+    """
+    Wait until no worker has buffered check-ins for an Attendance row.
+
+    Returns:
+    - bool: True once the buffers are drained, False if some were still
+      pending after timeout seconds (settings.ATTENDANCE_WRITE_BEHIND_CLOSE_WAIT)
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'ATTENDANCE_WRITE_BEHIND_CLOSE_WAIT', 5.0)
+    deadline = time.monotonic() + timeout
+    while (cache.get(attendance_pending_cache_key(attendance_id)) or 0) > 0:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AttendanceWriteBuffer:
+    """Durable, per-process buffer of AttendanceReport rows waiting to be inserted."""
+
+    def __init__(self, spool_dir, batch_size=200, flush_interval=1.0):
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._file = None
+        self._pending = 0
+        self._expiry_timers = {}
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._pid = None
+
+    @property
+    def active_path(self):
+        return os.path.join(self.spool_dir, f"attendance-{os.getpid()}.jsonl")
+
+    def _ensure_worker(self):
+        # Threads do not survive fork, so (re)start the worker per process
+        if self._worker is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._file = None
+        self._worker = threading.Thread(target=self._run, name="attendance-write-behind", daemon=True)
+        self._worker.start()
+        atexit.register(self.flush)
+
+    def enqueue(self, record, token=None, expiry_timestamp=None):
+        """
+        Append one report to the spool file. record holds AttendanceReport field
+        values keyed by column name (student_id_id, attendance_id_id, ...).
+        """
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+
+        # Raised before the write, so a flush can never lower it first
+        _add_pending(record['attendance_id_id'], 1)
+        try:
+            with self._lock:
+                self._ensure_worker()
+                if self._file is None:
+                    os.makedirs(self.spool_dir, exist_ok=True)
+                    self._file = open(self.active_path, 'a', encoding='utf-8')
+                self._file.write(line)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._pending += 1
+
+                if token and expiry_timestamp and token not in self._expiry_timers:
+                    self._schedule_expiry_flush(token, expiry_timestamp)
+        except Exception:
+            _add_pending(record['attendance_id_id'], -1)
+            raise
+
+        if self._pending >= self.batch_size:
+            self._wakeup.set()
+
+    def _schedule_expiry_flush(self, token, expiry_timestamp):
+        delay = max(expiry_timestamp - time.time(), 0) + 0.5
+
+        def on_expiry():
+            self._expiry_timers.pop(token, None)
+            self.flush(close_connection=True)
+
+        timer = threading.Timer(delay, on_expiry)
+        timer.daemon = True
+        self._expiry_timers[token] = timer
+        timer.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush(close_connection=True)
+            except Exception as e:
+                print(f"Write-behind flush failed, will retry: {e}")
+
+    def _claim_files(self):
+        """Rotate the active spool file and collect every file this process may flush."""
+        with self._lock:
+            if self._file is not None and self._pending:
+                self._file.close()
+                self._file = None
+                self._pending = 0
+                os.replace(self.active_path, f"{self.active_path}.{time.time_ns()}.flushing")
+
+        claimed = []
+        for path in glob.glob(os.path.join(self.spool_dir, "attendance-*.jsonl*")):
+            name = os.path.basename(path)
+            try:
+                pid = int(name.split('-', 1)[1].split('.', 1)[0])
+            except ValueError:
+                continue
+
+            if pid == os.getpid():
+                if path.endswith('.flushing'):
+                    claimed.append(path)
+            elif not _pid_is_alive(pid):
+                # Orphaned by a dead process: take ownership with an atomic rename
+                target = f"{self.active_path}.{time.time_ns()}.flushing"
+                try:
+                    os.replace(path, target)
+                except FileNotFoundError:
+                    continue
+                claimed.append(target)
+
+        return sorted(claimed)
+
+    def flush(self, close_connection=False):
+        """Insert all buffered reports. Returns the number of rows submitted."""
+        if not os.path.isdir(self.spool_dir):
+            return 0
+
+        submitted = 0
+        with self._flush_lock:
+            try:
+                for path in self._claim_files():
+                    submitted += self._flush_file(path)
+            finally:
+                if close_connection:
+                    connection.close()
+        return submitted
+
+    def _flush_file(self, path):
+        records = []
+        with open(path, encoding='utf-8') as spool:
+            for line in spool:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    continue
+
+        inserted = self._insert(records, path) if records else []
+        if inserted:
+            self._mark_absent_present(inserted)
+
+        os.unlink(path)
+        per_attendance = {}
+        for record in records:
+            per_attendance[record['attendance_id_id']] = per_attendance.get(record['attendance_id_id'], 0) + 1
+        for attendance_id, count in per_attendance.items():
+            _add_pending(attendance_id, -count)
+        return len(records)
+
+    def _insert(self, records, path):
+        """
+        bulk_create the records, setting aside the ones that can never be inserted
+        (their Attendance or student row was deleted meanwhile) so one bad record
+        does not block the spool. Returns the AttendanceReport objects submitted.
+        """
+        attendance_ids = set(Attendance.objects.filter(
+            id__in={record['attendance_id_id'] for record in records}
+        ).values_list('id', flat=True))
+        student_ids = set(Students.objects.filter(
+            id__in={record['student_id_id'] for record in records}
+        ).values_list('id', flat=True))
+
+        valid, rejected = [], []
+        for record in records:
+            if record['attendance_id_id'] in attendance_ids and record['student_id_id'] in student_ids:
+                valid.append(record)
+            else:
+                rejected.append(record)
+
+        reports = [AttendanceReport(status=True, **record) for record in valid]
+        try:
+            # Conflicts mean the row is already there (e.g. a replayed spool file)
+            AttendanceReport.objects.bulk_create(reports, batch_size=self.batch_size, ignore_conflicts=True)
+        except IntegrityError:
+            # Deleted between the check and the insert: fall back to one row at a time
+            inserted = []
+            for record, report in zip(valid, reports):
+                try:
+                    with transaction.atomic():
+                        AttendanceReport.objects.bulk_create([report], ignore_conflicts=True)
+                    inserted.append(report)
+                except IntegrityError:
+                    rejected.append(record)
+            reports = inserted
+
+        if rejected:
+            self._quarantine(path, rejected)
+        return reports
+
+    def _quarantine(self, path, records):
+        """Keep records that cannot be inserted under spool_dir/quarantine/ for inspection."""
+        quarantine_dir = os.path.join(self.spool_dir, 'quarantine')
+        os.makedirs(quarantine_dir, exist_ok=True)
+        target = os.path.join(quarantine_dir, f"{os.path.basename(path)}.jsonl")
+        with open(target, 'a', encoding='utf-8') as quarantine:
+            for record in records:
+                quarantine.write(json.dumps(record, separators=(',', ':')) + "\n")
+        print(f"Write-behind: {len(records)} check-ins could not be inserted, moved to {target}")
+
+    def _mark_absent_present(self, reports):
+        """Turn absent rows written by a close-out (see closeout.py) into the buffered check-ins."""
+        by_pair = {(report.student_id_id, report.attendance_id_id): report for report in reports}
+        absent = AttendanceReport.objects.filter(
+            status=False,
+            student_id__in={student_id for student_id, _ in by_pair},
+            attendance_id__in={attendance_id for _, attendance_id in by_pair}
+        ).values_list('student_id', 'attendance_id')
+        for pair in absent:
+            report = by_pair.get(pair)
+            if report is None:
+                continue
+            AttendanceReport.objects.filter(student_id_id=pair[0], attendance_id_id=pair[1], status=False).update(
+                status=True,
+                student_latitude=report.student_latitude,
+                student_longitude=report.student_longitude,
+                student_accuracy=report.student_accuracy,
+                location_verified=report.location_verified,
+                verification_details=report.verification_details,
+                updated_at=now()
+            )
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = AttendanceWriteBuffer(
+                    spool_dir=settings.ATTENDANCE_WRITE_BEHIND_DIR,
+                    batch_size=getattr(settings, 'ATTENDANCE_WRITE_BEHIND_BATCH_SIZE', 200),
+                    flush_interval=getattr(settings, 'ATTENDANCE_WRITE_BEHIND_INTERVAL', 1.0),
+                )
+    return _buffer
+
+
+def flush_pending_reports():
+    """Flush buffered check-ins if write-behind is enabled (no-op otherwise)."""
+    if not is_enabled():
+        return 0
+    return get_write_buffer().flush()
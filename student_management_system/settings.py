@@ -81,6 +81,93 @@ DATABASES = {
 }
 
 
+# Cache
+# QR sessions and check-in markers live in the cache. Set REDIS_URL to share them
+# between worker processes (redis package, see requirements.txt); otherwise each
+# process keeps its own in-memory cache.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'student-management',
+            'OPTIONS': {
+                'MAX_ENTRIES': 50000,  # Several keys per student per QR session
+            },
+        }
+    }
+
+
+# QR check-in write-behind
+# When enabled, validated scans are acknowledged immediately, spooled to disk and
+# inserted in batches by a background thread (see student_management_app/write_behind.py)
+ATTENDANCE_WRITE_BEHIND = os.environ.get('ATTENDANCE_WRITE_BEHIND', 'False') == 'True'
+ATTENDANCE_WRITE_BEHIND_DIR = os.path.join(BASE_DIR, 'attendance_spool')
+ATTENDANCE_WRITE_BEHIND_BATCH_SIZE = 200
+ATTENDANCE_WRITE_BEHIND_INTERVAL = 1.0  # Seconds between background flushes
+ATTENDANCE_WRITE_BEHIND_CLOSE_WAIT = 5.0  # Seconds a close-out waits for other workers' buffers before deferring
+
+# Route QR scans to the async views (set when serving through ASGI, see Procfile.asgi)
+QR_CHECKIN_ASYNC = os.environ.get('QR_CHECKIN_ASYNC', 'False') == 'True'
+
+# QR code images are rendered in memory and served from the cache ('svg' or 'png');
+# set QR_STORE_IMAGE to also keep a copy in MEDIA_ROOT
+QR_RENDER_FORMAT = os.environ.get('QR_RENDER_FORMAT', 'svg')
+QR_STORE_IMAGE = os.environ.get('QR_STORE_IMAGE', 'False') == 'True'
+
+# New QR codes use short uppercase base32 tokens on a /Q/<token> URL, which encode in
+# the QR alphanumeric mode (smaller code, faster scans); the old ?token= URLs still work
+QR_COMPACT_TOKENS = os.environ.get('QR_COMPACT_TOKENS', 'True') == 'True'
+
+# student_upload_qr decodes images in a process pool per web worker (0 = decode inline).
+# Uploads beyond QR_DECODE_MAX_IN_FLIGHT running or queued jobs, counted across all web workers
+# in the cache, get a 503 with Retry-After.
+QR_DECODE_WORKERS = int(os.environ.get('QR_DECODE_WORKERS', 2))
+QR_DECODE_MAX_IN_FLIGHT = int(os.environ.get('QR_DECODE_MAX_IN_FLIGHT', 8))
+# Seconds an upload waits for its decode before the 503; the job stops its attempts then too
+QR_DECODE_TIMEOUT = float(os.environ.get('QR_DECODE_TIMEOUT', 3))
+# Decoder order and downscaled attempts (longest side in pixels); measure with benchmark_qr_decode
+QR_DECODE_BACKENDS = ('pyzbar', 'opencv')
+QR_DECODE_DOWNSCALE_SIDES = (800, 1600)
+
+# Distance kernel for the check-in radius test: 'equirectangular' (default), 'haversine' or
+# 'geodesic' (geopy, the slow reference); compare them with benchmark_distance
+QR_DISTANCE_KERNEL = os.environ.get('QR_DISTANCE_KERNEL', 'equirectangular')
+
+# Classroom geofences: grid cell size of the in-process spatial index (0.001 degrees is ~110 m),
+# and how far outside a fence (meters) a scan is still accepted to absorb GPS drift at the walls
+GEOFENCE_GRID_CELL_DEGREES = float(os.environ.get('GEOFENCE_GRID_CELL_DEGREES', '0.001'))
+GEOFENCE_TOLERANCE_METERS = float(os.environ.get('GEOFENCE_TOLERANCE_METERS', '10'))
+# Seconds between checks of the geofence table for changes (each worker rebuilds its index on a change)
+GEOFENCE_INDEX_CHECK_SECONDS = float(os.environ.get('GEOFENCE_INDEX_CHECK_SECONDS', '5'))
+
+# Spoofed-location flags: spatial hash cell size in meters, and how many check-ins within a cell
+# and its neighbours (about 3x3 cells) count as a suspiciously tight cluster
+QR_SPOOF_CELL_METERS = float(os.environ.get('QR_SPOOF_CELL_METERS', '1'))
+QR_SPOOF_CLUSTER_SIZE = int(os.environ.get('QR_SPOOF_CLUSTER_SIZE', '4'))
+
+# pregenerate_qr_codes: site URL that pre-generated QR codes point at (no request to build it from)
+QR_SCAN_BASE_URL = os.environ.get('QR_SCAN_BASE_URL', '')
+
+# cleanup_qr_codes: expired QR code rows are kept this long before being purged. reverify_locations
+# needs a report's QR code (its coordinates and radius), so keep them for at least a semester
+QR_CODE_RETENTION_DAYS = int(os.environ.get('QR_CODE_RETENTION_DAYS', 180))
+QR_CODE_ARCHIVE_DIR = os.path.join(BASE_DIR, 'qr_archive')
+
+# Teacher's live check-in feed (server-sent events)
+QR_EVENT_POLL_INTERVAL = 1.0  # Seconds between cache polls per open feed
+# Seconds before a feed connection ends and the browser reconnects. Under a WSGI server each open
+# feed holds a worker for this long; production serves ASGI (render.yaml, Procfile.asgi) where it does not
+QR_EVENT_STREAM_MAX_DURATION = int(os.environ.get('QR_EVENT_STREAM_MAX_DURATION', 20))
+QR_DISTANCE_STATS_ACCURACY = 0.05  # Relative error of the distance percentiles shown in the feed
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -1,5 +1,6 @@
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 from .settings import *
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -26,6 +27,14 @@ else:
     }
     print("Using SQLite database for compatibility")  # Debug
 
+# QR sessions, check-in markers, the teacher's live feed, write-behind counters and the
+# per-session statistics live in the cache, so several workers must share one (Redis).
+# A per-process cache would let each worker see only its own scans.
+if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 and not os.environ.get('REDIS_URL'):
+    raise ImproperlyConfigured(
+        "WEB_CONCURRENCY > 1 needs a shared cache: set REDIS_URL (see render.yaml)"
+    )
+
 # Use environment variable for secret key
 SECRET_KEY = os.environ.get('SECRET_KEY', SECRET_KEY)
 